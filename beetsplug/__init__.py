@@ -1,3 +1,2 @@
 from pkgutil import extend_path
-__path__ = extend_path(__path__, __name__)
-from . import sftpuploader
\ No newline at end of file
+__path__ = extend_path(__path__, __name__)
\ No newline at end of file
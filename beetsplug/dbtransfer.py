@@ -0,0 +1,163 @@
+'''
+Cached, delta-aware transfer of the remote navidrome.db working copy.
+
+Alongside temp_path a small json sidecar records what the remote DB looked
+like when it was last transferred (size, mtime, sha1) and a digest of every
+block of the copy. Downloads are skipped while the remote is unchanged, and
+uploads only write the blocks that differ from that snapshot.
+
+Works with anything exposing the paramiko SFTPClient calls used here
+(stat, get, open), which includes pysftp connections.
+'''
+import os, re, json, hashlib, shlex
+
+DIGEST_SIZE = 8
+
+
+class RemoteChanged(Exception):
+    pass
+
+
+def page_size(path, default=4096):
+    '''SQLite page size from the DB header, so blocks line up with pages'''
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(18)
+        size = int.from_bytes(header[16:18], 'big')
+        return 65536 if size == 1 else (size or default)
+    except (OSError, ValueError):
+        return default
+
+def block_digests(path, block_size):
+    '''returns (concatenated block digests, whole-file sha1 hex) in one read pass'''
+    digests = bytearray()
+    sha1 = hashlib.sha1()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n: break
+            sha1.update(view[:n])
+            digests += hashlib.blake2b(view[:n], digest_size=DIGEST_SIZE).digest()
+    return (bytes(digests), sha1.hexdigest())
+
+
+class CachedRemoteDb:
+    def __init__(self, local_path, block_size=None):
+        self.local_path = local_path
+        self.meta_path = local_path + '.sync.json'
+        self.block_size = block_size
+        self.meta = self.load_meta()
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_meta(self, remote_path, st, block_size=None, digests=None, sha1=None):
+        block_size = block_size or self.block_size or page_size(self.local_path)
+        if digests is None:
+            (digests, sha1) = block_digests(self.local_path, block_size)
+        local = os.stat(self.local_path)
+        self.meta = {
+            'remote_path': remote_path,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'checksum': sha1,
+            'local_size': local.st_size,
+            'local_mtime': local.st_mtime,
+            'block_size': block_size,
+            'blocks': digests.hex(),
+        }
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+
+    def remote_unchanged(self, st, remote_path, remote_hash=None):
+        '''
+        whether the remote DB is still what the sidecar recorded
+        remote_hash - optional callable(path) returning the remote sha1, or None if unavailable
+        '''
+        m = self.meta
+        if not m or m['remote_path'] != remote_path: return False
+        if (m['size'], int(m['mtime'])) != (st.st_size, int(st.st_mtime)): return False
+        if remote_hash:
+            checksum = remote_hash(remote_path)
+            if checksum and checksum != m['checksum']: return False
+        return True
+
+    def local_unchanged(self):
+        '''the working copy hasn't been touched since it was last transferred'''
+        m = self.meta
+        if not m or not os.path.exists(self.local_path): return False
+        local = os.stat(self.local_path)
+        return (m['local_size'], m['local_mtime']) == (local.st_size, local.st_mtime)
+
+    def fetch(self, sftp, remote_path, remote_hash=None):
+        '''downloads the remote DB unless the cached copy is current, returns True if it downloaded'''
+        st = sftp.stat(remote_path)
+        if self.local_unchanged() and self.remote_unchanged(st, remote_path, remote_hash):
+            return False
+        sftp.get(remote_path, self.local_path)
+        self.save_meta(remote_path, st)
+        return True
+
+    def push(self, sftp, remote_path, remote_hash=None):
+        '''
+        writes only the blocks of the working copy that changed since fetch
+        remote_hash - as for fetch, catches writes that kept the size and mtime second
+        returns bytes sent, or None if there's no snapshot and the whole file has to go instead
+        raises RemoteChanged if the remote DB changed since fetch: its blocks no longer line
+        up with the snapshot, writing over them in place would mix two versions of the DB
+        '''
+        m = self.meta
+        if not m or m['remote_path'] != remote_path:
+            return None
+        if not self.remote_unchanged(sftp.stat(remote_path), remote_path, remote_hash):
+            raise RemoteChanged(f'{remote_path} changed on the remote since it was downloaded')
+        block_size = m['block_size']
+        base = bytes.fromhex(m['blocks'])
+        size = os.path.getsize(self.local_path)
+        digests = bytearray()
+        sha1 = hashlib.sha1()
+        sent = 0
+        with open(self.local_path, 'rb') as fl, sftp.open(remote_path, 'r+b') as fr:
+            fr.set_pipelined(True)
+            num = 0
+            while True:
+                data = fl.read(block_size)
+                if not data: break
+                sha1.update(data)
+                digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+                digests += digest
+                if digest != base[num * DIGEST_SIZE:(num + 1) * DIGEST_SIZE]:
+                    fr.seek(num * block_size)
+                    fr.write(data)
+                    sent += len(data)
+                num += 1
+            if size < m['size']:
+                fr.truncate(size)
+        self.save_meta(remote_path, sftp.stat(remote_path), block_size, bytes(digests), sha1.hexdigest())
+        return sent
+
+    def record(self, sftp, remote_path):
+        '''refreshes the snapshot after the whole file was uploaded some other way'''
+        self.save_meta(remote_path, sftp.stat(remote_path))
+
+
+def exec_sha1(execute):
+    '''
+    wraps an exec callable (e.g. pysftp's Connection.execute) into a remote_hash function
+    hosts that don't allow exec or lack sha1sum just return None, so size/mtime decide alone
+    '''
+    def remote_sha1(path):
+        try:
+            out = execute(f'sha1sum {shlex.quote(path)}')
+        except Exception:
+            return None
+        first = out[0].split()[0] if out and out[0].split() else b''
+        first = first.decode('utf-8', 'replace') if isinstance(first, bytes) else first
+        return first if re.fullmatch('[0-9a-f]{40}', first) else None
+    return remote_sha1
@@ -7,26 +7,63 @@ TODO:
 - Maybe support updating a remote db via sqlite3 commands sent to the remote server, in cases wher that's supported
 - Sync starred back to LastFM (ListenBrainz?)
 '''
-import sqlite3, os, sys, re, datetime 
+import sqlite3, os, re, json, time, datetime, pathlib 
 from functools import partial
-import pysftp
+from collections import namedtuple
 from beets.plugins import BeetsPlugin
-from beets.ui import (Subcommand)
+from beets.ui import (Subcommand, UserError)
 from beets import dbcore, config
-from sftpuploader import SftpUploader
+from beets.library import Item, parse_query_parts
+from ndmatch import MediaFileIndex, FullTextIndex, ItemIndex, RULES, relative_path, fulltext_tokens, read_items, item_path
+from ndwrite import NavidromeWriter, set_pragmas
+from ndledger import SyncLedger, fingerprint
+from ndremote import RemoteSqlDb
+from ndstats import Progress, Metrics
+from ndsql import SqlEngine, supported as sql_engine_supported
+from ndplan import make_plan, save_plan, load_plan, apply_plan, PlanError, PlanConflict
+from ndwatch import Debouncer, AnnotationPoller
+from ndcopy import WorkingCopy
+from ndmerge import merge, number, Annotation, NO_ANNOTATION, SIDES as MERGE_SIDES
 from beets.util import (bytestring_path, path_as_posix)
+# the SFTP/SSH (paramiko), progress bar (tqdm), HTTP and file time modules are imported
+# where they're used, a plain beet ls shouldn't pay for loading them
 
 
 
+# beets field each pushed annotation field comes from, unless dbuser maps it for a user
+USER_FIELDS = {'play_count': 'play_count', 'rating': 'rating', 'starred': 'starred'}
+
+# a media_file row with the pulled user's annotation, ndpull reads these PULL_CHUNK at a time
+Track = namedtuple('Track', 'nd_item_id artist album_artist album title mb_trackid updated_at play_count rating starred')
+PULL_CHUNK = 2000
+
+
 class NavidromeSyncPlugin(BeetsPlugin):
     def __init__(self):
         super().__init__()
         self.config.add({
             'dbpath': '',
-            'dbuser': '',
+            'dbuser': '', # a Navidrome user_name, a list of them, or user_name => {play_count/rating/starred: beets field}
             'temp_path': "./temp.db",
-            'pushtarget': 'local', # accepts: sftp, remote, local, or both
+            'ledger_path': '', # defaults to navidrome_sync.db in the beets config dir
+            'journal_mode': '', # pragmas for the downloaded temp_path copy only, e.g. memory / off
+            'synchronous': '',
+            'in_memory': False, # push against an in-memory copy of the DB, the changes are written back in one short transaction
+            'pushtarget': 'local', # accepts: sftp, remote, local, both, remote-sql (runs sqlite3 on the sftp host) or api (Subsonic API)
             "push-annotations": True,
+            'time_source': 'mtime', # file time --time pushes: mtime, ctime or birthtime (what --ctime picks)
+            'scan_workers': 8, # directories listed at once for --time
+            'engine': 'python', # python or sql (matches and writes with set based SQL against the attached beets DB)
+            'watch': {
+                'interval': 2, # seconds between looks for changes
+                'debounce': 3, # seconds without new beets changes before they're pushed
+                'max_wait': 30, # seconds a beets change waits at most while changes keep coming
+                'batch': 500, # items per push/pull batch
+                'record': False, # beets runs queue the items they change for ndwatch (in the ledger DB), only ndwatch empties the queue
+            },
+            'sync': {
+                'ratings': 'navidrome', # side whose ratings win in ndsync: navidrome or beets
+            },
             # 'ratingkey': 'rating',
             # 'favoritekey': 'starred',
             'navidrome': {
@@ -34,6 +71,11 @@ class NavidromeSyncPlugin(BeetsPlugin):
                 'username': '',
                 'password': '',
                 'port': 443,
+                'workers': 8, # API calls in flight at once
+                'rate': 50, # API calls per second at most, 0 for no limit
+                'batch': 200, # ids per star/unstar/scrobble call
+                'page_size': 500, # songs per search3 page
+                'scrobble': False, # push play counts by scrobbling the missing plays, these go on to Last.fm etc. if set up
             },
             'sftp': {
                 'auto': False,
@@ -42,13 +84,49 @@ class NavidromeSyncPlugin(BeetsPlugin):
                 'password': '',
                 'port': 22,
                 'directory' : '/music/',
-                'dbpath': '/data/navidrome.db'
+                'dbpath': '/data/navidrome.db',
+                'delta': True, # keep temp_path between runs, only transfer the DB when/where it changed
+                'compress': False,
+                'connections': 2, # SSH connections kept open for the run
+                'channels': 4, # SFTP channels per connection
+                'idle_timeout': 60,
+                'workers': 8, # files/chunks uploaded at once
+                'chunk_size': 8 * 1024 * 1024, # files over twice this are split into chunks
+                'block_size': 256 * 1024, # bytes read and written per SFTP write, from buffers reused for the whole upload
+                'pipeline': 1, # blocks read ahead per chunk by a reader thread, 1 reads them inline
+                'verify': True, # check uploads against their chunks' sha1s, resending chunks that don't match
+                'journal': '', # resume info for interrupted uploads, defaults to the beets config dir
+                'auto_workers': 2, # import tasks uploaded at once during auto upload
+                'auto_queue': 4, # import tasks waiting to upload before the import is held up
+                'sqlite3': 'sqlite3', # sqlite3 shell on the host, for pushtarget: remote-sql
             }
         })
         self.config['navidrome']['username'].redact = True
         self.config['navidrome']['password'].redact = True
         self.config['sftp']['username'].redact = True
         self.config['sftp']['password'].redact = True
+        self.pool = None
+        self.remote = None
+        self.uploader = None
+        self.background = None
+        self.metrics = Metrics()
+        self.watch_changes = set()
+        self.watch_cache = None
+        self.watching = False
+        self.pulling = False
+        if self.config['watch']['record'].get(bool):
+            self.register_listener('database_change', self.item_changed)
+            self.register_listener('item_imported', self.item_imported)
+            self.register_listener('album_imported', self.album_imported)
+            self.register_listener('after_write', self.item_written)
+            self.register_listener('cli_exit', self.queue_changes)
+        if self.config['sftp']['auto'].get():
+            self.register_listener('import_begin', self.sftp_auto_begin)
+            self.register_listener('import_task_files', self.add_imported_items)
+            self.register_listener('import', self.sftp_auto)
+
+    def sftp_config(self):
+        '''the sftp settings SftpPool and SftpUploader take, raises UserError when the connection details are incomplete'''
         sftp_config = {
             'host': self.config['sftp']['host'].get(),
             'username': self.config['sftp']['username'].get(),
@@ -56,40 +134,89 @@ class NavidromeSyncPlugin(BeetsPlugin):
             'port': self.config['sftp']['port'].get(),
             'directory': self.config['sftp']['directory'].get(),
             'local_directory': config['directory'].as_str(),
+            'compress': self.config['sftp']['compress'].get(bool),
+            'workers': self.config['sftp']['workers'].get(int),
+            'chunk_size': self.config['sftp']['chunk_size'].get(int),
+            'block_size': self.config['sftp']['block_size'].get(int),
+            'pipeline': self.config['sftp']['pipeline'].get(int),
+            'verify': self.config['sftp']['verify'].get(bool),
+            'journal': self.config['sftp']['journal'].as_str() or os.path.join(config.config_dir(), 'navidrome_sync_uploads.json'),
         }
-        check = ['host', 'username', 'port', 'password', 'directory']
-        self.imported_items = []
-        if all(k in sftp_config and sftp_config[k] for k in check):
-            self.uploader = SftpUploader(sftp_config, self._log)
-            if self.config['sftp']['auto'].get():
-                self.register_listener('import_task_files', self.add_imported_items)
-                self.register_listener('import', self.sftp_auto)
+        missing = [k for k in ('host', 'username', 'port', 'password', 'directory') if not sftp_config[k]]
+        if missing:
+            raise UserError(f'Configure sftp {", ".join(missing)} to upload files or use a remote DB')
+        return sftp_config
+
+    def sftp_setup(self):
+        '''sets up the SFTP pool and uploader the first time a command or auto upload needs them, returns the uploader'''
+        if self.uploader is None:
+            from sftppool import SftpPool
+            from sftpuploader import SftpUploader
+            sftp_config = self.sftp_config()
+            self.pool = SftpPool(sftp_config,
+                                 self.config['sftp']['connections'].get(int),
+                                 self.config['sftp']['channels'].get(int),
+                                 self.config['sftp']['idle_timeout'].get(int))
+            self.uploader = SftpUploader(sftp_config, self._log, self.pool)
+            self.uploader.metrics = self.metrics
+        return self.uploader
+
+    def sftp_auto_begin(self, session):
+        '''checks the sftp config before the import moves any files, and starts the background uploads'''
+        from sftpuploader import BackgroundUploader
+        self.background = BackgroundUploader(self.sftp_setup(), self._log,
+                                             self.config['sftp']['auto_workers'].get(int),
+                                             self.config['sftp']['auto_queue'].get(int))
 
     def add_imported_items(self, task):
-        if task.is_album:
-            for item in task.items:
-                self.imported_items.append(item)
-        else:
-            self.imported_items.append(task.item)
+        '''queues the task's files for upload in the background while the import carries on'''
+        self.background.put(task.imported_items())
 
     def sftp_auto(self, *rest):
-        items = self.imported_items
-        if len(items) == 0: return
-        self._log.info('Auto upload enabled, uploading to remote storage...')
-        self.uploader.upload(items, None, None)
-        self._log.info('Upload complete')
+        if self.background is None:
+            return
+        self._log.info('Waiting for background uploads to finish...')
+        stats = self.background.drain()
+        self.background.close()
+        self.background = None # a later import in the same process starts a new one
+        self.pool.close()
+        self._log.info('Upload complete: {0} files ({1:.1f} MB) uploaded, {2} already on the remote, {3} failed',
+                       stats['files'], stats['bytes'] / 1024 / 1024, stats['skipped'], stats['failed'])
+
+
+    def item_changed(self, lib, model):
+        # not what a pull just stored, pushing it back would change nothing
+        if isinstance(model, Item) and not self.pulling:
+            self.watch_changes.add(model.id)
+
+    def item_imported(self, lib, item):
+        self.watch_changes.add(item.id)
+
+    def album_imported(self, lib, album):
+        self.watch_changes.update(i.id for i in album.items())
 
+    def item_written(self, item, **rest):
+        self.watch_changes.add(item.id)
+
+    def queue_changes(self, lib):
+        '''on exit, hands the items this beets run changed to ndwatch (ndwatch itself takes them directly)'''
+        if self.watch_changes and not self.watching:
+            ledger = self.open_ledger()
+            ledger.queue(self.watch_changes)
+            ledger.close()
 
     def commands(self):
         nddb = Subcommand('nddb', help="Update remote DB")
         nddb.func = self.update_remote_db
         upload = Subcommand('ndupload', help='Sends new tracks matching a query to remote storage')
+        upload.parser.add_option('--stats', action='store_true', default=False, help="Print a JSON report of timings and transfer rates when done")
         upload.func = self.upload
         pull = Subcommand('ndpull', help='Pulls playcounts & starred items from Navidrome')
+        pull.parser.add_option('--stats', action='store_true', default=False, help="Print a JSON report of timings and match counts when done")
         pull.func = partial(self.nd_sync, 'pull')
         push = Subcommand('ndpush', help='Push file times to Navidrome')
         push.parser.add_option( '-t', '--time',          action='store_true',    default=False,      help="push directory file times to Navidrome db.")
-        push.parser.add_option( '-c', '--ctime',         action='store_true',    default=False,      help="additional option for --time, uses created time (on Windows) rather than modified time.")
+        push.parser.add_option( '-c', '--ctime',         action='store_true',    default=False,      help="additional option for --time, uses the file's creation (birth) time rather than modified time where the OS/filesystem records it.")
         push.parser.add_option( '-b', '--mb',            action='store_true',    default=True,       help="push MusicBrainz data from beets to Navidrome db.")
         push.parser.add_option( '-B', '--no-mb',         action='store_false',   dest='mb',          help="Don't push MusicBrainz data from beets to Navidrome db.")
         push.parser.add_option( '-s', '--starred',       action='store_true',    default=True,       help="Push starred tracks")
@@ -100,60 +227,386 @@ class NavidromeSyncPlugin(BeetsPlugin):
         push.parser.add_option( '-R', '--no-ratings',    action='store_false',   dest='ratings',     help="Don't push ratings")
         push.parser.add_option( '-l', '--log',                                   dest='log_path',    help="Log missed items to file")
         push.parser.add_option( '-A', '--no-annotations',action='store_true',    default=False,      help="Don't update any annotations (play counts, ratings, starred, MusicBrainz data)")
+        push.parser.add_option( '-i', '--incremental',   action='store_true',    default=False,      help="Only push items that changed since the last push to the same DB")
+        push.parser.add_option( '--stats',                action='store_true',    default=False,      help="Print a JSON report of timings, match counts, write and transfer rates when done")
+        push.parser.add_option( '--engine',               choices=('python', 'sql'), default=None,   help="Match and write in Python (default) or as set based SQL with the beets DB attached")
+        push.parser.add_option( '--report',                                      dest='report_path', help="With --engine sql, write every item's match (rule and media_file id) to this SQLite file")
+        push.parser.add_option( '--plan',                                        dest='plan_path',   help="Only read the Navidrome DB and save what the push would change (with the values it replaces) to this file")
+        push.parser.add_option( '--apply',                                       dest='apply_path',  help="Write a --plan file in one short transaction, if none of the rows it changes were changed since")
         push.func = partial(self.nd_sync, 'push')
-        return [push, pull, upload, nddb]
+        ndmap = Subcommand('ndmap', help='Checks the saved beets item <=> Navidrome track mapping push and pull reuse')
+        ndmap.parser.add_option('--prune', action='store_true', default=False, help="Drop entries whose item or track is gone, moved or rescanned")
+        ndmap.parser.add_option('--rebuild', action='store_true', default=False, help="Forget the mapping and match the library (or query) again, nothing is written to Navidrome")
+        ndmap.func = partial(self.nd_sync, 'map')
+        watch = Subcommand('ndwatch', help='Keeps running and syncs annotations both ways as they change (pushtarget: local)')
+        watch.parser.add_option('--no-push', action='store_false', dest='push', default=True, help="Only pull Navidrome's changes into beets")
+        watch.parser.add_option('--no-pull', action='store_false', dest='pull', default=True, help="Only push beets' changes to Navidrome")
+        watch.func = self.nd_watch
+        sync = Subcommand('ndsync', help='Syncs play counts, ratings and stars both ways in one pass')
+        sync.parser.add_option('--ratings', choices=MERGE_SIDES, default=None, help="Side whose ratings win (default from sync: ratings, navidrome)")
+        sync.parser.add_option('--stats', action='store_true', default=False, help="Print a JSON report of timings and match counts when done")
+        sync.func = partial(self.nd_sync, 'sync')
+        return [push, pull, upload, nddb, ndmap, watch, sync]
     
     def nd_sync(self, mode, lib, opts, args):
-        input('This is a destructive operation, please make sure you have a backup of your Navidrome DB before continuing. Press enter to continue...')
         target = self.config['pushtarget'].as_str()
+        (plan_path, apply_path) = (getattr(opts, 'plan_path', None), getattr(opts, 'apply_path', None))
+        if plan_path and apply_path:
+            raise UserError('Use --plan or --apply, not both')
+        if (plan_path or apply_path) and target not in ('local', 'sftp', 'remote'):
+            raise UserError(f'--plan and --apply work on one Navidrome DB file, pushtarget local, sftp or remote (not {target})')
+        if mode == 'sync' and target in ('remote-sql', 'api'):
+            raise UserError(f'ndsync reads and writes the Navidrome DB file, it needs pushtarget local, sftp, remote or both (not {target})')
+        if mode != 'map' and not plan_path and not apply_path:
+            input('This is a destructive operation, please make sure you have a backup of your Navidrome DB before continuing. Press enter to continue...')
         remoteEnabled = re.search('^(sftp|remote|both)$', target)
         localEnabled = re.search('^(local|both)$', target)
+        remoteSqlEnabled = target == 'remote-sql'
+        apiEnabled = target == 'api'
         items = lib.items(args)
-        for enabled, func in ((remoteEnabled, self.get_remote_db), (localEnabled, self.get_local_db)):
+        self.start_metrics()
+        for enabled, func in ((remoteEnabled, self.get_remote_db), (localEnabled, self.get_local_db),
+                              (remoteSqlEnabled, self.get_remote_sql_db), (apiEnabled, self.get_api_db)):
             name = func.__name__
             if name == 'get_remote_db' and not remoteEnabled: continue
             if name == 'get_local_db' and not localEnabled: continue
             if not enabled: continue
-            (conn, cur) = func()
+            with self.metrics.phase('db_fetch'):
+                (conn, cur) = func('plan' if plan_path else mode)
+            copy = None
+            if (conn and mode in ('push', 'sync') and not plan_path and not apply_path and name in ('get_local_db', 'get_remote_db')
+                    and self.config['in_memory'].get(bool)):
+                (conn, cur, copy) = self.working_copy(name, conn)
             if not conn:
                 self._log.info(f'Unable to connect to configured DB path for function "{mode}". Exiting...')
                 continue
             else:
+                pushed = None
+                remote = self.remote if name in ('get_remote_sql_db', 'get_api_db') else None
                 if mode == 'push':
-                    self.nd_push_annotations(conn, cur, items, opts)
+                    if apply_path:
+                        pushed = self.nd_apply(conn, apply_path, self.ledger_key(name))
+                    elif self.use_sql_engine(opts, remote):
+                        pushed = self.nd_push_sql(conn, cur, lib, args, opts, self.ledger_key(name))
+                    else:
+                        pushed = self.nd_push_annotations(conn, cur, items, opts, self.ledger_key(name), remote)
+                    conn.commit()
+                    if copy:
+                        self.write_back(copy)
+                elif mode == 'sync':
+                    self.nd_merge(conn, cur, lib, items, opts, self.ledger_key(name))
                     conn.commit()
+                    if copy:
+                        self.write_back(copy)
                 elif mode == 'pull':
-                    self.nd_pull(lib, conn, cur)
+                    self.nd_pull(lib, conn, cur, self.ledger_key(name), remote)
+                elif mode == 'map':
+                    self.nd_map(conn, cur, lib, args, opts, self.ledger_key(name), remote)
                 conn.close()
                 conn = None
                 cur = None
-                if name == 'get_remote_db':
-                    self.update_remote_db()
+                if name == 'get_api_db':
+                    self.remote.close()
+                if name == 'get_remote_db' and mode != 'map' and not plan_path:
+                    with self.metrics.phase('db_upload'):
+                        self.update_remote_db()
+                if pushed:
+                    ledger = self.open_ledger()
+                    ledger.record(self.ledger_key(name), pushed)
+                    ledger.close()
+        if self.pool:
+            self.pool.close()
+        self.print_stats(opts)
         return
 
-    def get_local_db(self, *rest):
+    def start_metrics(self):
+        self.metrics = Metrics()
+        if self.uploader:
+            self.uploader.metrics = self.metrics
+
+    def print_stats(self, opts):
+        if getattr(opts, 'stats', False):
+            print(json.dumps(self.metrics.report(), indent=2))
+
+    def ledger_key(self, name):
+        '''identifies the Navidrome DB a push went to, so ledger entries for different targets don't mix'''
+        if name == 'get_api_db':
+            return f"subsonic://{self.config['navidrome']['username'].as_str()}@{self.config['navidrome']['host'].as_str()}"
+        if name in ('get_remote_db', 'get_remote_sql_db'):
+            return f"sftp://{self.config['sftp']['host'].as_str()}{self.config['sftp']['dbpath'].as_str()}"
+        return os.path.abspath(self.config['dbpath'].as_str())
+
+    def ledger_path(self):
+        return self.config['ledger_path'].as_str() or os.path.join(config.config_dir(), 'navidrome_sync.db')
+
+    def open_ledger(self):
+        return SyncLedger(self.ledger_path())
+
+    def scan_times(self, paths, opts):
+        '''
+        file times for --time read from the filesystem (see ndtimes)
+        returns dict of path => UTC string, files not found locally are left out
+        '''
+        from ndtimes import TimeScanner, KINDS as TIME_KINDS
+        kind = 'birthtime' if opts.ctime else self.config['time_source'].as_choice(TIME_KINDS)
+        scanner = TimeScanner(self.ledger_path(), kind, self.config['scan_workers'].get(int))
+        try:
+            with self.metrics.phase('time_scan'):
+                times = scanner.scan(paths)
+        finally:
+            scanner.close()
+        self.metrics.count('time_dirs_listed', scanner.listed)
+        self.metrics.count('time_dirs_unchanged', scanner.unchanged)
+        self._log.info('Read {0} of {1} files ({2} directories listed, {3} unchanged since the last scan)',
+                       kind, len(times), scanner.listed, scanner.unchanged)
+        if scanner.fallbacks:
+            self._log.info('No birth time recorded for {0} files on this system/filesystem, used their mtime', scanner.fallbacks)
+        if scanner.missing and scanner.missing * 2 > len(paths):
+            self._log.warning('{0} of {1} files not found locally, using the mtime stored in beets for them. '
+                              'Are the files at the paths beets has for them on this machine?', scanner.missing, len(paths))
+        elif scanner.missing:
+            self._log.info('{0} files not found locally, using the mtime stored in beets for them', scanner.missing)
+        return times
+
+    def working_copy(self, name, conn):
+        '''swaps the DB connection for one to an in-memory copy of the DB (see ndcopy)'''
+        conn.close()
+        path = self.config['temp_path' if name == 'get_remote_db' else 'dbpath'].as_str()
+        with self.metrics.phase('db_copy'):
+            copy = WorkingCopy(path)
+        self._log.info('Copied {0} into memory in {1:.2f}s', path, copy.copy_seconds)
+        return (copy.conn, copy.conn.cursor(), copy)
+
+    def write_back(self, copy):
+        (rows, secs) = copy.write_back()
+        self.metrics.add_time('write_back', secs)
+        self.metrics.count('rows_written_back', rows)
+        self._log.info('Wrote {0} changed rows back to {1}, the DB was locked for {2:.3f}s', rows, copy.path, secs)
+
+    def get_local_db(self, mode='push'):
         dbpath = self.config['dbpath'].as_str()
         if not dbpath:
             self._log.info('Configure a valid local dbpath to continue. Exiting...')
             return
-        return self.db_connect(dbpath)
+        return self.db_connect(dbpath, mode == 'plan')
      
-    def get_remote_db(self, *rest):
+    def get_remote_db(self, mode='push'):
         local_path = self.config['temp_path'].as_str()
+        remote_path = self.config['sftp']['dbpath'].as_str()
+        from dbtransfer import CachedRemoteDb, exec_sha1
         with self.sftp_connect() as sftp:
-            sftp.get(self.config['sftp']['dbpath'].as_str(), local_path)
-            return self.db_connect(local_path)
+            started = time.perf_counter()
+            if self.config['sftp']['delta'].get(bool):
+                if not CachedRemoteDb(local_path).fetch(sftp, remote_path, exec_sha1(partial(self.pool.execute, sftp=sftp))):
+                    self._log.info('Remote DB unchanged since last sync, using cached copy')
+                    started = None
+            else:
+                sftp.get(remote_path, local_path)
+            if started:
+                self.metrics.transfer('db_download', os.path.getsize(local_path), time.perf_counter() - started)
+            (conn, cur) = self.db_connect(local_path, mode == 'plan')
+            if conn and mode != 'plan':
+                set_pragmas(conn, self.config['journal_mode'].as_str(), self.config['synchronous'].as_str())
+            return (conn, cur)
 
-    def nd_push_annotations(self, conn, cur, items, opts):
-        user_name = self.config['dbuser'].as_str()
-        if not user_name:
-            self._og.info('Set dbuser in config to a valid Navidrome username for new or modified annotations')
-            return
-        cur.execute('SELECT id FROM user WHERE user_name = ?', (user_name,))
-        user_id = cur.fetchone()[0]
-        print(user_id)
-        if not user_id:
+    def get_remote_sql_db(self, mode='push'):
+        '''
+        streams the bits of the remote DB matching needs into memory, the push is
+        sent back as SQL (see ndremote), nothing is downloaded or uploaded whole
+        '''
+        self.sftp_setup()
+        self.remote = RemoteSqlDb(self.pool, self.config['sftp']['dbpath'].as_str(), self.config['sftp']['sqlite3'].as_str())
+        started = time.perf_counter()
+        try:
+            names = [name for (name, _) in self.push_users()]
+            (conn, cur) = self.remote.projection(mode == 'pull', names[:1] if mode == 'pull' else names)
+        except OSError as e:
+            raise UserError(f'Unable to read the remote DB with sqlite3 over SSH: {e}')
+        self.metrics.transfer('db_projection', self.remote.received, time.perf_counter() - started)
+        self._log.info('Read {0} media files from the remote DB ({1:.1f} MB)', cur.execute('SELECT count(*) FROM media_file').fetchone()[0],
+                       self.remote.received / 1024 / 1024)
+        return (conn, cur)
+
+    def get_api_db(self, *rest):
+        '''pages every song in through the Subsonic API, pushes are sent back as API calls (see subsonic)'''
+        from subsonic import SubsonicError, ApiTarget
+        api = self.config['navidrome']
+        login = api['username'].as_str()
+        # the API only ever acts as the logged in user, another dbuser's fields would end up on the login's account
+        others = [name for (name, _) in self.push_users() if name.casefold() != login.casefold()]
+        if others:
+            raise UserError(f'pushtarget: api reads and writes as the navidrome login {login}, not dbuser {", ".join(others)}. '
+                            f'Set dbuser to {login} or leave it unset')
+        client = self.subsonic_api_connect()
+        self.remote = ApiTarget(client, next((name for (name, _) in self.push_users()), None) or login,
+                                api['batch'].get(int), api['page_size'].get(int), api['scrobble'].get(bool), self._log)
+        started = time.perf_counter()
+        try:
+            (conn, cur) = self.remote.projection()
+        except (SubsonicError, OSError) as e:
+            self.remote.close()
+            raise UserError(f'Unable to read songs through the Subsonic API: {e}')
+        self.metrics.transfer('api_read', client.received, time.perf_counter() - started)
+        self._log.info('Read {0} songs through the Subsonic API in {1} calls', cur.execute('SELECT count(*) FROM media_file').fetchone()[0],
+                       client.calls)
+        return (conn, cur)
+
+    def use_sql_engine(self, opts, remote=None):
+        if (opts.engine or self.config['engine'].as_str()) != 'sql':
+            return False
+        if opts.plan_path:
+            self._log.info('--plan matches with the python engine')
+            return False
+        if remote:
+            self._log.info('The sql engine needs the Navidrome DB file, pushing to {0} with the python engine', remote.name)
+            return False
+        if not sql_engine_supported():
+            self._log.info('The sql engine needs sqlite 3.33 or newer (have {0}), using the python engine', sqlite3.sqlite_version)
+            return False
+        return True
+
+    def push_users(self):
+        '''
+        dbuser as a list of (user_name, {annotation field: beets field}), it can be one
+        user_name, a list of them (all get the same values), or a mapping of user_name to
+        the beets fields that user's play_count/rating/starred come from
+        '''
+        value = self.config['dbuser'].get()
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = [value]
+        users = []
+        for (name, fields) in (value.items() if isinstance(value, dict) else ((v, None) for v in value)):
+            fields = dict(fields or {})
+            unknown = set(fields) - set(USER_FIELDS)
+            if unknown:
+                raise UserError(f'dbuser {name}: unknown field(s) {", ".join(unknown)}, expected {", ".join(USER_FIELDS)}')
+            users.append((str(name), dict(USER_FIELDS, **{k: str(v) for (k, v) in fields.items()})))
+        return users
+
+    def user_ids(self, cur, remote=None):
+        '''the pushed users found in the DB's user table, list of (user_id, user_name, fields)'''
+        users = self.push_users()
+        if not users and getattr(remote, 'user_name', ''):
+            users = [(remote.user_name, dict(USER_FIELDS))]
+        if not users:
+            self._log.info('Set dbuser in config to a valid Navidrome username for new or modified annotations')
+            return []
+        found = []
+        for (name, fields) in users:
+            row = cur.execute('SELECT id FROM user WHERE user_name = ?', (name,)).fetchone()
+            if row:
+                found.append((row[0], name, fields))
+            else:
+                self._log.info('Navidrome user {0} not found, skipping it', name)
+        if not found:
             self._log.info('Configured dbuser username does not return a valid user_id. Exiting...')
+        return found
+
+    def nd_map(self, conn, cur, lib, args, opts, target, remote=None):
+        '''
+        reports how much of the saved mapping for a target still holds, --prune drops
+        the rest, --rebuild forgets it and runs the push's matching with nothing to write
+        '''
+        ledger = self.open_ledger()
+        if opts.rebuild:
+            ledger.forget(target)
+        mapping = ledger.mapping(target)
+        files = dict(cur.execute('SELECT id, updated_at FROM media_file'))
+        with lib.transaction() as tx:
+            paths = {id: item_path(path, lib.directory) for (id, path) in tx.query('SELECT id, path FROM items')}
+        invalid = [i for (i, (nd_id, path, updated_at)) in mapping.items()
+                   if nd_id not in files or paths.get(i) != path or files[nd_id] != updated_at]
+        self._log.info('{0}: {1} mapped items, {2} no longer valid', target, len(mapping), len(invalid))
+        if opts.prune and invalid:
+            ledger.forget(target, invalid)
+            self._log.info('Pruned {0} entries', len(invalid))
+        ledger.close()
+        if opts.rebuild:
+            push = next(c for c in self.commands() if c.name == 'ndpush')
+            (match_opts, _) = push.parser.parse_args(['--no-annotations'])
+            if self.use_sql_engine(match_opts, remote):
+                self.nd_push_sql(conn, cur, lib, args, match_opts, target)
+            else:
+                self.nd_push_annotations(conn, cur, lib.items(args), match_opts, target, remote)
+
+    def nd_push_sql(self, conn, cur, lib, args, opts, target=None):
+        '''
+        push with the set based engine (see ndsql), items are read from the beets DB
+        with SQL instead of being loaded as Items, only unmatched ones go through Python
+        target - ledger key of the DB, items with a still valid saved mapping skip matching
+        '''
+        users = self.user_ids(cur)
+        if not users:
+            return
+        if opts.incremental:
+            self._log.info('--incremental is ignored by the sql engine, every matched item is pushed')
+        annotate = not opts.no_annotations
+        fields = NavidromeWriter(None, opts.starred and annotate, opts.playcounts and annotate, opts.ratings and annotate).fields
+        (query, sort) = parse_query_parts(args, Item)
+        sort = sort or lib.get_default_item_sort() # same order lib.items(args) lists them in
+        (clause, subvals) = query.clause()
+        if target:
+            self.open_ledger().close() # creates the mapping table if needed
+        engine = SqlEngine(conn, os.fsdecode(lib.path), config['directory'].as_str(), target and self.ledger_path(), target, lib.directory)
+        try:
+            with self.metrics.phase('index_build'):
+                # queries on flex fields have no SQL clause, beets picks the items for those
+                total = engine.build_keys(clause or '1', subvals, None if clause else [i.id for i in lib.items(query)],
+                                          sort.order_clause(), {f for (_, _, user_fields) in users for f in user_fields.values()})
+            if total == 0:
+                self._log.info('Supplied query returned zero results. Exiting...')
+                return
+            with self.metrics.phase('matching'):
+                counts = engine.match()
+                unmatched = engine.unmatched()
+                fuzzy = []
+                missed_log = []
+                if unmatched:
+                    with self.metrics.phase('fulltext_index_build'):
+                        fulltext = FullTextIndex(cur)
+                for (item_id, artist, albumartist, album, title, path, mb_trackid) in unmatched:
+                    id = self.fuzzy_search([artist, albumartist, album, title], cur, fulltext)[0]
+                    if id:
+                        fuzzy.append((item_id, id))
+                    else:
+                        missed_log.append(f'missed:{artist},{title},{path},{mb_trackid}')
+                engine.add_matches(fuzzy)
+            for (k, v) in counts.items():
+                self.metrics.count(f'match.{k}', v)
+            self.metrics.count('missed', len(missed_log))
+            self._log.info('Matched {0} of {1} items by: {2}', engine.matched(), total, ', '.join(f'{k} {v}' for k, v in counts.items()))
+            if opts.time:
+                paths = engine.item_paths()
+                times = self.scan_times([p for (_, p) in paths], opts)
+                engine.set_times((id, times.get(p)) for (id, p) in paths)
+            started = time.perf_counter()
+            rows = engine.write([(user_id, user_fields) for (user_id, _, user_fields) in users], fields, opts.mb and annotate, opts.time)
+            secs = time.perf_counter() - started
+            self.metrics.add_time('writes', secs)
+            self.metrics.count('rows_written', rows)
+            self._log.info('Wrote {0} rows in {1:.2f}s ({2:.0f} rows/s)', rows, secs, rows / secs if secs else rows)
+            if opts.report_path:
+                engine.report(opts.report_path)
+                self._log.info('Match report written to {0}', opts.report_path)
+        finally:
+            engine.close()
+        if opts.log_path is not None:
+            f = open(opts.log_path, "w", encoding='utf-8')
+            f.write('\r\n'.join(missed_log))
+            f.close()
+        self._log.info('Navidrome push complete')
+
+    def nd_push_annotations(self, conn, cur, items, opts, target=None, remote=None):
+        '''
+        target - ledger key of the DB being pushed to, with --incremental items whose
+        pushed fields haven't changed since the last push there are skipped
+        remote - RemoteSqlDb or ApiTarget the changes are sent to instead of writing to conn
+        returns list of (item id, fingerprint, media_file id) for the ledger
+        '''
+        users = self.user_ids(cur, remote)
+        if not users:
             return
         self._log.info('Pushing ' +
                     ('starred, ' if opts.starred and not opts.no_annotations else '') +
@@ -163,9 +616,29 @@ class NavidromeSyncPlugin(BeetsPlugin):
                     ('modified time, ' if opts.time else '') +
                     'to Navidrome DB'
         )
+        pushed = {}
+        mapping = {}
+        if target:
+            ledger = self.open_ledger()
+            if opts.incremental:
+                pushed = ledger.pushed(target)
+            mapping = ledger.mapping(target)
+            ledger.close()
+        flags = (opts.starred, opts.playcounts, opts.ratings, opts.mb, opts.time, opts.no_annotations, [u[:2] for u in users])
+        skipped = 0
         all_items = []
         for i in items:
+            # (user_id, play_count, rating, starred) for each user, from that user's beets fields
+            values = [(user_id, i.get(f['play_count'], 0), i.get(f['rating'], 0), i.get(f['starred'], 'False'))
+                      for (user_id, _, f) in users]
+            fp = fingerprint(flags, values, *(i.get(k) for k in ('mtime', 'mb_trackid', 'mb_albumid',
+                                                                 'mb_artistid', 'mb_albumartistid', 'albumtype', 'mb_releasetrackid')))
+            if i.id in pushed and pushed[i.id][0] == fp:
+                skipped += 1
+                continue
             all_items.append((
+                i.id,
+                fp,
                 i['path'].decode('utf-8'),
                 i['artist'],
                 i['albumartist'],
@@ -177,23 +650,40 @@ class NavidromeSyncPlugin(BeetsPlugin):
                 i['mb_albumartistid'],
                 i['albumtype'],
                 i['mb_releasetrackid'],
-                i['play_count'] if 'play_count' in i else 0,
-                i['rating'] if 'rating' in i else 0,
-                i['starred'] if 'starred' in i else 'False',
+                values,
                 i['mtime'] if 'mtime' in i else 'NULL'
             ))
             # all_items.extend(items)
         total = len(all_items)
+        if skipped:
+            self._log.info('Skipping {0} items unchanged since the last push', skipped)
         if total == 0:
-            self._log.info('Supplied query returned zero results. Exiting...')
-            return
+            self._log.info('Nothing changed since the last push. Exiting...' if skipped else 'Supplied query returned zero results. Exiting...')
+            return []
         matched = 0
         updated = 0
         missed = 0
         missed_log = []
-        ids = []
+        ids = set()
+        annotate = not opts.no_annotations
+        writer = NavidromeWriter(users[0][0], opts.starred and annotate, opts.playcounts and annotate, opts.ratings and annotate)
+        rules = dict.fromkeys(('mapped',) + RULES + ('fuzzy',), 0)
         local_path = config['directory'].as_str()
+        # ndwatch keeps these between its pushes, until media_file changes
+        cache = self.watch_cache if self.watch_cache is not None else {}
+        # media_file id => (updated_at, album_id), to check saved mappings against
+        if 'files' not in cache:
+            cache['files'] = {r[0]: r[1:] for r in cur.execute('SELECT id, updated_at, album_id FROM media_file')}
+        files = cache['files']
+        ledger_rows = []
+        mapped = []
+        stale = []
+        times = self.scan_times([r[2] for r in all_items], opts) if opts.time else {}
+        progress = Progress(total, matched=0, updated=0, missed=0)
+        started = time.perf_counter()
         for (
+                item_id,
+                fp,
                 path, 
                 artist, 
                 albumartist,
@@ -205,101 +695,345 @@ class NavidromeSyncPlugin(BeetsPlugin):
                 mb_albumartistid, 
                 albumtype, 
                 mb_releasetrackid, 
-                play_count, 
-                rating, 
-                starred, 
+                values,
                 mtime
             ) in all_items:
-            utc = convert_time(mtime)
-            utc_m = utc.replace('Z', '.000000000Z')
-            path = path.replace('\\', '/').replace(local_path, '')
-            cur.execute(''' SELECT id
-                            FROM media_file 
-                            WHERE (mbz_recording_id = ?)
-                            OR (path LIKE ?)
-                            OR (artist = ? AND title = ?);''',
-                        (mb_trackid, artist, title, f'%{path}%'))
-            needle = [artist, albumartist, album, title]
-            id = cur.fetchone() or self.fuzzy_search(needle, cur)
-            id = len(id) > 0 and id[0] or None
+            utc = (times.get(path) or convert_time(mtime)) if opts.time else None
+            full_path = path
+            path = relative_path(path, local_path)
+            saved = mapping.get(item_id)
+            (id, rule) = self.match_media_file(cur, cache, saved, full_path, path, artist, albumartist, title, album, mb_trackid)
+            if saved and rule != 'mapped':
+                stale.append(item_id)
+            self._log.debug('{0} - {1}: {2}', artist, title, rule or 'no match')
             if not id:
                 missed += 1
                 missed_log.append(f'missed:{artist},{title},{path},{mb_trackid}')
             else:
                 matched += 1
+                rules[rule] += 1
+                ledger_rows.append((item_id, fp, id))
+                mapped.append((item_id, id, full_path))
                 if id not in ids:
                     updated += 1
-                    ids.append(id)
-                    cur.execute('SELECT ann_id FROM annotation WHERE item_id = ?', (id,))
-                    rows = cur.fetchall()
-                    if (opts.starred or opts.playcounts or opts.ratings):
-                        mtime = re.sub("T|Z", " ", convert_time(mtime)).strip() if starred and opts.starred else "NULL"
-                        starred = 1 if starred == 'True' and opts.starred else 0
-                        rating = rating if opts.ratings else 0
-                        play_count = play_count if opts.playcounts else 0
-                        if len(rows) == 0:
-                            cur.execute(''' INSERT into annotation (ann_id, user_id, item_id, item_type, play_count, play_date, rating, starred, starred_at)
-                                            VALUES  (lower(hex(randomblob(4))) || '-' || 
-                                                    lower(hex(randomblob(2))) || '-4' || 
-                                                    substr(lower(hex(randomblob(2))),2) || '-' || 
-                                                    substr('89ab',abs(random()) % 4 + 1, 1) || 
-                                                    substr(lower(hex(randomblob(2))),2) || '-' || 
-                                                    lower(hex(randomblob(6))),
-                                                    ?, ?, "media_file", ?, NULL, ?, ?, ?);''',
-                                                (user_id, id, play_count, rating, starred, mtime))
-                        else:
-                            cur.execute(''' UPDATE annotation 
-                                            SET starred = ?, 
-                                                starred_at = ?, 
-                                                play_count = ?,
-                                                rating = ? 
-                                            WHERE item_id = ?
-                                            AND user_id = ?
-                                            AND item_type = "media_file";'''
-                                        , (starred, mtime, play_count, rating, id, user_id))
-                    if opts.mb: 
-                        cur.execute(''' UPDATE media_file
-                                        SET mbz_recording_id = ?,
-                                            mbz_album_id = ?,
-                                            mbz_artist_id = ?,
-                                            mbz_album_artist_id = ?,
-                                            mbz_album_type = ?,
-                                            mbz_release_track_id = ?
-                                        WHERE id = ?''', 
-                                        (mb_trackid, mb_albumid, mb_artistid, mb_albumartistid, albumtype, mb_releasetrackid, id))
+                    ids.add(id)
+                    if not opts.no_annotations:
+                        for (user_id, play_count, rating, starred) in values:
+                            starred_at = re.sub("T|Z", " ", convert_time(mtime)).strip() if starred == 'True' else None
+                            writer.annotate(id, play_count, rating, 1 if starred == 'True' else 0, starred_at, user_id)
+                    if opts.mb and not opts.no_annotations:
+                        writer.set_mbids(id, (mb_trackid, mb_albumid, mb_artistid, mb_albumartistid, albumtype, mb_releasetrackid))
                     if opts.time:
-                        cur.execute('SELECT album_id FROM media_file WHERE id = ?', (id,))
-                        album_id = cur.fetchone()[0]
-                        cur.execute(''' UPDATE media_file 
-                                        SET updated_at = ?, created_at = ?
-                                        WHERE id = ?''',
-                                        (utc, utc_m, id))
-                        cur.execute(''' UPDATE album
-                                        SET updated_at = ?, created_at = ?
-                                        WHERE id = ?''',
-                                        (utc, utc_m, album_id))
-            update_progress(total=total, matched=matched, updated=updated, missed=missed)
-        print('')
+                        writer.set_time(id, files[id][1], utc, utc.replace('Z', '.000000000Z'))
+            progress.set(matched=matched, updated=updated, missed=missed)
+        progress.close()
+        self.metrics.add_time('matching', time.perf_counter() - started)
+        for (k, v) in rules.items():
+            self.metrics.count(f'match.{k}', v)
+        self.metrics.count('missed', missed)
+        self._log.info('Matched by: {0}', ', '.join(f'{k} {v}' for k, v in rules.items()))
+        # entries carry updated_at as it is after this push, --time just changed it (except through the API)
+        times = writer.times if remote is None or remote.name != 'api' else {}
+        mapped = [(i, id, p, times[id][0] if id in times else files[id][0]) for (i, id, p) in mapped]
+        stale = set(stale) - set(r[0] for r in mapped)
+        if opts.plan_path:
+            plan = make_plan(writer, cur, {'target': target})
+            (plan.mapped, plan.forget, plan.record) = (mapped, sorted(stale), ledger_rows)
+            save_plan(opts.plan_path, plan)
+            self.metrics.count('planned_changes', len(plan.changes))
+            self._log.info('Plan of {0} changes ({1}) written to {2}, apply it with ndpush --apply', len(plan.changes),
+                           ', '.join(f'{k} {v}' for k, v in plan.counts().items()) or 'nothing to change', opts.plan_path)
+            return None
+        if remote:
+            from subsonic import SubsonicError
+            started = time.perf_counter()
+            try:
+                (rows, size) = remote.apply(writer, cur)
+            except OSError as e:
+                raise UserError(f'Remote DB update failed, nothing was changed: {e}')
+            except SubsonicError as e:
+                raise UserError(f'Subsonic API update failed part way: {e}')
+            secs = time.perf_counter() - started
+            self.metrics.transfer(remote.name, size, secs)
+        else:
+            (rows, secs) = writer.apply(conn)
+            for (id, (utc, _)) in writer.times.items():
+                files[id] = (utc, files[id][1])
+        self.metrics.add_time('writes', secs)
+        self.metrics.count('rows_written', rows)
+        self._log.info('Wrote {0} rows in {1:.2f}s ({2:.0f} rows/s)', rows, secs, rows / secs if secs else rows)
+        if target:
+            ledger = self.open_ledger()
+            ledger.map(target, mapped)
+            ledger.forget(target, stale)
+            ledger.close()
         if opts.log_path is not None:
             f = open(opts.log_path, "w", encoding='utf-8')
             f.write('\r\n'.join(missed_log))
             f.close()
         self._log.info('Navidrome push complete')
+        return ledger_rows
+
+    def match_media_file(self, cur, cache, saved, full_path, path, artist, albumartist, title, album, mb_trackid):
+        '''
+        resolves a beets item to a media_file id: its saved mapping while that still holds, then the index rules, then fuzzy
+        cache - dict with files (media_file id => (updated_at, album_id)), the indexes are built into it when first needed
+        saved - the item's mapping entry, (nd_id, path, updated_at) or None
+        returns (id, rule), or (None, None) if nothing matched
+        '''
+        files = cache['files']
+        if saved and saved[0] in files and saved[1] == full_path and saved[2] == files[saved[0]][0]:
+            return (saved[0], 'mapped')
+        if cache.get('index') is None:
+            self._log.info('Indexing Navidrome media files...')
+            with self.metrics.phase('index_build'):
+                cache['index'] = MediaFileIndex(cur)
+            self._log.info('Indexed {0} media files', cache['index'].size)
+        (id, rule) = cache['index'].match(path, artist, title, album, mb_trackid)
+        if id:
+            return (id, rule)
+        if not cache.get('fulltext'):
+            with self.metrics.phase('fulltext_index_build'):
+                cache['fulltext'] = FullTextIndex(cur)
+        id = self.fuzzy_search([artist, albumartist, album, title], cur, cache['fulltext'])[0]
+        return (id, 'fuzzy') if id else (None, None)
+
+    def nd_merge(self, conn, cur, lib, items, opts, target):
+        '''
+        ndsync: matches every item to its track once, merges each pair's annotations (see ndmerge)
+        and writes what changed on either side, Navidrome's in one transaction, beets' in
+        transactions of PULL_CHUNK items. dbusers sharing beets fields with an earlier one
+        get that user's merged values, like ndpush gives them
+        '''
+        users = self.user_ids(cur)
+        if not users:
+            return
+        ratings = opts.ratings or self.config['sync']['ratings'].as_choice(MERGE_SIDES)
+        ledger = self.open_ledger()
+        mapping = ledger.mapping(target)
+        cache = {'files': {r[0]: r[1:] for r in cur.execute('SELECT id, updated_at, album_id FROM media_file')}}
+        local_path = config['directory'].as_str()
+        rules = dict.fromkeys(('mapped',) + RULES + ('fuzzy',), 0)
+        pairs = []
+        mapped = []
+        stale = []
+        ids = set()
+        missed = 0
+        started = time.perf_counter()
+        for item in items:
+            full_path = item['path'].decode('utf-8')
+            saved = mapping.get(item.id)
+            (id, rule) = self.match_media_file(cur, cache, saved, full_path, relative_path(full_path, local_path), item['artist'],
+                                               item['albumartist'], item['title'], item['album'], item['mb_trackid'])
+            if saved and rule != 'mapped':
+                stale.append(item.id)
+            if not id:
+                missed += 1
+                self._log.debug('{0} - {1}: no match', item['artist'], item['title'])
+                continue
+            rules[rule] += 1
+            mapped.append((item.id, id, full_path, cache['files'][id][0]))
+            # a track several items match is synced with the first of them, like ndpush does
+            if id not in ids:
+                ids.add(id)
+                pairs.append((item, id))
+        self.metrics.add_time('matching', time.perf_counter() - started)
+        self._log.info('Matched by: {0}', ', '.join(f'{k} {v}' for k, v in rules.items()))
+
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        writer = NavidromeWriter(None)
+        updates = {}
+        merged_for = {}
+        synced = []
+        for (user_id, name, fields) in users:
+            key = tuple(fields[k] for k in ('play_count', 'rating', 'starred'))
+            current = {r[0]: Annotation(number(r[1]), number(r[2]), bool(r[3]), r[4]) for r in cur.execute(
+                '''SELECT item_id, play_count, rating, starred, starred_at FROM annotation
+                   WHERE item_type = 'media_file' AND user_id = ?''', (user_id,))}
+            leader = merged_for.get(key)
+            merged = {}
+            base = ledger.synced(target, user_id) if leader is None else {}
+            for (item, id) in pairs:
+                nd = current.get(id, NO_ANNOTATION)
+                if leader is not None:
+                    value = leader[item.id]
+                else:
+                    beets = Annotation(number(item.get(fields['play_count'])), number(item.get(fields['rating'])),
+                                       str(item.get(fields['starred'])) == 'True', None)
+                    value = merged[item.id] = merge(beets, nd, base.get(item.id), ratings, now)
+                    changes = {}
+                    if value.play_count != beets.play_count:
+                        changes[fields['play_count']] = value.play_count
+                    if value.rating != beets.rating:
+                        changes[fields['rating']] = value.rating
+                    if value.starred != beets.starred:
+                        changes[fields['starred']] = str(value.starred)
+                    if item.get('nd_item_id') != id:
+                        changes['nd_item_id'] = id
+                    if changes:
+                        updates.setdefault(item.id, (item, {}))[1].update(changes)
+                if value[:3] != nd[:3]:
+                    writer.annotate(id, value.play_count, value.rating, int(value.starred), value.starred_at, user_id)
+            if leader is None:
+                merged_for[key] = merged
+                synced.append((user_id, merged))
+
+        (rows, secs) = writer.apply(conn)
+        self.metrics.add_time('writes', secs)
+        self.metrics.count('rows_written', rows)
+        started = time.perf_counter()
+        updates = list(updates.values())
+        self.pulling = True
+        try:
+            for start in range(0, len(updates), PULL_CHUNK):
+                with lib.transaction():
+                    for (item, changes) in updates[start:start + PULL_CHUNK]:
+                        item.update(changes)
+                        item.store()
+        finally:
+            self.pulling = False
+        self.metrics.add_time('writes', time.perf_counter() - started)
+        self.metrics.count('items_changed', len(updates))
+        # the new baseline for stars, only once both sides hold it: recorded before a failed write,
+        # the next sync would take the side that missed the write for the one that changed
+        for (user_id, merged) in synced:
+            ledger.set_synced(target, user_id, ((i, v.starred) for (i, v) in merged.items()))
+        for (k, v) in rules.items():
+            self.metrics.count(f'match.{k}', v)
+        self.metrics.count('missed', missed)
+        ledger.map(target, mapped)
+        ledger.forget(target, set(stale) - set(r[0] for r in mapped))
+        ledger.close()
+        self._log.info('Synced {0} tracks: {1} Navidrome annotations and {2} beets items changed, {3} items unmatched',
+                       len(pairs), len(writer.annotations), len(updates), missed)
+
+    def nd_apply(self, conn, path, target):
+        '''
+        writes a --plan file made against the same target
+        returns the plan's ledger rows for nd_sync to record
+        '''
+        try:
+            plan = load_plan(path)
+        except (OSError, PlanError) as e:
+            raise UserError(f'Unable to read plan: {e}')
+        if plan.header.get('target') != target:
+            raise UserError(f"{path} was planned against {plan.header.get('target')}, not {target}")
+        try:
+            (rows, secs) = apply_plan(conn, plan)
+        except PlanConflict as e:
+            first = e.conflicts[0]
+            raise UserError(f'{len(e.conflicts)} of the rows in {path} changed since it was planned (first: {first["op"]} {first["key"]}), '
+                            'nothing was applied, plan again')
+        self.metrics.add_time('writes', secs)
+        self.metrics.count('rows_written', rows)
+        self._log.info('Applied {0} changes ({1} rows) planned {2} in {3:.3f}s', len(plan.changes), rows, plan.header.get('created'), secs)
+        if target:
+            ledger = self.open_ledger()
+            ledger.map(target, plan.mapped)
+            ledger.forget(target, plan.forget)
+            ledger.close()
+        return plan.record
+
+    def nd_watch(self, lib, opts, args):
+        '''
+        syncs until interrupted (see ndwatch): queued beets changes are pushed in debounced
+        batches, the first dbuser's annotation changes are pulled as they show up, and the
+        DB connection and match data are kept between batches
+        '''
+        if self.config['pushtarget'].as_str() != 'local':
+            raise UserError('ndwatch keeps the Navidrome DB open, it needs pushtarget: local')
+        self.start_metrics()
+        (conn, cur) = self.get_local_db() or (None, None)
+        if not conn:
+            return
+        users = self.user_ids(cur)
+        if not users:
+            return
+        (user_id, name, fields) = users[0]
+        watch = self.config['watch']
+        pending = Debouncer(watch['debounce'].get(float), watch['max_wait'].get(float), watch['batch'].get(int))
+        target = self.ledger_key('get_local_db')
+        push = next(c for c in self.commands() if c.name == 'ndpush')
+        (push_opts, _) = push.parser.parse_args([])
+        ledger = self.open_ledger()
+        mark = ledger.watermark(target, user_id)
+        poller = AnnotationPoller(conn, user_id, mark)
+        if opts.pull and mark is None:
+            self._log.info('First ndwatch run for {0}, pulling changes from now on (ndpull gets earlier ones)', target)
+        if opts.push and not watch['record'].get(bool):
+            self._log.warning('watch: record is off, so changes other beets commands make are not pushed (set watch: record: yes)')
+        self.watching = True
+        self.watch_cache = {}
+        pull_cache = {}
+        self._log.info('Watching for changes, Ctrl+C to stop')
+        try:
+            while True:
+                if opts.push:
+                    pending.add(self.watch_changes)
+                    self.watch_changes.clear()
+                    pending.add(ledger.take_queue())
+                (rows, files_changed) = poller.poll()
+                if files_changed:
+                    self.watch_cache.clear() # Navidrome rescanned, media_file ids and updated_at may have moved
+                if rows and opts.pull:
+                    self._log.info('Pulling {0} changed annotations of {1}', len(rows), name)
+                    tracks = [Track._make(r) for r in rows]
+                    chunks = (tracks[i:i + pending.size] for i in range(0, len(tracks), pending.size))
+                    self.process_navidrome_annotations(lib, chunks, self._log, target, len(tracks), fields, pull_cache)
+                    ledger.set_watermark(target, user_id, poller.mark())
+                while opts.push and pending.due():
+                    self.watch_push(conn, cur, lib, pending.take(), push_opts, target, fields, pull_cache, ledger)
+                    poller.skip_own_writes()
+                    ledger.set_watermark(target, user_id, poller.mark())
+                time.sleep(watch['interval'].get(float))
+        except KeyboardInterrupt:
+            if len(pending):
+                self._log.info('Pushing {0} pending changes before exiting', len(pending))
+                self.watch_push(conn, cur, lib, pending.take(everything=True), push_opts, target, fields, pull_cache, ledger)
+        finally:
+            self.watching = False
+            self.watch_cache = None
+            ledger.close()
+            conn.close()
+
+    def watch_push(self, conn, cur, lib, ids, opts, target, fields, pull_cache, ledger):
+        '''pushes a batch of changed items for ndwatch and refreshes what pull knows of them'''
+        if 'items' in pull_cache:
+            rows = {r.id: r for r in read_items(os.fsdecode(lib.path), fields, ids=ids, directory=lib.directory)}
+            for i in ids:
+                if i in rows:
+                    pull_cache['items'][i] = rows[i]
+                else:
+                    pull_cache['items'].pop(i, None)
+            pull_cache.pop('index', None) # artist/title may have changed, rebuilt when next needed
+        items = [i for i in map(lib.get_item, ids) if i is not None]
+        if not items:
+            return
+        self._log.info('Pushing {0} changed items', len(items))
+        pushed = self.nd_push_annotations(conn, cur, items, opts, target)
+        if pushed:
+            ledger.record(target, pushed)
 
     def sftp_connect(self):
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        host = self.config['sftp']['host'].get()
-        user = self.config['sftp']['username'].get()
-        passw = self.config['sftp']['password'].get()
-        port = self.config['sftp']['port'].get()
-        return pysftp.Connection(host, username=user, password=passw, port=port, cnopts=cnopts)
+        '''borrows a pooled SFTP session, use as a context manager'''
+        self.sftp_setup()
+        return self.pool.session()
     
-    def db_connect(self, db_file):
+    def db_connect(self, db_file, readonly=False):
+        '''
+        readonly - for --plan: opened read-only and, in WAL mode, inside one read
+        transaction, so all of the matching sees the same snapshot without holding
+        up Navidrome's writes (other journal modes would block them while it's open)
+        '''
         conn = None
         cur = None
         try:
-            conn = sqlite3.connect(db_file)
+            if readonly:
+                conn = sqlite3.connect(pathlib.Path(db_file).resolve().as_uri() + '?mode=ro', uri=True)
+                if conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+                    conn.execute('BEGIN')
+            else:
+                conn = sqlite3.connect(db_file)
             cur = conn.cursor()
         except (RuntimeError, TypeError, NameError) as e:
             print(e)
@@ -317,163 +1051,226 @@ class NavidromeSyncPlugin(BeetsPlugin):
         return dest.decode("utf-8")
     
     def upload(self, lib, opts, args):
-        self.uploader.upload(lib, opts, args)
+        self.start_metrics()
+        self.sftp_setup().upload(lib, opts, args)
+        self.print_stats(opts)
+        self.pool.close()
         self._log.info('Upload complete')
     
-    # def nd_api(self, lib, opts, args):
-    #     conn = self.subsonic_api_connect()
-    #     return
-
-    # Unused at the moment
-    # def subsonic_api_connect(self):
-    #     host = self.config['navidrome']['host'].get()
-    #     user = self.config['navidrome']['username'].get()
-    #     passw = self.config['navidrome']['password'].get()
-    #     port = self.config['navidrome']['port'].get()
-    #     if host and user and passw and port:
-    #         return libsonic.Connection(host , user, passw, port=port)
-    #     else:
-    #         return False
-
-    def nd_pull(self, lib, conn, cur):
-        tracks = []
-        rows = dict()
-        for row in cur.execute('SELECT item_id, item_type, play_count, rating, starred FROM annotation;'):
-            rows[row[0]] = row
-        for (item_id, artist, albumArtist, album, title, mb_trackid) in cur.execute('SELECT id, artist, album_artist, album, title, mbz_recording_id FROM media_file;'):
-            playCount = 0
-            rating = 0
-            starred = 0
-            if item_id in rows:
-                (item_id, item_type, playCount, rating, starred) = rows[item_id]
-            tracks.append({
-                "nd_item_id": item_id,
-                "artist": artist,
-                "albumArtist": albumArtist,
-                "album": album,
-                "title": title,
-                "mb_trackid": mb_trackid,
-                "starred": starred,
-                "rating": rating,
-                "playCount": playCount
-            })
-        self.process_navidrome_annotations(lib, tracks, self._log)
+    def subsonic_api_connect(self):
+        from subsonic import SubsonicClient, SubsonicError
+        host = self.config['navidrome']['host'].as_str()
+        user = self.config['navidrome']['username'].as_str()
+        passw = self.config['navidrome']['password'].as_str()
+        port = self.config['navidrome']['port'].get(int)
+        if not (host and user and passw and port):
+            raise UserError('Configure navidrome host, username and password to use the Subsonic API')
+        client = SubsonicClient(host, user, passw, port, self.config['navidrome']['workers'].get(int),
+                                self.config['navidrome']['rate'].get(float))
+        try:
+            client.ping()
+        except (SubsonicError, OSError) as e:
+            client.close()
+            raise UserError(f'Unable to reach the Subsonic API at {host}: {e}')
+        return client
+
+    def nd_pull(self, lib, conn, cur, target=None, remote=None):
+        '''pulls the first configured dbuser's annotations, media_file is streamed through in chunks rather than loaded'''
+        users = self.user_ids(cur, remote)
+        if not users:
+            return
+        (user_id, name, fields) = users[0]
+        if len(users) > 1:
+            self._log.info('Pulling the annotations of {0}, the first dbuser', name)
+        total = cur.execute('SELECT count(*) FROM media_file').fetchone()[0]
+        self.process_navidrome_annotations(lib, self.nd_tracks(conn, user_id), self._log, target, total, fields)
+
+    def nd_tracks(self, conn, user_id, size=PULL_CHUNK):
+        '''yields lists of Track, every media_file row with the user's annotation or zeros where there is none'''
+        cur = conn.cursor()
+        cur.execute('''SELECT m.id, m.artist, m.album_artist, m.album, m.title, m.mbz_recording_id, m.updated_at,
+                              coalesce(a.play_count, 0), coalesce(a.rating, 0), coalesce(a.starred, 0)
+                       FROM media_file m LEFT JOIN annotation a
+                       ON a.item_id = m.id AND a.user_id = ? AND a.item_type = 'media_file' ''', (user_id,))
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            yield [Track._make(r) for r in rows]
 
     # Shamelessly lifted process_tracks func from lastimport.py, with some modification
-    def process_navidrome_annotations(self, lib, tracks, log):
-        input('Press Enter to continue...')
-        total = len(tracks)
+    def process_navidrome_annotations(self, lib, chunks, log, target=None, total=None, fields=USER_FIELDS, cache=None):
+        '''
+        chunks - iterable of lists of Track, each list is matched and then written in one transaction
+        target - ledger key of the Navidrome DB, tracks with a still valid saved mapping skip matching
+        fields - beets field each of play_count/rating/starred is pulled into
+        cache - dict ndwatch keeps the ItemRows and ItemIndex in between pulls, no confirmation asked
+        Beets items are indexed as ItemRows, an Item is only loaded for a track that changes it.
+        '''
+        if cache is None:
+            input('Press Enter to continue...')
+            cache = {}
         total_found = 0
         total_fails = 0
-        log.info('Processing {0} tracks...', total)
-
-        for num in range(0, total):
-            song = None
-            trackid = None
-            item_id = tracks[num]['nd_item_id'].strip()
-            artist = tracks[num]['artist'].strip()
-            title = tracks[num]['title'].strip()
-            album = ''
-            if 'album' in tracks[num]:
-                album = tracks[num]['album'].strip()
-
-            log.debug('query: {0} - {1} ({2})', artist, title, album)
-
-            # Try with previously saved Navidrome item id
-            if item_id:
-                try:
-                    song = lib.items(
-                        dbcore.query.MatchQuery('nd_item_id', item_id)
-                    ).get()
-                except:
-                    log.debug('no item_id match')
-
-            # Then try to query by musicbrainz's trackid
-            if song is None and trackid:
-                song = lib.items(
-                    dbcore.query.MatchQuery('mb_trackid', trackid)
-                ).get()
-
-            # If not, try just artist/title
-            if song is None:
-                log.debug('no album match, trying by artist/title')
-                query = dbcore.AndQuery([
-                    dbcore.query.SubstringQuery('artist', artist),
-                    dbcore.query.SubstringQuery('title', title)
-                ])
-                song = lib.items(query).get()
-
-            # Last resort, try just replacing to utf-8 quote
-            if song is None:
-                title = title.replace("'", '\u2019')
-                log.debug('no title match, trying utf-8 single quote')
-                query = dbcore.AndQuery([
-                    dbcore.query.SubstringQuery('artist', artist),
-                    dbcore.query.SubstringQuery('title', title)
-                ])
-                song = lib.items(query).get()
-
-            if song is not None:
-                count = int(song.get('play_count', 0))
-                new_count = 0
-                if 'playCount' in tracks[num]:
-                    new_count = int(tracks[num]['playCount'])
-                log.debug('match: {0} - {1} ({2}) '
-                        'updating: play_count {3} => {4}',
-                        song.artist, song.title, song.album, count, new_count)
-                if new_count > count:
-                    log.info("{} - {} => {}", tracks[num]['title'], count, new_count)
-                    song['play_count'] = new_count
-                song['starred'] = "True" if tracks[num]['starred'] else "False"
-                song['rating'] = tracks[num]['rating']
-                song['nd_item_id'] = tracks[num]['nd_item_id']
-                song.store()
-                total_found += 1
-            else:
-                total_fails += 1
-                log.info('  - No match: {0} - {1} ({2})',
-                        artist, title, album)
+        total_changed = 0
+        ledger = self.open_ledger() if target else None
+        if 'items' not in cache:
+            with self.metrics.phase('index_build'):
+                cache['items'] = {row.id: row for row in read_items(os.fsdecode(lib.path), fields, lib.get_default_item_sort().order_clause(), directory=lib.directory)}
+        items = cache['items']
+        index = cache.get('index')
+        log.info('Processing {0} tracks against {1} items...', total, len(items))
+        progress = Progress(total, matched=0, updated=0, missed=0)
+        rules = {}
+        (play_count_field, rating_field, starred_field) = (fields[k] for k in ('play_count', 'rating', 'starred'))
+
+        for tracks in chunks:
+            updates = []
+            mapped = []
+            stale = []
+            with self.metrics.phase('matching'):
+                saved = ledger.lookup(target, (t.nd_item_id for t in tracks)) if ledger else {}
+                for track in tracks:
+                    item_id = (track.nd_item_id or '').strip()
+                    artist = (track.artist or '').strip()
+                    title = (track.title or '').strip()
+                    album = (track.album or '').strip()
+
+                    log.debug('query: {0} - {1} ({2})', artist, title, album)
+
+                    (song, rule) = (None, None)
+                    entry = saved.get(track.nd_item_id)
+                    if entry:
+                        song = items.get(entry[0])
+                        if song is not None and song.path == entry[1] and track.updated_at == entry[2]:
+                            rule = 'mapped'
+                        else:
+                            (song, rule) = (None, None)
+                            stale.append((entry[0], track.nd_item_id))
+
+                    # saved Navidrome item id, then musicbrainz's trackid, then artist/title
+                    if song is None:
+                        if index is None:
+                            with self.metrics.phase('index_build'):
+                                index = cache['index'] = ItemIndex(items.values())
+                        (song, rule) = index.match(item_id, artist, title, track.mb_trackid)
 
-        if total_fails > 0:
-            log.info('Synced {0}/{1} from Navidrome ({2} unknown)',
-                    total_found, total, total_fails)
+                    # Last resort, substring artist/title queries, trying the utf-8 quote too
+                    if song is None:
+                        log.debug('no indexed match, trying substring artist/title')
+                        for t in (title, title.replace("'", '\u2019')):
+                            query = dbcore.AndQuery([
+                                dbcore.query.SubstringQuery('artist', artist),
+                                dbcore.query.SubstringQuery('title', t)
+                            ])
+                            found = lib.items(query).get()
+                            if found is not None:
+                                song = items.get(found.id)
+                                break
+
+                    if song is not None:
+                        song = items[song.id] # the index has the row as read, an earlier track may have changed it
+                        count = int(song.play_count or 0)
+                        new_count = int(track.play_count or 0)
+                        log.debug('match ({5}): {0} - {1} ({2}) '
+                                'updating: play_count {3} => {4}',
+                                song.artist, song.title, album, count, new_count, rule or 'substring')
+                        changes = {
+                            starred_field: "True" if track.starred else "False",
+                            rating_field: track.rating,
+                            'nd_item_id': track.nd_item_id,
+                        }
+                        current = {starred_field: song.starred, rating_field: song.rating, 'nd_item_id': song.nd_item_id}
+                        if new_count > count:
+                            log.info("{} - {} => {}", track.title, count, new_count)
+                            changes[play_count_field] = new_count
+                            current[play_count_field] = song.play_count
+                        if any(str(current[k]) != str(v) for (k, v) in changes.items()):
+                            updates.append((song.id, changes))
+                            items[song.id] = song._replace(starred=changes[starred_field], rating=track.rating, nd_item_id=track.nd_item_id,
+                                                           play_count=changes.get(play_count_field, song.play_count))
+                        total_found += 1
+                        rules[rule or 'substring'] = rules.get(rule or 'substring', 0) + 1
+                        mapped.append((song.id, track.nd_item_id, song.path, track.updated_at))
+                    else:
+                        total_fails += 1
+                        log.info('  - No match: {0} - {1} ({2})',
+                                artist, title, album)
+                    progress.set(matched=total_found, updated=total_changed, missed=total_fails)
+
+            started = time.perf_counter()
+            self.pulling = True
+            try:
+                with lib.transaction():
+                    for (id, changes) in updates:
+                        song = lib.get_item(id)
+                        if song is None: continue
+                        changes = {k: v for (k, v) in changes.items() if str(song.get(k)) != str(v)}
+                        if changes:
+                            song.update(changes)
+                            song.store()
+                            total_changed += 1
+            finally:
+                self.pulling = False
+            self.metrics.add_time('writes', time.perf_counter() - started)
+            if ledger:
+                ledger.unmap(target, stale)
+                ledger.map(target, mapped)
+            progress.set(matched=total_found, updated=total_changed, missed=total_fails)
+        progress.close()
+        if ledger:
+            ledger.close()
+        for (k, v) in rules.items():
+            self.metrics.count(f'match.{k}', v)
+        self.metrics.count('missed', total_fails)
+        self.metrics.count('items_changed', total_changed)
+
+        log.info('Synced {0}/{1} from Navidrome ({2} changed, {3} unknown)',
+                total_found, total, total_changed, total_fails)
 
         return total_found, total_fails
-    
+
 
     def update_remote_db(self, *rest):
+        from dbtransfer import CachedRemoteDb, RemoteChanged, exec_sha1
+        self.sftp_setup()
         local_path = self.config['temp_path'].as_str()
-        self.uploader.upload_file(local_path, self.config['sftp']['dbpath'].as_str())
+        remote_path = self.config['sftp']['dbpath'].as_str()
+        cached = CachedRemoteDb(local_path) if self.config['sftp']['delta'].get(bool) else None
+        sent = None
+        started = time.perf_counter()
+        if cached:
+            try:
+                with self.sftp_connect() as sftp:
+                    sent = cached.push(sftp, remote_path, exec_sha1(partial(self.pool.execute, sftp=sftp)))
+            except RemoteChanged as e:
+                raise UserError(f'{e}, Navidrome wrote to it during the push. Nothing was uploaded, run the push again')
+        if sent is None:
+            sent = self.uploader.upload_file(local_path, remote_path)[1]
+            if cached:
+                with self.sftp_connect() as sftp:
+                    cached.record(sftp, remote_path)
+        else:
+            self._log.info('Sent {0} changed bytes of {1}', sent, os.path.getsize(local_path))
+        self.metrics.transfer('db_upload', sent, time.perf_counter() - started)
         self._log.info('Remote DB updated, complete a full refresh in Navidrome for changes to take effect')
         return
 
-    def fuzzy_search(self, needle, cur):
+    def fuzzy_search(self, needle, cur, index=None):
         '''
         compares each string segment of the needle to the 'full_text' db field
         if all segments are found: returns tuple of (id, updated_at, mbz_recording_id)
         returns (None, None, None) if not
+        pass a FullTextIndex to reuse it across calls, otherwise one is built from cur
         '''
-        haystack_re = re.compile('[^a-zA-Z0-9A-zÀ-ÖØ-öø-įĴ-őŔ-žǍ-ǰǴ-ǵǸ-țȞ-ȟȤ-ȳɃɆ-ɏḀ-ẞƀ-ƓƗ-ƚƝ-ơƤ-ƥƫ-ưƲ-ƶẠ-ỿ\s]', re.MULTILINE) # should catch all all diacritics?? i dunno
-        haystack = []
-        for (t, i, u, m) in cur.execute('SELECT full_text, id, updated_at, mbz_recording_id FROM media_file;'):
-            haystack.append((t, i, u, m)) 
+        index = index or FullTextIndex(cur)
         if needle[0] == needle[1]: # artist & album artist are passed as first two items of list
-            needle.pop()
-        needle = re.sub(haystack_re, '', ' '.join(needle).lower().replace('the', ''))
-        l = needle.split()
-        for (string, *rest) in haystack:
-            if all(s in string for s in l):
-                return(rest)                
-        return (None, None, None)
+            needle = needle[:1] + needle[2:]
+        tokens = [t for t in fulltext_tokens(' '.join(needle)) if t != 'the']
+        found = index.search(tokens)
+        if len(found) > 1:
+            self._log.debug('fuzzy: {0} candidates for {1}', len(found), ' '.join(tokens))
+        return found[0] if found else (None, None, None)
 
 def convert_iso_time(t): return datetime.datetime.fromisoformat(t).astimezone(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
 def convert_time(t): return datetime.datetime.fromtimestamp(int(t), tz=datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
-
-def update_progress(**kwargs): # =total, matched, updated, missed):
-    # total, matched, updated, missed = [kwargs.get(k) for k in (list(kwargs))]
-    total, matched, updated, missed = [kwargs.get(k) for k in ('total', 'matched', 'updated', 'missed')]
-    pad_int = lambda s: str(s).rjust(len(str(total)))
-    per = ((matched + (missed or 0)) / total) * 100
-    updated_str = f'{pad_int(updated)} updated, ' if updated is not None else ''
-    sys.stdout.write(f'  --- {pad_int(matched)} of {pad_int(total)} matched ({updated_str}{pad_int(missed)} missed) - {str(int(per)).rjust(3)}% complete ---\r')
-    sys.stdout.flush()
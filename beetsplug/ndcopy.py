@@ -0,0 +1,114 @@
+'''
+In-memory working copy of the Navidrome DB for pushes (in_memory: yes).
+
+The DB is copied into :memory: with the online backup API a few hundred
+pages per step, so Navidrome is only held up for one step at a time, and the
+push matches and writes against the copy without any disk I/O or journaling.
+Temp triggers record every row and column the push changes. Those are read
+back out of the copy and written to the DB in one transaction: existing rows
+by their natural key and only in the columns the push changed, so whatever
+Navidrome changed meanwhile in other rows or columns stays as it is.
+'''
+import sqlite3, time
+from ndwrite import has_upsert_key
+
+# natural key of each table a push writes to
+KEYS = {'annotation': ('user_id', 'item_id', 'item_type'), 'media_file': ('id',), 'album': ('id',)}
+INSERTED = '*'
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class WorkingCopy:
+    def __init__(self, path, pages=256):
+        self.path = path
+        self.conn = sqlite3.connect(':memory:')
+        start = time.perf_counter()
+        source = sqlite3.connect(path)
+        try:
+            source.backup(self.conn, pages=pages)
+        finally:
+            source.close()
+        self.copy_seconds = time.perf_counter() - start
+        self.columns = {t: [r[1] for r in self.conn.execute(f'PRAGMA table_info({t})')] for t in KEYS}
+        self.track()
+
+    def track(self):
+        '''temp triggers logging (table, rowid, column) for every insert and changed column'''
+        self.conn.execute('CREATE TEMP TABLE nd_changed (tbl TEXT, row INTEGER, col TEXT, PRIMARY KEY (tbl, row, col)) WITHOUT ROWID')
+        for (table, columns) in self.columns.items():
+            if not columns: continue
+            self.conn.execute(f'''CREATE TEMP TRIGGER nd_{table}_insert AFTER INSERT ON main.{table} BEGIN
+                                      INSERT OR IGNORE INTO nd_changed VALUES ('{table}', new.rowid, '{INSERTED}');
+                                  END''')
+            self.conn.execute(f'''CREATE TEMP TRIGGER nd_{table}_update AFTER UPDATE ON main.{table} BEGIN
+                                      {" ".join(f"INSERT OR IGNORE INTO nd_changed SELECT '{table}', new.rowid, '{c}' WHERE new.{quote(c)} IS NOT old.{quote(c)};"
+                                                for c in columns if c not in KEYS[table])}
+                                  END''')
+
+    def changes(self):
+        '''returns list of (table, columns, rows, inserted), rows being key values followed by column values'''
+        changed = {}
+        for (table, row, col) in self.conn.execute('SELECT tbl, row, col FROM nd_changed'):
+            changed.setdefault((table, row), set()).add(col)
+        groups = {}
+        for ((table, row), cols) in changed.items():
+            inserted = INSERTED in cols
+            cols = tuple(c for c in self.columns[table] if c not in KEYS[table] and (inserted or c in cols))
+            groups.setdefault((table, cols, inserted), []).append(row)
+        out = []
+        for ((table, cols, inserted), rowids) in groups.items():
+            select = ', '.join(map(quote, KEYS[table] + cols))
+            rows = []
+            for start in range(0, len(rowids), 500):
+                batch = rowids[start:start + 500]
+                rows.extend(self.conn.execute(f'SELECT {select} FROM {table} WHERE rowid IN ({",".join("?" * len(batch))})', batch))
+            out.append((table, cols, rows, inserted))
+        return out
+
+    def write_back(self, timeout=30):
+        '''
+        writes the changes to the DB in one transaction
+        returns (rows written, seconds the DB was locked for)
+        '''
+        changes = self.changes()
+        if not changes:
+            return (0, 0)
+        target = sqlite3.connect(self.path, timeout=timeout)
+        try:
+            cur = target.cursor()
+            upsert = has_upsert_key(cur)
+            start = time.perf_counter()
+            cur.execute('BEGIN IMMEDIATE')
+            rows = 0
+            for (table, cols, values, inserted) in changes:
+                keys = KEYS[table]
+                where = ' AND '.join(f'{quote(k)} = ?' for k in keys)
+                # a row added here that turns out to exist by now keeps the DB's ann_id
+                set_cols = [n for (n, c) in enumerate(cols) if not (inserted and c == 'ann_id')]
+                update = f'UPDATE {table} SET {", ".join(f"{quote(cols[n])} = ?" for n in set_cols)} WHERE {where}'
+                update_values = [tuple(v[len(keys) + n] for n in set_cols) + v[:len(keys)] for v in values]
+                if not inserted:
+                    cur.executemany(update, update_values)
+                else:
+                    insert = f'INSERT INTO {table} ({", ".join(map(quote, keys + cols))}) VALUES ({", ".join("?" * (len(keys) + len(cols)))})'
+                    if table == 'annotation' and upsert:
+                        cur.executemany(insert + f''' ON CONFLICT (user_id, item_id, item_type)
+                                                      DO UPDATE SET {", ".join(f"{quote(c)} = excluded.{quote(c)}" for c in cols if c != 'ann_id')}''', values)
+                    else:
+                        for (u, v) in zip(update_values, values):
+                            if cur.execute(update, u).rowcount == 0:
+                                cur.execute(insert, v)
+                rows += len(values)
+            target.commit()
+            return (rows, time.perf_counter() - start)
+        except BaseException:
+            target.rollback()
+            raise
+        finally:
+            target.close()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,147 @@
+'''
+Sidecar SQLite ledger of what was last pushed to each Navidrome DB.
+
+Each beets item gets a fingerprint of the fields it pushed along with the
+media_file id it mapped to, so incremental pushes can drop unchanged items
+before touching Navidrome at all.
+
+The mapping table remembers which media_file each beets item matched, for
+push and pull alike, with the item path and the track's updated_at as of
+then. While both are unchanged the entry is trusted and the item isn't
+matched again; anything else (moved file, rescanned track) re-matches.
+
+For ndwatch, watch_queue collects the ids of items other beets runs changed
+and watermarks remembers how far into each user's annotations it has read.
+For ndsync, synced keeps each item's starred state as of the last sync, per
+Navidrome user, to tell which side changed a star since.
+'''
+import sqlite3, hashlib, time
+
+
+def fingerprint(*values):
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SyncLedger:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS pushed (
+                                target TEXT NOT NULL,
+                                item_id INTEGER NOT NULL,
+                                fingerprint TEXT NOT NULL,
+                                nd_id TEXT,
+                                PRIMARY KEY (target, item_id))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS mapping (
+                                target TEXT NOT NULL,
+                                item_id INTEGER NOT NULL,
+                                nd_id TEXT NOT NULL,
+                                path TEXT,
+                                updated_at TEXT,
+                                PRIMARY KEY (target, item_id))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS mapping_nd_id ON mapping (target, nd_id)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS watch_queue (item_id INTEGER PRIMARY KEY, queued_at REAL)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS watermarks (
+                                target TEXT NOT NULL,
+                                user_id TEXT NOT NULL,
+                                max_rowid INTEGER,
+                                changed_at TEXT,
+                                changed_item TEXT,
+                                PRIMARY KEY (target, user_id))''')
+        if 'changed_item' not in {r[1] for r in self.conn.execute('PRAGMA table_info(watermarks)')}:
+            self.conn.execute('ALTER TABLE watermarks ADD COLUMN changed_item TEXT')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS synced (
+                                target TEXT NOT NULL,
+                                user_id TEXT NOT NULL,
+                                item_id INTEGER NOT NULL,
+                                starred INTEGER,
+                                PRIMARY KEY (target, user_id, item_id))''')
+        self.conn.commit()
+
+    def pushed(self, target):
+        '''returns dict of beets item id => (fingerprint, nd_id) for a target'''
+        cur = self.conn.execute('SELECT item_id, fingerprint, nd_id FROM pushed WHERE target = ?', (target,))
+        return {i: (f, n) for (i, f, n) in cur}
+
+    def record(self, target, rows):
+        '''rows - iterable of (item_id, fingerprint, nd_id)'''
+        with self.conn:
+            self.conn.executemany('''INSERT INTO pushed (target, item_id, fingerprint, nd_id) VALUES (?, ?, ?, ?)
+                                     ON CONFLICT (target, item_id) DO UPDATE
+                                     SET fingerprint = excluded.fingerprint, nd_id = excluded.nd_id''',
+                                  ((target,) + tuple(r) for r in rows))
+
+    def mapping(self, target):
+        '''returns dict of beets item id => (nd_id, path, updated_at) for a target'''
+        cur = self.conn.execute('SELECT item_id, nd_id, path, updated_at FROM mapping WHERE target = ?', (target,))
+        return {i: (n, p, u) for (i, n, p, u) in cur}
+
+    def lookup(self, target, nd_ids):
+        '''returns dict of nd_id => (item_id, path, updated_at) for some media_file ids, for pulling a chunk at a time'''
+        found = {}
+        nd_ids = list(nd_ids)
+        for start in range(0, len(nd_ids), 500):
+            batch = nd_ids[start:start + 500]
+            cur = self.conn.execute(f'''SELECT nd_id, item_id, path, updated_at FROM mapping
+                                        WHERE target = ? AND nd_id IN ({','.join('?' * len(batch))})''', [target] + batch)
+            for (n, i, p, u) in cur:
+                found.setdefault(n, (i, p, u))
+        return found
+
+    def map(self, target, rows):
+        '''rows - iterable of (item_id, nd_id, item path, media_file updated_at)'''
+        with self.conn:
+            self.conn.executemany('''INSERT INTO mapping (target, item_id, nd_id, path, updated_at) VALUES (?, ?, ?, ?, ?)
+                                     ON CONFLICT (target, item_id) DO UPDATE
+                                     SET nd_id = excluded.nd_id, path = excluded.path, updated_at = excluded.updated_at''',
+                                  ((target,) + tuple(r) for r in rows))
+
+    def forget(self, target, item_ids=None):
+        '''drops mapping entries for item_ids, or the target's whole mapping'''
+        with self.conn:
+            if item_ids is None:
+                self.conn.execute('DELETE FROM mapping WHERE target = ?', (target,))
+            else:
+                self.conn.executemany('DELETE FROM mapping WHERE target = ? AND item_id = ?', ((target, i) for i in item_ids))
+
+    def unmap(self, target, pairs):
+        '''pairs - (item_id, nd_id), each dropped only while the item is still mapped to that nd_id'''
+        with self.conn:
+            self.conn.executemany('DELETE FROM mapping WHERE target = ? AND item_id = ? AND nd_id = ?',
+                                  ((target,) + tuple(p) for p in pairs))
+
+    def queue(self, item_ids):
+        '''adds changed beets items for ndwatch to push'''
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO watch_queue VALUES (?, ?)', ((i, time.time()) for i in item_ids))
+
+    def take_queue(self):
+        '''returns and removes the queued item ids'''
+        with self.conn:
+            rows = self.conn.execute('SELECT item_id, queued_at FROM watch_queue').fetchall()
+            # an item queued again meanwhile has a new queued_at and stays
+            self.conn.executemany('DELETE FROM watch_queue WHERE item_id = ? AND queued_at = ?', rows)
+        return [r[0] for r in rows]
+
+    def watermark(self, target, user_id):
+        '''returns (max_rowid, changed_at, changed_item) ndwatch had read the user's annotations up to, or None'''
+        return self.conn.execute('SELECT max_rowid, changed_at, changed_item FROM watermarks WHERE target = ? AND user_id = ?',
+                                 (target, user_id)).fetchone()
+
+    def set_watermark(self, target, user_id, mark):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO watermarks (target, user_id, max_rowid, changed_at, changed_item) VALUES (?, ?, ?, ?, ?)',
+                              (target, user_id) + tuple(mark))
+
+    def synced(self, target, user_id):
+        '''returns dict of beets item id => starred as of the last ndsync'''
+        cur = self.conn.execute('SELECT item_id, starred FROM synced WHERE target = ? AND user_id = ?', (target, user_id))
+        return {i: bool(s) for (i, s) in cur}
+
+    def set_synced(self, target, user_id, rows):
+        '''rows - iterable of (item_id, starred)'''
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?)',
+                                  ((target, user_id, i, int(s)) for (i, s) in rows))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,255 @@
+'''
+In-memory match index over Navidrome's media_file table.
+
+The table is read once and hashed by MusicBrainz recording id, by path tail,
+and by normalized (artist, title[, album]), so each beets item resolves with
+a handful of dict lookups instead of a table scan per item.
+'''
+import os, re, sqlite3
+from collections import namedtuple
+from bisect import bisect_left
+from heapq import merge
+
+# Rule names reported for each match, in the order they are tried
+RULES = ('mbid', 'path', 'artist_album_title', 'artist_title')
+
+
+haystack_re = re.compile('[^a-zA-Z0-9A-zÀ-ÖØ-öø-įĴ-őŔ-žǍ-ǰǴ-ǵǸ-țȞ-ȟȤ-ȳɃɆ-ɏḀ-ẞƀ-ƓƗ-ƚƝ-ơƤ-ƥƫ-ưƲ-ƶẠ-ỿ\s]', re.MULTILINE) # should catch all all diacritics?? i dunno
+
+
+def norm_text(s):
+    '''casefolds and collapses whitespace, unifies curly single quotes'''
+    if not s: return ''
+    return ' '.join(str(s).replace('’', "'").casefold().split())
+
+def norm_path(p):
+    if isinstance(p, bytes):
+        p = p.decode('utf-8', 'surrogateescape')
+    return p.replace('\\', '/').casefold()
+
+def path_key(p):
+    '''last two components (parent dir + file name) of a normalized path'''
+    return '/'.join(p.rstrip('/').rsplit('/', 2)[-2:])
+
+
+class MediaFileIndex:
+    def __init__(self, cur):
+        self.by_mbid = {}
+        self.by_path = {}
+        self.by_artist_title = {}
+        self.by_artist_album_title = {}
+        self.album_ids = {}
+        self.size = 0
+        self.build(cur)
+
+    def build(self, cur):
+        cur.execute('SELECT id, path, artist, album_artist, album, title, mbz_recording_id, album_id FROM media_file;')
+        for row in cur:
+            self.add(*row)
+
+    def add(self, id, path, artist, album_artist, album, title, mbid, album_id=None):
+        self.size += 1
+        if album_id:
+            self.album_ids[id] = album_id
+        if mbid:
+            self.by_mbid.setdefault(mbid, id)
+        if path:
+            p = norm_path(path)
+            self.by_path.setdefault(path_key(p), []).append((p, id))
+        t = norm_text(title)
+        if not t: return
+        for a in {norm_text(artist), norm_text(album_artist)}:
+            if not a: continue
+            self.by_artist_title.setdefault((a, t), []).append(id)
+            self.by_artist_album_title.setdefault((a, norm_text(album), t), []).append(id)
+
+    def match(self, rel_path, artist, title, album=None, mb_trackid=None):
+        '''
+        resolves a beets item to a media_file id
+        returns tuple of (id, rule), or (None, None) if nothing matched
+        rel_path is the item path relative to the beets music directory
+        '''
+        if mb_trackid and mb_trackid in self.by_mbid:
+            return (self.by_mbid[mb_trackid], 'mbid')
+        if rel_path:
+            p = norm_path(rel_path).lstrip('/')
+            for (full, id) in self.by_path.get(path_key(p), ()):
+                if full == p or full.endswith('/' + p):
+                    return (id, 'path')
+        a, t = norm_text(artist), norm_text(title)
+        if album:
+            ids = self.by_artist_album_title.get((a, norm_text(album), t))
+            if ids: return (ids[0], 'artist_album_title')
+        ids = self.by_artist_title.get((a, t))
+        if ids: return (ids[0], 'artist_title')
+        return (None, None)
+
+
+def fulltext_tokens(s):
+    '''lowercases and strips anything haystack_re doesn't allow, then splits on whitespace'''
+    if not s: return []
+    return re.sub(haystack_re, '', s.lower()).split()
+
+def _contains(postings, n):
+    i = bisect_left(postings, n)
+    return i < len(postings) and postings[i] == n
+
+
+class FullTextIndex:
+    '''
+    Inverted index of full_text tokens to sorted posting lists of row numbers.
+    A needle token matches a row if it's a substring of any of the row's tokens,
+    same as the old substring scan, so tokens missing from the vocabulary are
+    expanded once against the vocabulary and cached.
+    '''
+    def __init__(self, cur):
+        self.rows = []
+        self.lengths = []
+        self.postings = {}
+        self.expanded = {}
+        self.trigrams = None
+        self.build(cur)
+
+    def build(self, cur):
+        cur.execute('SELECT full_text, id, updated_at, mbz_recording_id FROM media_file;')
+        for (text, *rest) in cur:
+            n = len(self.rows)
+            self.rows.append(tuple(rest))
+            tokens = set(fulltext_tokens(text))
+            self.lengths.append(len(tokens))
+            for t in tokens:
+                self.postings.setdefault(t, []).append(n)
+
+    def words_containing(self, token):
+        '''vocabulary words containing token, narrowed by a trigram index of the vocabulary'''
+        if len(token) < 3:
+            return [w for w in self.postings if token in w]
+        if self.trigrams is None:
+            self.trigrams = {}
+            for w in self.postings:
+                for g in {w[i:i + 3] for i in range(len(w) - 2)}:
+                    self.trigrams.setdefault(g, []).append(w)
+        grams = [self.trigrams.get(token[i:i + 3], ()) for i in range(len(token) - 2)]
+        return [w for w in min(grams, key=len) if token in w]
+
+    def lookup(self, token):
+        if token in self.expanded:
+            return self.expanded[token]
+        lists = [self.postings[w] for w in self.words_containing(token)]
+        if len(lists) == 1:
+            found = lists[0]
+        else:
+            found = []
+            for n in merge(*lists):
+                if not found or found[-1] != n:
+                    found.append(n)
+        self.expanded[token] = found
+        return found
+
+    def search(self, tokens):
+        '''
+        returns every row containing all tokens as (id, updated_at, mbz_recording_id),
+        best first: rows with the fewest extra tokens rank highest
+        '''
+        if not tokens: return []
+        lists = sorted((self.lookup(t) for t in set(tokens)), key=len)
+        found = lists[0]
+        for postings in lists[1:]:
+            if not found: break
+            found = [n for n in found if _contains(postings, n)]
+        return [self.rows[n] for n in sorted(found, key=lambda n: self.lengths[n])]
+
+
+class ItemRow(namedtuple('ItemRow', 'id path artist title mb_trackid nd_item_id play_count rating starred')):
+    '''
+    what pull needs of a beets item, read straight from the library DB: a tuple
+    is a fraction of an Item, which matters with the whole library indexed
+    play_count/rating/starred are the raw values of the beets fields they're pulled into
+    '''
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+def item_path(path, directory=None):
+    '''
+    the absolute path Item.path gives for a raw items.path value, as str: beets stores
+    paths inside the music directory (directory, the library's) relative to it
+    '''
+    if not isinstance(path, str):
+        path = bytes(path).decode('utf-8', 'surrogateescape')
+    if directory and path and not os.path.isabs(path):
+        path = os.path.normpath(os.path.join(os.fsdecode(directory), path.replace('/', os.sep)))
+    return path
+
+
+def read_items(library_path, fields, order=None, ids=None, directory=None):
+    '''
+    yields an ItemRow per beets item
+    fields - dict of play_count/rating/starred => beets field (fixed or flex) holding it
+    order - ORDER BY clause, beets' sort order to pick the same item among duplicates lib.items() would
+    ids - only these items
+    directory - the library's music directory, paths come out absolute like Item.path
+    '''
+    conn = sqlite3.connect(library_path)
+    try:
+        fixed = {r[1] for r in conn.execute('PRAGMA table_info(items)')}
+        names = ['nd_item_id'] + [fields[k] for k in ('play_count', 'rating', 'starred')]
+        columns = ', '.join(f'i."{f}"' if f in fixed else '(SELECT value FROM item_attributes WHERE entity_id = i.id AND key = ?)'
+                            for f in names)
+        where = '' if ids is None else f'WHERE i.id IN ({",".join(str(int(i)) for i in ids)})'
+        cur = conn.execute(f'SELECT i.id, i.path, i.artist, i.title, i.mb_trackid, {columns} FROM items i {where} ORDER BY {order or "i.id"}',
+                           [f for f in names if f not in fixed])
+        for row in cur:
+            yield ItemRow(row[0], item_path(row[1], directory), *row[2:])
+    finally:
+        conn.close()
+
+
+class ItemIndex:
+    '''
+    Beets items hashed by saved nd_item_id, mb_trackid and normalized artist/title,
+    for matching Navidrome tracks on pull without a library query per track.
+    Works on Items and ItemRows alike.
+    '''
+    def __init__(self, items):
+        self.by_nd_id = {}
+        self.by_mbid = {}
+        self.by_artist_title = {}
+        self.size = 0
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        self.size += 1
+        nd_id = item.get('nd_item_id')
+        if nd_id:
+            self.by_nd_id.setdefault(nd_id, item)
+        if item.mb_trackid:
+            self.by_mbid.setdefault(item.mb_trackid, item)
+        key = (norm_text(item.artist), norm_text(item.title))
+        if all(key):
+            self.by_artist_title.setdefault(key, item)
+
+    def match(self, nd_id, artist, title, mb_trackid=None):
+        '''returns tuple of (item, rule), or (None, None)'''
+        if nd_id and nd_id in self.by_nd_id:
+            return (self.by_nd_id[nd_id], 'nd_item_id')
+        if mb_trackid and mb_trackid in self.by_mbid:
+            return (self.by_mbid[mb_trackid], 'mbid')
+        item = self.by_artist_title.get((norm_text(artist), norm_text(title)))
+        if item is not None:
+            return (item, 'artist_title')
+        return (None, None)
+
+
+def relative_path(path, local_dir):
+    '''strips the beets music directory from an item path, posix separators'''
+    if isinstance(path, bytes):
+        path = path.decode('utf-8', 'surrogateescape')
+    path = path.replace('\\', '/')
+    local_dir = local_dir.replace('\\', '/').rstrip('/')
+    if local_dir and path.startswith(local_dir + '/'):
+        path = path[len(local_dir) + 1:]
+    return path
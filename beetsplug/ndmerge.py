@@ -0,0 +1,51 @@
+'''
+Merge rules for ndsync, which syncs annotations both ways in one pass.
+
+Every beets item is matched to its Navidrome track once, like ndpush does,
+and each pair is merged field by field:
+
+- play_count: the higher of the two, plays only ever add up
+- rating: the side picked with sync: ratings (navidrome or beets), where that
+  side has one; 0 means unrated on both sides, so it never clears a rating the
+  other side has (a track Navidrome has no annotation for is unrated there)
+- starred: the side that changed it last
+
+Beets doesn't date its stars, so the ledger keeps each pair's starred state
+as of the last sync (SyncLedger.synced). Two sides that disagree now can't
+both have changed since, so the one that differs from the last sync is the
+latest change and wins. Pairs never synced before go by starred_at: a star
+Navidrome has a starred_at for (set on starring and unstarring) wins over
+beets, one it never touched loses to beets.
+'''
+from collections import namedtuple
+
+SIDES = ('navidrome', 'beets')
+
+Annotation = namedtuple('Annotation', 'play_count rating starred starred_at')
+NO_ANNOTATION = Annotation(0, 0, False, None)
+
+
+def number(v):
+    '''play counts and ratings as ints, beets flex fields are strings and may be unset'''
+    try:
+        return int(float(v or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def merge(beets, nd, base=None, ratings='navidrome', now=None):
+    '''
+    beets, nd - Annotation of either side, beets' starred_at is ignored
+    base - starred as of the last sync of the pair, None if it never was
+    now - starred_at for a star beets changed
+    returns the merged Annotation
+    '''
+    (preferred, other) = (nd.rating, beets.rating) if ratings == 'navidrome' else (beets.rating, nd.rating)
+    rating = preferred or other
+    if beets.starred == nd.starred:
+        (starred, starred_at) = (nd.starred, nd.starred_at)
+    elif (beets.starred != base) if base is not None else not nd.starred_at:
+        (starred, starred_at) = (beets.starred, now)
+    else:
+        (starred, starred_at) = (nd.starred, nd.starred_at)
+    return Annotation(max(beets.play_count, nd.play_count), rating, starred, starred_at)
@@ -0,0 +1,208 @@
+'''
+Change sets for ndpush --plan / --apply.
+
+--plan does all the reading and matching against a read-only connection and,
+instead of writing, saves what the push would change as a JSONL file: a
+header line, then one line per annotation, media_file or album row with its
+values before and after. Rows the push would leave as they are don't make it
+in. The ledger updates a push does (saved mapping, --incremental
+fingerprints) ride along and are only recorded once the plan is applied.
+
+--apply opens one write transaction, checks every before value is still what
+the DB holds (anything Navidrome or a user changed since is a conflict and
+nothing is applied), runs the writes through NavidromeWriter and commits.
+The DB is locked for that transaction only.
+'''
+import json, time, datetime
+from ndwrite import NavidromeWriter, MBID_COLUMNS
+
+PLAN_FORMAT = 'navidrome_sync-plan'
+PLAN_VERSION = 1
+ANNOTATION_COLUMNS = ('play_count', 'rating', 'starred', 'starred_at')
+TIME_COLUMNS = ('updated_at', 'created_at')
+
+
+class PlanError(Exception):
+    pass
+
+
+class PlanConflict(Exception):
+    def __init__(self, conflicts):
+        super().__init__(f'{len(conflicts)} rows changed since the plan was made')
+        self.conflicts = conflicts
+
+
+class Plan:
+    def __init__(self, header, changes=None, mapped=None, forget=None, record=None):
+        '''
+        header - dict of target (ledger key of the DB planned against), fields (annotation columns written), created
+        changes - list of dicts with op (annotation, mbids, file_times, album_times), key, before, after
+        mapped/forget/record - ledger updates, see SyncLedger.map, forget and record
+        '''
+        self.header = header
+        self.changes = changes or []
+        self.mapped = mapped or []
+        self.forget = forget or []
+        self.record = record or []
+
+    def counts(self):
+        counts = {}
+        for c in self.changes:
+            counts[c['op']] = counts.get(c['op'], 0) + 1
+        return counts
+
+
+def fetch(cur, sql, keys, *params):
+    '''runs sql with its IN (%s) filled with batches of keys, yields rows'''
+    keys = list(keys)
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        yield from cur.execute(sql % ','.join('?' * len(batch)), params + tuple(batch))
+
+
+def current_values(cur, annotations, files, albums):
+    '''
+    the DB's values for the rows a plan touches
+    annotations - (user_id, item_id) keys, files - media_file ids, albums - album ids
+    returns dicts for each of them, key => list of values, rows that don't exist are left out
+    '''
+    found = {'annotation': {}, 'media_file': {}, 'album': {}}
+    by_user = {}
+    for (user_id, item_id) in annotations:
+        by_user.setdefault(user_id, []).append(item_id)
+    for (user_id, item_ids) in by_user.items():
+        for row in fetch(cur, f'''SELECT item_id, {", ".join(ANNOTATION_COLUMNS)} FROM annotation
+                                  WHERE item_type = 'media_file' AND user_id = ? AND item_id IN (%s)''', item_ids, user_id):
+            found['annotation'].setdefault((user_id, row[0]), list(row[1:]))
+    for row in fetch(cur, f'SELECT id, {", ".join(MBID_COLUMNS + TIME_COLUMNS)} FROM media_file WHERE id IN (%s)', files):
+        found['media_file'][row[0]] = list(row[1:])
+    for row in fetch(cur, f'SELECT id, {", ".join(TIME_COLUMNS)} FROM album WHERE id IN (%s)', albums):
+        found['album'][row[0]] = list(row[1:])
+    return found
+
+
+def comparable(values):
+    '''values as text, beets flex fields come as strings ('68') where the DB's integer columns hold numbers'''
+    return None if values is None else [None if v is None else str(v) for v in values]
+
+
+def before_value(op, key, current, fields):
+    '''
+    a change's before value as found in current (see current_values), None for a missing row
+    for annotations only the written fields, what's in the other columns can change freely
+    '''
+    if op == 'annotation':
+        row = current['annotation'].get(tuple(key))
+        return None if row is None else [row[ANNOTATION_COLUMNS.index(f)] for f in fields]
+    if op == 'album_times':
+        return current['album'].get(key)
+    row = current['media_file'].get(key)
+    if row is None:
+        return None
+    return row[:len(MBID_COLUMNS)] if op == 'mbids' else row[len(MBID_COLUMNS):]
+
+
+def make_plan(writer, cur, header):
+    '''the writer's changes with their before values read through cur, minus those that change nothing'''
+    header = dict(header, format=PLAN_FORMAT, version=PLAN_VERSION, fields=writer.fields,
+                  created=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'))
+    current = current_values(cur, writer.annotations, set(writer.mbids) | set(writer.times), writer.album_times)
+    plan = Plan(header)
+    entries = [('annotation', list(k), [a[c] for c in ANNOTATION_COLUMNS]) for (k, a) in writer.annotations.items()]
+    entries += [('mbids', k, list(v)) for (k, v) in writer.mbids.items()]
+    entries += [('file_times', k, list(v)) for (k, v) in writer.times.items()]
+    entries += [('album_times', k, list(v)) for (k, v) in writer.album_times.items()]
+    for (op, key, after) in entries:
+        if op != 'annotation' and key not in current['album' if op == 'album_times' else 'media_file']:
+            continue # nothing to update
+        before = before_value(op, key, current, writer.fields)
+        written = [after[ANNOTATION_COLUMNS.index(f)] for f in writer.fields] if op == 'annotation' else after
+        if comparable(before) == comparable(written):
+            continue
+        plan.changes.append({'op': op, 'key': key, 'before': before, 'after': after})
+    return plan
+
+
+def save_plan(path, plan):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(plan.header) + '\n')
+        for c in plan.changes:
+            f.write(json.dumps(c, ensure_ascii=False) + '\n')
+        for row in plan.mapped:
+            f.write(json.dumps({'op': 'map', 'row': list(row)}, ensure_ascii=False) + '\n')
+        for item_id in plan.forget:
+            f.write(json.dumps({'op': 'forget', 'item_id': item_id}) + '\n')
+        for row in plan.record:
+            f.write(json.dumps({'op': 'record', 'row': list(row)}) + '\n')
+
+
+def load_plan(path):
+    with open(path, encoding='utf-8') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != PLAN_FORMAT:
+            raise PlanError(f'{path} is not a navidrome_sync plan')
+        if header.get('version') != PLAN_VERSION:
+            raise PlanError(f'{path} is a version {header.get("version")} plan, this version of the plugin reads version {PLAN_VERSION}')
+        plan = Plan(header)
+        for (n, line) in enumerate(f, 2):
+            try:
+                entry = json.loads(line)
+                op = entry['op']
+            except (ValueError, KeyError, TypeError):
+                raise PlanError(f'{path} line {n} is not a plan entry')
+            if op == 'map':
+                plan.mapped.append(tuple(entry['row']))
+            elif op == 'forget':
+                plan.forget.append(entry['item_id'])
+            elif op == 'record':
+                plan.record.append(tuple(entry['row']))
+            else:
+                plan.changes.append(entry)
+    return plan
+
+
+def apply_plan(conn, plan):
+    '''
+    checks the before values and writes the plan in one transaction
+    returns (rows written, seconds the transaction took), raises PlanConflict without writing anything
+    '''
+    fields = plan.header['fields']
+    writer = NavidromeWriter(None, 'starred' in fields, 'play_count' in fields, 'rating' in fields)
+    keys = {'annotation': set(), 'media_file': set(), 'album': set()}
+    for c in plan.changes:
+        (op, key, after) = (c['op'], c['key'], c['after'])
+        if op == 'annotation':
+            key = tuple(key)
+            keys['annotation'].add(key)
+            writer.annotations[key] = dict(zip(ANNOTATION_COLUMNS, after))
+        elif op == 'mbids':
+            keys['media_file'].add(key)
+            writer.mbids[key] = tuple(after)
+        elif op == 'file_times':
+            keys['media_file'].add(key)
+            writer.times[key] = tuple(after)
+        elif op == 'album_times':
+            keys['album'].add(key)
+            writer.album_times[key] = tuple(after)
+        else:
+            raise PlanError(f'unknown plan entry {op}')
+    start = time.perf_counter()
+    rows = 0
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        current = current_values(cur, keys['annotation'], keys['media_file'], keys['album'])
+        conflicts = [c for c in plan.changes if comparable(before_value(c['op'], c['key'], current, fields)) != comparable(c['before'])]
+        if conflicts:
+            raise PlanConflict(conflicts)
+        for (sql, values) in writer.statements(cur):
+            cur.executemany(sql, values)
+            rows += len(values)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return (rows, time.perf_counter() - start)
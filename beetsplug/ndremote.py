@@ -0,0 +1,95 @@
+'''
+Navidrome DB on the server, read and written through the sqlite3 shell over SSH exec.
+
+Instead of moving the whole DB both ways (pushtarget: sftp), only a compact
+projection of the tables matching needs is streamed down into an in-memory
+DB, and the push comes back as one transactional SQL script that sqlite3
+runs on the host. Traffic scales with the library listing plus the changed
+rows rather than with the size of navidrome.db.
+
+Needs SSH exec and the sqlite3 command line shell on the server.
+'''
+import shlex, sqlite3
+from ndwrite import has_upsert_key, sql_literal
+
+COLUMN_SEP = b'\x1f' # sqlite3 -ascii separators
+ROW_SEP = b'\x1e'
+
+# what MediaFileIndex, FullTextIndex and nd_pull read from media_file
+MEDIA_FILE_COLUMNS = ('id', 'path', 'artist', 'album_artist', 'album', 'title', 'mbz_recording_id',
+                      'album_id', 'full_text', 'updated_at')
+
+
+def records(chunks):
+    '''splits sqlite3 -ascii output into tuples of str, empty fields (incl. NULL) come back as None'''
+    rest = b''
+    for chunk in chunks:
+        rows = (rest + chunk).split(ROW_SEP)
+        rest = rows.pop()
+        for row in rows:
+            yield tuple(f.decode('utf-8', 'surrogateescape') or None for f in row.split(COLUMN_SEP))
+
+
+class RemoteSqlDb:
+    name = 'sql_script'
+
+    def __init__(self, pool, db_path, sqlite3='sqlite3'):
+        self.pool = pool
+        self.db_path = db_path
+        self.sqlite3 = sqlite3
+        self.received = 0
+        self.version = None
+
+    def counted(self, chunks):
+        for chunk in chunks:
+            self.received += len(chunk)
+            yield chunk
+
+    def query(self, sql):
+        '''streams the rows of a read-only query on the server'''
+        command = f'{self.sqlite3} -readonly -ascii {shlex.quote(self.db_path)}'
+        return records(self.counted(self.pool.stream(command, (sql.strip().rstrip(';') + ';\n').encode('utf-8'))))
+
+    def execute_script(self, script):
+        '''runs a script with sqlite3 -bail, so it stops at the first error and the open transaction is dropped'''
+        command = f'{self.sqlite3} -bail {shlex.quote(self.db_path)}'
+        for _ in self.pool.stream(command, script.encode('utf-8')):
+            pass
+
+    def projection(self, annotations=False, user_names=()):
+        '''
+        in-memory DB with the user table, the media_file columns matching needs and
+        the annotation table's schema; the users' media_file annotations are copied
+        too with annotations=True (for pull) or when the schema has no upsert key,
+        since the push then needs to know which rows exist
+        returns (conn, cur)
+        '''
+        conn = sqlite3.connect(':memory:')
+        cur = conn.cursor()
+        self.version = next(self.query('SELECT sqlite_version()'))[0]
+        cur.execute('CREATE TABLE user (id TEXT PRIMARY KEY, user_name TEXT)')
+        cur.executemany('INSERT INTO user VALUES (?, ?)', self.query('SELECT id, user_name FROM user'))
+        for (sql,) in self.query("SELECT sql FROM sqlite_master WHERE tbl_name = 'annotation' AND sql IS NOT NULL"):
+            cur.execute(sql)
+        cur.execute(f'CREATE TABLE media_file ({", ".join(MEDIA_FILE_COLUMNS)})')
+        cur.executemany(f'INSERT INTO media_file VALUES ({", ".join("?" * len(MEDIA_FILE_COLUMNS))})',
+                        self.query(f'SELECT {", ".join(MEDIA_FILE_COLUMNS)} FROM media_file'))
+        if user_names and (annotations or not has_upsert_key(cur)):
+            columns = ('user_id', 'item_id', 'item_type', 'play_count', 'rating', 'starred', 'starred_at')
+            if any(r[1] == 'ann_id' for r in cur.execute('PRAGMA table_info(annotation)').fetchall()):
+                columns = ('ann_id',) + columns
+            cur.executemany(f'INSERT INTO annotation ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                            self.query(f'''SELECT {", ".join("a." + c for c in columns)} FROM annotation a
+                                           JOIN user u ON u.id = a.user_id
+                                           WHERE u.user_name IN ({", ".join(sql_literal(n) for n in user_names)})
+                                             AND a.item_type = 'media_file' '''))
+        conn.commit()
+        return (conn, cur)
+
+    def apply(self, writer, cur):
+        '''sends the writer's changes as one script, returns (rows written, script bytes)'''
+        bulk = tuple(int(n) for n in (self.version or '0').split('.')[:2]) >= (3, 33) # UPDATE ... FROM
+        (script, rows) = writer.script(cur, bulk)
+        if rows:
+            self.execute_script(script)
+        return (rows, len(script.encode('utf-8')))
@@ -0,0 +1,232 @@
+'''
+Set based push engine (engine: sql).
+
+The beets library DB is ATTACHed to the Navidrome DB connection and both
+sides are boiled down to indexed temp tables of normalized match keys, so
+each match rule is one join and each kind of write is one statement over
+the matched rows. Only items no rule matched come back to Python, for the
+fuzzy full_text fallback. With a ledger attached, items whose saved mapping
+still holds (same path, same media_file updated_at) are taken from it first
+and the mapping is rewritten with the writes.
+
+Normalization is the same Python code the index engine uses (registered as
+SQL functions), and items are ranked in the same sort order beets lists them
+in, so both engines match the same items the same way and a track matched by
+several items gets the same one's values.
+'''
+import sqlite3
+from ndmatch import RULES, norm_text, norm_path, path_key, relative_path, item_path
+from ndwrite import NEW_ANN_ID, MBID_COLUMNS, has_upsert_key, sql_literal
+
+BEETS_MBID_COLUMNS = ('mb_trackid', 'mb_albumid', 'mb_artistid', 'mb_albumartistid', 'albumtype', 'mb_releasetrackid')
+ANNOTATION_FIELDS = ('play_count', 'rating', 'starred')
+
+
+def supported():
+    '''UPDATE ... FROM needs sqlite 3.33'''
+    return sqlite3.sqlite_version_info >= (3, 33, 0)
+
+
+class SqlEngine:
+    def __init__(self, conn, library_path, music_dir, ledger_path=None, target=None, directory=None):
+        '''
+        ledger_path/target - SyncLedger DB and ledger key of this Navidrome DB, to use and update the saved mapping
+        directory - the library's music directory (lib.directory), which beets stores item paths relative to;
+        b_items has them absolute, the same paths the python engine keeps in the mapping
+        '''
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.target = target if ledger_path else None
+        self.counts = dict.fromkeys(('mapped',) + RULES + ('fuzzy',), 0)
+        conn.create_function('nd_norm', 1, norm_text, deterministic=True)
+        conn.create_function('nd_norm_path', 1, lambda p: norm_path(p) if p else '', deterministic=True)
+        conn.create_function('nd_path_key', 1, path_key, deterministic=True)
+        conn.create_function('nd_rel_path', 1, lambda p: relative_path(p, music_dir) if p else '', deterministic=True)
+        conn.create_function('nd_item_path', 1, lambda p: item_path(p, directory) if p else '', deterministic=True)
+        self.cur.execute('ATTACH DATABASE ? AS beets', (library_path,))
+        if self.target:
+            self.cur.execute('ATTACH DATABASE ? AS ledger', (ledger_path,))
+
+    def build_keys(self, clause='1', subvals=(), item_ids=None, order=None, fields=ANNOTATION_FIELDS):
+        '''
+        temp tables of match keys for both sides
+        clause/subvals - beets query clause selecting the items, or item_ids for queries beets can't express in SQL
+        order - beets sort ORDER BY clause, the first item in this order wins a track matched more than once
+        fields - beets fields annotations are pushed from (flex or fixed), read into columns f0, f1, ...
+        '''
+        cur = self.cur
+        cur.executescript('''
+            CREATE TEMP TABLE nd_keys AS
+                SELECT n, id, album_id, mbid, npath, nd_path_key(npath) AS pkey FROM (
+                    SELECT rowid AS n, id, album_id, nullif(mbz_recording_id, '') AS mbid, nd_norm_path(path) AS npath
+                    FROM main.media_file);
+            CREATE INDEX temp.nd_keys_id ON nd_keys (id);
+            CREATE INDEX temp.nd_keys_mbid ON nd_keys (mbid, n);
+            CREATE INDEX temp.nd_keys_pkey ON nd_keys (pkey, n);
+            CREATE TEMP TABLE nd_artist_keys AS
+                SELECT rowid AS n, id, nd_norm(artist) AS a, nd_norm(album) AS al, nd_norm(title) AS t FROM main.media_file
+                UNION
+                SELECT rowid AS n, id, nd_norm(album_artist) AS a, nd_norm(album) AS al, nd_norm(title) AS t FROM main.media_file;
+            DELETE FROM nd_artist_keys WHERE a = '' OR t = '';
+            CREATE INDEX temp.nd_artist_keys_aalt ON nd_artist_keys (a, al, t, n);
+            CREATE INDEX temp.nd_artist_keys_at ON nd_artist_keys (a, t, n);''')
+        if item_ids is not None:
+            cur.execute('CREATE TEMP TABLE item_ids (id INTEGER PRIMARY KEY)')
+            cur.executemany('INSERT INTO item_ids VALUES (?)', ((i,) for i in item_ids))
+            (clause, subvals) = ('id IN (SELECT id FROM temp.item_ids)', ())
+        fixed = {r[1] for r in cur.execute('PRAGMA beets.table_info(items)')}
+        self.columns = {f: f'f{n}' for (n, f) in enumerate(sorted(fields))}
+        flex = ', '.join((f'i."{f}"' if f in fixed else
+                          f'(SELECT value FROM beets.item_attributes WHERE entity_id = i.id AND key = {sql_literal(f)})') + f' AS {c}'
+                         for (f, c) in self.columns.items())
+        cur.execute(f'''CREATE TEMP TABLE b_items AS
+                            SELECT i.id AS item_id, row_number() OVER (ORDER BY {order or "i.id"}) AS ord, nd_item_path(i.path) AS path, nd_rel_path(nd_item_path(i.path)) AS rel_path, i.artist, i.albumartist, i.album, i.title,
+                                   i.mtime, {", ".join("i." + c for c in BEETS_MBID_COLUMNS)}, {flex}
+                            FROM beets.items i WHERE {clause}''', subvals)
+        cur.executescript('''
+            ALTER TABLE b_items ADD COLUMN rpath;
+            ALTER TABLE b_items ADD COLUMN pkey;
+            ALTER TABLE b_items ADD COLUMN a;
+            ALTER TABLE b_items ADD COLUMN al;
+            ALTER TABLE b_items ADD COLUMN t;
+            UPDATE b_items SET rpath = ltrim(nd_norm_path(rel_path), '/'), a = nd_norm(artist), al = nd_norm(album), t = nd_norm(title);
+            UPDATE b_items SET pkey = nd_path_key(rpath);
+            CREATE UNIQUE INDEX temp.b_items_id ON b_items (item_id);
+            CREATE TEMP TABLE matches (item_id INTEGER PRIMARY KEY, nd_id TEXT, rule TEXT);
+            CREATE TEMP TABLE item_times (item_id INTEGER PRIMARY KEY, utc TEXT);''')
+        return cur.execute('SELECT count(*) FROM b_items').fetchone()[0]
+
+    def match(self):
+        '''runs the rules in order, each only over items still unmatched, returns dict of rule => count'''
+        lookups = {
+            'mbid': '''SELECT k.id FROM nd_keys k WHERE k.mbid = b.mb_trackid ORDER BY k.n LIMIT 1''',
+            'path': '''SELECT k.id FROM nd_keys k WHERE k.pkey = b.pkey AND b.rpath != ''
+                         AND (k.npath = b.rpath OR substr(k.npath, -length(b.rpath) - 1) = '/' || b.rpath)
+                       ORDER BY k.n LIMIT 1''',
+            'artist_album_title': '''SELECT k.id FROM nd_artist_keys k WHERE b.album != '' AND k.a = b.a AND k.al = b.al AND k.t = b.t
+                                     ORDER BY k.n LIMIT 1''',
+            'artist_title': '''SELECT k.id FROM nd_artist_keys k WHERE k.a = b.a AND k.t = b.t ORDER BY k.n LIMIT 1''',
+        }
+        if self.target:
+            self.cur.execute('''INSERT INTO matches
+                                SELECT b.item_id, x.nd_id, 'mapped' FROM b_items b
+                                JOIN ledger.mapping x ON x.target = ? AND x.item_id = b.item_id
+                                JOIN main.media_file f ON f.id = x.nd_id
+                                WHERE x.path = b.path AND f.updated_at IS x.updated_at''', (self.target,))
+            self.counts['mapped'] = self.cur.rowcount
+        for rule in RULES:
+            self.cur.execute(f'''INSERT INTO matches
+                                 SELECT item_id, nd_id, '{rule}' FROM (
+                                     SELECT b.item_id, ({lookups[rule]}) AS nd_id FROM b_items b
+                                     WHERE b.item_id NOT IN (SELECT item_id FROM matches))
+                                 WHERE nd_id IS NOT NULL''')
+            self.counts[rule] = self.cur.rowcount
+        return self.counts
+
+    def unmatched(self):
+        '''(item_id, artist, albumartist, album, title, rel_path, mb_trackid) of items no rule matched'''
+        return self.cur.execute('''SELECT item_id, artist, albumartist, album, title, rel_path, mb_trackid FROM b_items
+                                   WHERE item_id NOT IN (SELECT item_id FROM matches)''').fetchall()
+
+    def add_matches(self, rows, rule='fuzzy'):
+        '''rows - (item_id, media_file id) found outside SQL'''
+        self.cur.executemany(f"INSERT INTO matches VALUES (?, ?, '{rule}')", rows)
+        self.counts[rule] += len(rows)
+
+    def item_paths(self):
+        '''(item_id, absolute path) of matched items'''
+        return self.cur.execute('SELECT item_id, path FROM b_items WHERE item_id IN (SELECT item_id FROM matches)').fetchall()
+
+    def set_times(self, rows):
+        '''rows - (item_id, UTC string) file times pushed by times=True, items without one fall back to the beets mtime'''
+        self.cur.executemany('INSERT OR REPLACE INTO item_times VALUES (?, ?)', ((i, t) for (i, t) in rows if t))
+
+    def write(self, users, fields, mbids=False, times=False):
+        '''
+        users - list of (user_id, {annotation field: beets field}), each gets one annotation statement
+        fields - annotation fields to update on existing rows (as NavidromeWriter.fields),
+        new rows get every value; one statement per kind of write, all in one transaction
+        returns rows written
+        '''
+        cur = self.cur
+        mbid_columns = ', '.join(f'b.{c} AS {c}' for c in BEETS_MBID_COLUMNS)
+        # one row per media_file, the first matching item in beets' sort order wins
+        cur.execute(f'''CREATE TEMP TABLE push AS
+                        SELECT m.nd_id, k.album_id, CAST(b.mtime AS INTEGER) AS mtime, {", ".join("b." + c for c in self.columns.values())},
+                               coalesce(t.utc, strftime('%Y-%m-%dT%H:%M:%SZ', CAST(b.mtime AS INTEGER), 'unixepoch')) AS utc, {mbid_columns}
+                        FROM (SELECT m.nd_id, m.item_id, row_number() OVER (PARTITION BY m.nd_id ORDER BY b.ord) AS n
+                              FROM matches m JOIN b_items b USING (item_id)) m
+                        JOIN b_items b USING (item_id) JOIN nd_keys k ON k.id = m.nd_id
+                        LEFT JOIN item_times t ON t.item_id = m.item_id
+                        WHERE m.n = 1''')
+        cur.execute('CREATE UNIQUE INDEX temp.push_nd_id ON push (nd_id)')
+        rows = 0
+        with self.conn:
+            if fields:
+                for (user_id, user_fields) in users:
+                    rows += self.write_annotations(user_id, fields, user_fields)
+            if mbids:
+                cur.execute(f'''UPDATE media_file SET {", ".join(f"{c} = p.{b}" for (c, b) in zip(MBID_COLUMNS, BEETS_MBID_COLUMNS))}
+                                FROM push p WHERE media_file.id = p.nd_id''')
+                rows += cur.rowcount
+            if times:
+                cur.execute('''UPDATE media_file SET updated_at = p.utc, created_at = replace(p.utc, 'Z', '.000000000Z')
+                               FROM push p WHERE media_file.id = p.nd_id''')
+                rows += cur.rowcount
+                cur.execute('''UPDATE album SET updated_at = x.utc, created_at = replace(x.utc, 'Z', '.000000000Z')
+                               FROM (SELECT album_id, max(utc) AS utc FROM push WHERE album_id IS NOT NULL GROUP BY album_id) x
+                               WHERE album.id = x.album_id''')
+                rows += cur.rowcount
+            if self.target:
+                cur.execute('DELETE FROM ledger.mapping WHERE target = ? AND item_id IN (SELECT item_id FROM b_items)', (self.target,))
+                cur.execute('''INSERT INTO ledger.mapping (target, item_id, nd_id, path, updated_at)
+                               SELECT ?, m.item_id, m.nd_id, b.path, f.updated_at
+                               FROM matches m JOIN b_items b USING (item_id) JOIN main.media_file f ON f.id = m.nd_id''', (self.target,))
+        return rows
+
+    def write_annotations(self, user_id, fields, user_fields):
+        cur = self.cur
+        (play_count, rating, starred) = (f'p.{self.columns[user_fields[f]]}' for f in ANNOTATION_FIELDS)
+        values = {'play_count': f'coalesce({play_count}, 0)', 'rating': f'coalesce({rating}, 0)',
+                  'starred': f"coalesce({starred} = 'True', 0)",
+                  'starred_at': f"CASE WHEN {starred} = 'True' THEN datetime(p.mtime, 'unixepoch') END"}
+        has_ann_id = any(r[1] == 'ann_id' for r in cur.execute('PRAGMA table_info(annotation)').fetchall())
+        insert = f'''INSERT INTO annotation ({"ann_id, " if has_ann_id else ""}user_id, item_id, item_type, play_count, play_date, rating, starred, starred_at)
+                     SELECT {NEW_ANN_ID + ", " if has_ann_id else ""}:user, p.nd_id, 'media_file', {values["play_count"]}, NULL,
+                            {values["rating"]}, {values["starred"]}, {values["starred_at"]}
+                     FROM push p'''
+        if has_upsert_key(cur):
+            cur.execute(f'''{insert} WHERE true
+                            ON CONFLICT (user_id, item_id, item_type)
+                            DO UPDATE SET {", ".join(f"{f} = excluded.{f}" for f in fields)}''', {'user': user_id})
+            return cur.rowcount
+        # older schemas without a unique key
+        cur.execute(f'''UPDATE annotation SET {", ".join(f"{f} = {values[f]}" for f in fields)} FROM push p
+                        WHERE annotation.user_id = :user AND annotation.item_id = p.nd_id AND annotation.item_type = 'media_file' ''',
+                    {'user': user_id})
+        rows = cur.rowcount
+        cur.execute(f'''{insert} WHERE p.nd_id NOT IN (SELECT item_id FROM annotation WHERE user_id = :user AND item_type = 'media_file'
+                                                                             AND item_id IS NOT NULL)''', {'user': user_id})
+        return rows + cur.rowcount
+
+    def matched(self):
+        return self.cur.execute('SELECT count(*) FROM matches').fetchone()[0]
+
+    def report(self, path):
+        '''writes the match report table (every item with what it matched and how) to a separate SQLite file'''
+        self.cur.execute('ATTACH DATABASE ? AS report', (path,))
+        with self.conn:
+            self.cur.execute('DROP TABLE IF EXISTS report.matches')
+            self.cur.execute('''CREATE TABLE report.matches AS
+                                SELECT b.item_id, b.rel_path AS path, b.artist, b.album, b.title, b.mb_trackid,
+                                       m.nd_id AS media_file_id, coalesce(m.rule, 'missed') AS rule
+                                FROM b_items b LEFT JOIN matches m USING (item_id) ORDER BY b.item_id''')
+        self.cur.execute('DETACH DATABASE report')
+
+    def close(self):
+        self.cur.executescript('''DROP TABLE IF EXISTS temp.push; DROP TABLE IF EXISTS temp.matches;
+                                  DROP TABLE IF EXISTS temp.b_items; DROP TABLE IF EXISTS temp.item_ids; DROP TABLE IF EXISTS temp.item_times;
+                                  DROP TABLE IF EXISTS temp.nd_keys; DROP TABLE IF EXISTS temp.nd_artist_keys;''')
+        self.cur.execute('DETACH DATABASE beets')
+        if self.target:
+            self.cur.execute('DETACH DATABASE ledger')
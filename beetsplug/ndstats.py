@@ -0,0 +1,99 @@
+'''
+Progress output and run metrics shared by push, pull and upload.
+
+Progress redraws its status line at most every `interval` seconds no matter
+how often it's updated, and Metrics collects per-phase timings, counters and
+transfer rates for the --stats JSON report. Both are safe to use from worker
+threads.
+'''
+import sys, time, threading
+from contextlib import contextmanager
+
+
+def update_progress(**kwargs): # =total, matched, updated, missed):
+    # total, matched, updated, missed = [kwargs.get(k) for k in (list(kwargs))]
+    total, matched, updated, missed = [kwargs.get(k) for k in ('total', 'matched', 'updated', 'missed')]
+    pad_int = lambda s: str(s).rjust(len(str(total)))
+    per = ((matched + (missed or 0)) / total) * 100
+    updated_str = f'{pad_int(updated)} updated, ' if updated is not None else ''
+    sys.stdout.write(f'  --- {pad_int(matched)} of {pad_int(total)} matched ({updated_str}{pad_int(missed)} missed) - {str(int(per)).rjust(3)}% complete ---\r')
+    sys.stdout.flush()
+
+
+class Progress:
+    def __init__(self, total, interval=0.25, **counts):
+        self.total = total
+        self.interval = interval
+        self.counts = counts
+        self.lock = threading.Lock()
+        self.last = 0
+
+    def set(self, **counts):
+        '''sets absolute counter values'''
+        with self.lock:
+            self.counts.update(counts)
+            self.maybe_draw()
+
+    def add(self, **counts):
+        '''increments counters, for use from several threads'''
+        with self.lock:
+            for (k, v) in counts.items():
+                self.counts[k] = self.counts.get(k, 0) + v
+            self.maybe_draw()
+
+    def maybe_draw(self):
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.draw()
+
+    def draw(self):
+        if self.total:
+            update_progress(total=self.total, **self.counts)
+
+    def close(self):
+        with self.lock:
+            self.draw()
+        print('')
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.transfers = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def transfer(self, name, size, seconds):
+        '''records bytes moved over some channel or connection and how long it took'''
+        with self.lock:
+            t = self.transfers.setdefault(name, [0, 0])
+            t[0] += size
+            t[1] += seconds
+
+    def report(self):
+        with self.lock:
+            return {
+                'total_seconds': round(time.perf_counter() - self.started, 4),
+                'phases': {k: round(v, 4) for (k, v) in self.phases.items()},
+                'counters': dict(self.counters),
+                'transfers': {k: {'bytes': b, 'seconds': round(s, 4), 'bytes_per_second': round(b / s) if s else None}
+                              for (k, (b, s)) in self.transfers.items()},
+            }
@@ -0,0 +1,175 @@
+'''
+File times for ndpush --time, read from the filesystem.
+
+Item paths are grouped by directory and each directory is listed once with
+os.scandir, directories spread over a thread pool, which is what counts on
+a slow NAS mount where every round trip adds up. The time taken is one of
+
+    mtime     - last modification
+    ctime     - last inode change on *nix, creation time on Windows
+    birthtime - creation time: st_birthtime where the OS has it (macOS, BSD,
+                Windows), statx on Linux if the filesystem records it,
+                mtime otherwise (counted, so the caller can say so)
+
+Birth times are cached in the ledger DB, per file by inode and size, and per
+directory by its inode and mtime: a directory nothing was added to, removed
+from or renamed in since the last scan isn't listed again. mtime and ctime
+come with the listing's stat anyway so they aren't cached. A scan only
+updates the cached files it was asked about, and drops only those the
+listing shows are gone, so a query covering part of a directory keeps the
+rest of its cache.
+'''
+import os, sys, struct, sqlite3, datetime, ctypes, ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+
+KINDS = ('mtime', 'ctime', 'birthtime')
+
+AT_FDCWD = -100
+STATX_BTIME = 0x800
+STATX_BTIME_OFFSET = 80 # struct statx: stx_btime.tv_sec (s64), tv_nsec (u32)
+
+
+def load_statx():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        statx = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).statx
+    except (OSError, AttributeError): # glibc older than 2.28
+        return None
+    statx.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_void_p)
+    return statx
+
+_statx = load_statx()
+
+
+def birthtime(path, st):
+    '''creation time of a file, None if the OS or filesystem doesn't record one'''
+    t = getattr(st, 'st_birthtime', None)
+    if t is not None:
+        return t
+    if os.name == 'nt':
+        return st.st_ctime
+    if _statx is None:
+        return None
+    buf = ctypes.create_string_buffer(256)
+    if _statx(AT_FDCWD, os.fsencode(path), 0, STATX_BTIME, buf) != 0:
+        return None
+    (mask,) = struct.unpack_from('I', buf, 0)
+    if not mask & STATX_BTIME:
+        return None
+    (sec, nsec) = struct.unpack_from('qI', buf, STATX_BTIME_OFFSET)
+    return sec + nsec / 1e9
+
+def utc_string(t): return datetime.datetime.fromtimestamp(int(t), tz=datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class TimeScanner:
+    def __init__(self, cache_path=None, kind='mtime', workers=8):
+        self.kind = kind
+        self.workers = workers
+        self.listed = 0
+        self.unchanged = 0
+        self.fallbacks = 0
+        self.missing = 0
+        self.conn = None
+        if cache_path and kind == 'birthtime':
+            self.conn = sqlite3.connect(cache_path)
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS scanned_dirs (path TEXT PRIMARY KEY, inode INTEGER, mtime_ns INTEGER);
+                CREATE TABLE IF NOT EXISTS file_times (dir TEXT NOT NULL, name TEXT NOT NULL, inode INTEGER, size INTEGER,
+                                                       birthtime REAL, PRIMARY KEY (dir, name));
+                CREATE INDEX IF NOT EXISTS file_times_inode ON file_times (inode, size);''')
+
+    def scan(self, paths):
+        '''
+        paths - file paths (str)
+        returns dict of path => UTC time string, files that can't be found are left out
+        '''
+        dirs = {}
+        for p in paths:
+            dirs.setdefault(os.path.dirname(p), set()).add(os.path.basename(p))
+        (known, by_name, by_inode) = self.load_cache()
+        times = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (d, key, found, gone, listed) in executor.map(lambda d: self.scan_dir(d, dirs[d], known.get(d), by_name, by_inode), dirs):
+                self.missing += len(dirs[d]) - len(found)
+                if listed:
+                    self.listed += 1
+                    self.save(d, key, found, gone)
+                else:
+                    self.unchanged += 1
+                for (name, (inode, size, t, exact)) in found.items():
+                    times[os.path.join(d, name)] = utc_string(t)
+                    if not exact:
+                        self.fallbacks += 1
+        if self.conn:
+            self.conn.commit()
+        return times
+
+    def load_cache(self):
+        if not self.conn:
+            return ({}, {}, {})
+        known = {p: (i, m) for (p, i, m) in self.conn.execute('SELECT path, inode, mtime_ns FROM scanned_dirs')}
+        (by_name, by_inode) = ({}, {})
+        for (d, name, inode, size, t) in self.conn.execute('SELECT dir, name, inode, size, birthtime FROM file_times'):
+            by_name.setdefault(d, {})[name] = (inode, size, t, True)
+            by_inode[(inode, size)] = t
+        return (known, by_name, by_inode)
+
+    def scan_dir(self, d, names, known, by_name, by_inode):
+        '''
+        returns (dir, (inode, mtime_ns), {name: (inode, size, time, exact)}, gone, listed),
+        gone - cached names the listing no longer has, or has as a different file
+        '''
+        try:
+            st = os.stat(d)
+        except OSError:
+            return (d, None, {}, set(), True)
+        key = (st.st_ino, st.st_mtime_ns)
+        cached = by_name.get(d, {})
+        if key == known and names <= cached.keys():
+            return (d, key, {n: cached[n] for n in names}, set(), False)
+        found = {}
+        listing = {}
+        try:
+            with os.scandir(d) as entries:
+                for entry in entries:
+                    if entry.name in cached:
+                        listing[entry.name] = entry.inode()
+                    if entry.name not in names: continue
+                    try:
+                        est = entry.stat()
+                    except OSError:
+                        continue
+                    (t, exact) = self.timestamp(entry.path, est, by_inode)
+                    found[entry.name] = (est.st_ino, est.st_size, t, exact)
+        except OSError: # a listing cut short confirms nothing is gone
+            return (d, key, found, set(), True)
+        gone = {n for n in cached.keys() - found.keys() if listing.get(n) != cached[n][0]}
+        return (d, key, found, gone, True)
+
+    def timestamp(self, path, st, by_inode):
+        '''returns (time, exact), exact is False where mtime stood in for a missing birth time'''
+        if self.kind == 'mtime':
+            return (st.st_mtime, True)
+        if self.kind == 'ctime':
+            return (st.st_ctime, True)
+        t = by_inode.get((st.st_ino, st.st_size))
+        if t is None:
+            t = birthtime(path, st)
+        return (st.st_mtime, False) if t is None else (t, True)
+
+    def save(self, d, key, found, gone):
+        '''upserts the files found with a birth time, deletes the gone ones and any now without one'''
+        if not self.conn or key is None: return
+        self.conn.execute('INSERT OR REPLACE INTO scanned_dirs VALUES (?, ?, ?)', (d,) + key)
+        self.conn.executemany('''INSERT INTO file_times VALUES (?, ?, ?, ?, ?)
+                                 ON CONFLICT (dir, name) DO UPDATE
+                                 SET inode = excluded.inode, size = excluded.size, birthtime = excluded.birthtime''',
+                              ((d, name, inode, size, t) for (name, (inode, size, t, exact)) in found.items() if exact))
+        self.conn.executemany('DELETE FROM file_times WHERE dir = ? AND name = ?',
+                              ((d, name) for name in gone | {n for (n, f) in found.items() if not f[3]}))
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
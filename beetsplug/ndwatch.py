@@ -0,0 +1,142 @@
+'''
+Change detection for ndwatch, which keeps syncing in both directions while it runs.
+
+Beets side: with watch: record on, the plugin listens for database_change,
+item_imported, album_imported and after_write in every beets run and, on exit,
+queues the ids of the items that changed in the ledger DB (see SyncLedger.queue);
+ndwatch picks them up from there, or straight from its own listeners. A Debouncer
+holds them until changes stop coming for a moment, so an import or a modify
+over a few hundred items goes out as one batch rather than one per item.
+
+Navidrome side: an AnnotationPoller looks at PRAGMA data_version, which only
+moves when another connection (Navidrome) commits, and only then reads the
+annotation rows past its high-water mark: rowids above the highest seen for
+new rows, play_date/starred_at/rated_at after the newest seen for updated ones.
+Times are compared to the millisecond, ties on the newest time go by item_id,
+so the rows at the mark itself aren't read again on every poll (only a change
+stamped in the same millisecond as the mark, to a lower item_id, would be
+missed). Idle polls cost one pragma, busy ones the rows that changed.
+Navidrome versions without rated_at don't date rating changes, those are only
+picked up together with a play or a star.
+'''
+import time
+
+TIME_COLUMNS = ('play_date', 'starred_at', 'rated_at')
+STAMP = "strftime('%Y-%m-%d %H:%M:%f', {0})" # to the millisecond, whatever format Navidrome stored
+TRACK_COLUMNS = ('m.id', 'm.artist', 'm.album_artist', 'm.album', 'm.title', 'm.mbz_recording_id', 'm.updated_at',
+                 'a.play_count', 'a.rating', 'a.starred')
+
+
+class Debouncer:
+    def __init__(self, delay=3, max_wait=30, size=500):
+        '''
+        delay - seconds without new changes before a batch is due
+        max_wait - seconds the oldest change waits at most, however busy it gets
+        size - ids per batch, a full batch is due right away
+        '''
+        self.delay = delay
+        self.max_wait = max_wait
+        self.size = size
+        self.pending = {}
+        self.first = None
+        self.last = None
+
+    def add(self, ids):
+        now = time.monotonic()
+        for i in ids:
+            self.pending.setdefault(i, now)
+            self.last = now
+        if self.pending and self.first is None:
+            self.first = now
+
+    def due(self):
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return len(self.pending) >= self.size or now - self.last >= self.delay or now - self.first >= self.max_wait
+
+    def take(self, everything=False):
+        '''returns the oldest size ids (or all of them) and forgets them'''
+        ids = sorted(self.pending, key=self.pending.get)
+        if not everything:
+            ids = ids[:self.size]
+        for i in ids:
+            del self.pending[i]
+        self.first = min(self.pending.values()) if self.pending else None
+        return ids
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class AnnotationPoller:
+    def __init__(self, conn, user_id, mark=None):
+        '''
+        conn - connection to the Navidrome DB, kept open (data_version is per connection)
+        mark - (max_rowid, changed_at, changed_item) to carry on from, None to start from now
+        '''
+        self.conn = conn
+        self.user_id = user_id
+        columns = {r[1] for r in conn.execute('PRAGMA table_info(annotation)')}
+        self.time_columns = [c for c in TIME_COLUMNS if c in columns]
+        self.version = self.data_version()
+        (self.rowid, self.changed_at, self.changed_item) = mark or self.current()
+        self.files = self.files_version()
+
+    def data_version(self):
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def files_version(self):
+        '''changes when Navidrome's scanner adds, removes or updates tracks'''
+        return self.conn.execute('SELECT count(*), max(updated_at) FROM media_file').fetchone()
+
+    def current(self):
+        '''the newest rowid, change time and highest item_id changed at that time in the user's annotations now'''
+        row = self.conn.execute(f'''SELECT max(rowid) {"".join(", max(" + STAMP.format(c) + ")" for c in self.time_columns)}
+                                    FROM annotation WHERE item_type = 'media_file' AND user_id = ?''', (self.user_id,)).fetchone()
+        changed_at = max(filter(None, row[1:]), default=None)
+        changed_item = None
+        if changed_at:
+            changed_item = self.conn.execute(f'''SELECT max(item_id) FROM annotation WHERE item_type = 'media_file' AND user_id = ?
+                                                 AND ? IN ({", ".join(STAMP.format(c) for c in self.time_columns)})''',
+                                             (self.user_id, changed_at)).fetchone()[0]
+        return (row[0] or 0, changed_at, changed_item)
+
+    def mark(self):
+        return (self.rowid, self.changed_at, self.changed_item)
+
+    def poll(self):
+        '''
+        returns (rows, files_changed): rows in TRACK_COLUMNS order for annotations changed since
+        the last poll, files_changed if media_file changed too (cached matching data is stale)
+        '''
+        version = self.data_version()
+        if version == self.version:
+            return ([], False)
+        self.version = version
+        files = self.files_version()
+        (files_changed, self.files) = (files != self.files, files)
+        stamps = [STAMP.format(f'a.{c}') for c in self.time_columns]
+        changed = ' OR '.join(['a.rowid > :rowid'] + [f'{s} > :at OR ({s} = :at AND a.item_id > :item)' for s in stamps])
+        cur = self.conn.execute(f'''SELECT a.rowid, {"".join(s + ", " for s in stamps)}{", ".join(TRACK_COLUMNS)}
+                                    FROM annotation a JOIN media_file m ON m.id = a.item_id
+                                    WHERE a.item_type = 'media_file' AND a.user_id = :user AND ({changed})''',
+                                {'user': self.user_id, 'rowid': self.rowid, 'at': self.changed_at, 'item': self.changed_item})
+        rows = []
+        skip = 1 + len(self.time_columns)
+        for row in cur:
+            self.rowid = max(self.rowid, row[0])
+            for stamp in filter(None, row[1:skip]):
+                # row[skip] is m.id, the annotation's item_id
+                if self.changed_at is None or (stamp, row[skip]) > (self.changed_at, self.changed_item or ''):
+                    (self.changed_at, self.changed_item) = (stamp, row[skip])
+            rows.append(row[skip:])
+        return (rows, files_changed)
+
+    def skip_own_writes(self):
+        '''
+        after writing to the DB through conn: if nothing else was committed since the
+        last poll, moves the mark past what was just written so it isn't pulled back
+        '''
+        if self.data_version() == self.version:
+            (self.rowid, self.changed_at, self.changed_item) = self.current()
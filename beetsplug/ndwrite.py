@@ -0,0 +1,171 @@
+'''
+Batched write stage for pushes to the Navidrome DB.
+
+Changes are collected while matching and applied afterwards in a single
+transaction with executemany, instead of several statements per track, or
+rendered into one SQL script for running on the server (pushtarget: remote-sql).
+'''
+import time
+
+NEW_ANN_ID = '''lower(hex(randomblob(4))) || '-' ||
+                lower(hex(randomblob(2))) || '-4' ||
+                substr(lower(hex(randomblob(2))),2) || '-' ||
+                substr('89ab',abs(random()) % 4 + 1, 1) ||
+                substr(lower(hex(randomblob(2))),2) || '-' ||
+                lower(hex(randomblob(6)))'''
+
+MBID_COLUMNS = ('mbz_recording_id', 'mbz_album_id', 'mbz_artist_id',
+                'mbz_album_artist_id', 'mbz_album_type', 'mbz_release_track_id')
+
+
+def sql_literal(v):
+    if v is None: return 'NULL'
+    if isinstance(v, bool): return str(int(v))
+    if isinstance(v, (int, float)): return repr(v)
+    if isinstance(v, bytes): return f"X'{v.hex()}'"
+    return "'" + str(v).replace("'", "''") + "'"
+
+def render(sql, row):
+    '''fills the ? placeholders of a statement with literals, the statements here have no ? anywhere else'''
+    parts = sql.split('?')
+    return ''.join(p + sql_literal(v) for (p, v) in zip(parts, row)) + parts[-1]
+
+def set_based(sql, table):
+    '''
+    rewrites one of the single row statements here to run once over all rows of table
+    (columns c0, c1, ... in placeholder order): UPDATE ... WHERE becomes UPDATE ... FROM
+    table WHERE (sqlite 3.33+), INSERT ... VALUES becomes INSERT ... SELECT ... FROM table
+    '''
+    parts = sql.split('?')
+    sql = ''.join(p + f'p.c{n}' for (n, p) in enumerate(parts[:-1])) + parts[-1]
+    if sql.startswith('UPDATE'):
+        (head, where) = sql.split(' WHERE ', 1)
+        return f'{head} FROM {table} AS p WHERE {where}'
+    (head, conflict) = (sql.split(' ON CONFLICT ', 1) + [None])[:2]
+    (insert, values) = head.split(' VALUES ', 1)
+    return f'{insert} SELECT {values.strip()[1:-1]} FROM {table} AS p WHERE true' + (f' ON CONFLICT {conflict}' if conflict else '')
+
+
+def set_pragmas(conn, journal_mode=None, synchronous=None):
+    '''
+    relaxes durability for a throwaway working copy, e.g. journal_mode: memory, synchronous: off
+    don't use these against a DB Navidrome itself has open
+    '''
+    if journal_mode:
+        conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    if synchronous:
+        conn.execute(f'PRAGMA synchronous = {synchronous}')
+
+
+class NavidromeWriter:
+    def __init__(self, user_id, starred=True, playcounts=True, ratings=True):
+        '''
+        user_id - user annotations are written for unless annotate() is given another
+        starred, playcounts, ratings - which annotation fields are pushed, disabled
+        fields are left alone on existing annotations and default to 0 on new ones
+        '''
+        self.user_id = user_id
+        self.fields = [f for (f, on) in (('starred', starred), ('play_count', playcounts), ('rating', ratings)) if on]
+        if starred:
+            self.fields.append('starred_at')
+        self.annotations = {}
+        self.mbids = {}
+        self.times = {}
+        self.album_times = {}
+
+    def annotate(self, item_id, play_count, rating, starred, starred_at, user_id=None):
+        if self.fields:
+            self.annotations[(user_id or self.user_id, item_id)] = {'play_count': play_count, 'rating': rating, 'starred': starred, 'starred_at': starred_at}
+
+    def set_mbids(self, item_id, mbids):
+        self.mbids[item_id] = tuple(mbids)
+
+    def set_time(self, item_id, album_id, utc, utc_m):
+        '''album times end up as the newest time of any of their tracks'''
+        self.times[item_id] = (utc, utc_m)
+        if album_id and (album_id not in self.album_times or self.album_times[album_id][0] < utc):
+            self.album_times[album_id] = (utc, utc_m)
+
+    def __len__(self):
+        return len(self.annotations) + len(self.mbids) + len(self.times) + len(self.album_times)
+
+    def apply(self, conn):
+        '''writes everything in one transaction, returns (rows written, seconds taken)'''
+        start = time.perf_counter()
+        rows = 0
+        with conn:
+            cur = conn.cursor()
+            for (sql, values) in self.statements(cur):
+                cur.executemany(sql, values)
+                rows += len(values)
+        return (rows, time.perf_counter() - start)
+
+    def script(self, cur, bulk=True, batch=500):
+        '''
+        the same writes as one transactional SQL script, for the sqlite3 shell on the server
+        cur only needs the annotation schema (and, without an upsert key, the pushed users' annotation item_ids)
+        bulk - load each statement's rows into a temp table and run it once, set based,
+        instead of once per row with the values spelled out (needs sqlite 3.33+ on the server)
+        returns (script, rows)
+        '''
+        lines = ['PRAGMA busy_timeout = 10000;', 'BEGIN IMMEDIATE;']
+        rows = 0
+        for (num, (sql, values)) in enumerate(self.statements(cur)):
+            if not values: continue
+            sql = ' '.join(sql.split())
+            rows += len(values)
+            if not bulk:
+                lines.extend(render(sql, v) + ';' for v in values)
+                continue
+            table = f'temp.push{num}'
+            lines.append(f'CREATE TABLE {table} ({", ".join(f"c{n}" for n in range(len(values[0])))});')
+            for start in range(0, len(values), batch):
+                lines.append(f'INSERT INTO {table} VALUES ' +
+                             ','.join(f'({",".join(map(sql_literal, v))})' for v in values[start:start + batch]) + ';')
+            lines.append(set_based(sql, table) + ';')
+            lines.append(f'DROP TABLE {table};')
+        lines.append('COMMIT;')
+        return ('\n'.join(lines) + '\n', rows)
+
+    def statements(self, cur):
+        '''list of (sql, list of parameter tuples) making up the push'''
+        out = []
+        if self.annotations:
+            out.extend(self.annotation_statements(cur))
+        if self.mbids:
+            out.append((f'UPDATE media_file SET {", ".join(c + " = ?" for c in MBID_COLUMNS)} WHERE id = ?',
+                        [v + (k,) for (k, v) in self.mbids.items()]))
+        if self.times:
+            out.append(('UPDATE media_file SET updated_at = ?, created_at = ? WHERE id = ?',
+                        [v + (k,) for (k, v) in self.times.items()]))
+            out.append(('UPDATE album SET updated_at = ?, created_at = ? WHERE id = ?',
+                        [v + (k,) for (k, v) in self.album_times.items()]))
+        return out
+
+    def annotation_statements(self, cur):
+        columns = ('play_count', 'rating', 'starred', 'starred_at')
+        values = [k + tuple(a[c] for c in columns) for (k, a) in self.annotations.items()]
+        has_ann_id = any(r[1] == 'ann_id' for r in cur.execute('PRAGMA table_info(annotation)'))
+        insert = f'''INSERT INTO annotation ({"ann_id, " if has_ann_id else ""}user_id, item_id, item_type, play_count, play_date, rating, starred, starred_at)
+                     VALUES ({NEW_ANN_ID + ", " if has_ann_id else ""}?, ?, 'media_file', ?, NULL, ?, ?, ?)'''
+        if has_upsert_key(cur):
+            return [(f'''{insert}
+                         ON CONFLICT (user_id, item_id, item_type)
+                         DO UPDATE SET {", ".join(f"{f} = excluded.{f}" for f in self.fields)}''', values)]
+        # older schemas without a unique key: split into updates and inserts up front
+        users = {k[0] for k in self.annotations}
+        cur.execute("SELECT user_id, item_id FROM annotation WHERE item_type = 'media_file'")
+        existing = {r for r in cur if r[0] in users}
+        return [(f'''UPDATE annotation SET {", ".join(f"{f} = ?" for f in self.fields)}
+                     WHERE user_id = ? AND item_id = ? AND item_type = 'media_file' ''',
+                 [tuple(self.annotations[v[:2]][f] for f in self.fields) + v[:2] for v in values if v[:2] in existing]),
+                (insert, [v for v in values if v[:2] not in existing])]
+
+
+def has_upsert_key(cur):
+    '''ON CONFLICT needs a unique index or primary key on exactly (user_id, item_id, item_type)'''
+    key = {'user_id', 'item_id', 'item_type'}
+    for (_, name, unique, *rest) in cur.execute('PRAGMA index_list(annotation)').fetchall():
+        if unique and {r[2] for r in cur.execute(f'PRAGMA index_info("{name}")')} == key:
+            return True
+    return False
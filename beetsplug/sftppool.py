@@ -0,0 +1,191 @@
+'''
+Pool of reusable SSH transports and SFTP channels.
+
+A handful of transports are kept alive for the run and each carries several
+SFTP channels, so the SSH handshake and auth happen once per transport
+instead of once per file or chunk. Channels are health checked before they
+are handed out, broken ones are dropped and replaced, and anything left idle
+longer than idle_timeout is closed.
+'''
+import time
+import threading
+from contextlib import contextmanager
+import paramiko
+
+
+class SftpPool:
+    def __init__(self, sftp_config, max_connections=2, channels=4, idle_timeout=60):
+        self.sftp_config = sftp_config
+        self.max_connections = max_connections
+        self.max_channels = channels
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.clients = []   # connected SSHClients
+        self.open = {}      # SSHClient => number of SFTP channels open on it
+        self.owner = {}     # SFTPClient => SSHClient it runs on
+        self.idle = []      # (SFTPClient, last used) ready for reuse
+        self.connecting = 0
+        self.names = {}     # SSHClient => 'connN', for per-connection stats
+
+    def connect(self):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.sftp_config['host'], port=self.sftp_config['port'],
+                    username=self.sftp_config['username'], password=self.sftp_config['password'],
+                    compress=self.sftp_config.get('compress', False))
+        ssh.get_transport().window_size = 2147483647
+        return ssh
+
+    @contextmanager
+    def session(self):
+        '''borrows an SFTP channel, broken channels aren't returned to the pool'''
+        sftp = self.acquire()
+        broken = False
+        try:
+            yield sftp
+        except (paramiko.ssh_exception.SSHException, EOFError):
+            broken = True
+            raise
+        finally:
+            self.release(sftp, broken)
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                self.reap()
+                while self.idle:
+                    (sftp, _) = self.idle.pop()
+                    if self.healthy(sftp):
+                        return sftp
+                    self.discard(sftp)
+                client = next((c for c in self.clients if self.open[c] < self.max_channels and alive(c)), None)
+                if client is not None:
+                    self.open[client] += 1
+                    break
+                if len(self.clients) + self.connecting < self.max_connections:
+                    self.connecting += 1
+                    break
+                self.cond.wait()
+        try:
+            if client is None:
+                try:
+                    client = self.connect()
+                finally:
+                    with self.cond:
+                        self.connecting -= 1
+                        if client is not None:
+                            self.clients.append(client)
+                            self.open[client] = 1
+                            self.names[client] = f'conn{len(self.names)}'
+                        self.cond.notify()
+            sftp = client.open_sftp()
+        except Exception:
+            if client is not None:
+                with self.cond:
+                    self.open[client] -= 1
+                    self.drop_client(client)
+                    self.cond.notify()
+            raise
+        with self.cond:
+            self.owner[sftp] = client
+        return sftp
+
+    def name(self, sftp):
+        '''stable name of the connection a channel runs on'''
+        with self.cond:
+            return self.names.get(self.owner.get(sftp), 'conn?')
+
+    def release(self, sftp, broken=False):
+        with self.cond:
+            if broken or not self.healthy(sftp):
+                self.discard(sftp)
+            else:
+                self.idle.append((sftp, time.monotonic()))
+            self.cond.notify()
+
+    def healthy(self, sftp):
+        channel = sftp.get_channel()
+        return channel is not None and not channel.closed and channel.get_transport().is_active()
+
+    def discard(self, sftp):
+        client = self.owner.pop(sftp, None)
+        try:
+            sftp.close()
+        except Exception:
+            pass
+        if client is not None:
+            self.open[client] -= 1
+            self.drop_client(client)
+
+    def drop_client(self, client):
+        '''closes a transport once no channels are left on it, dead transports drain the same way'''
+        if client in self.open and self.open[client] <= 0:
+            del self.open[client]
+            self.clients.remove(client)
+            client.close()
+
+    def reap(self):
+        '''closes channels idle for longer than idle_timeout'''
+        now = time.monotonic()
+        stale = [s for (s, used) in self.idle if now - used > self.idle_timeout]
+        if stale:
+            self.idle = [(s, used) for (s, used) in self.idle if s not in stale]
+            for sftp in stale:
+                self.discard(sftp)
+
+    def execute(self, command, sftp=None):
+        '''
+        runs a command over an exec channel of a pooled transport, returns stdout lines
+        sftp - a session the caller holds, whose transport is used instead of borrowing another
+        '''
+        if sftp is None:
+            with self.session() as sftp:
+                return self.execute(command, sftp)
+        chan = sftp.get_channel().get_transport().open_session()
+        try:
+            chan.exec_command(command)
+            out = chan.makefile('rb').read()
+            chan.recv_exit_status()
+        finally:
+            chan.close()
+        return out.splitlines()
+
+    def stream(self, command, stdin=None, size=65536):
+        '''
+        runs a command over an exec channel and yields its stdout in chunks as they arrive
+        stdin (bytes) is sent first, raises OSError with the command's stderr if it exits non-zero
+        '''
+        with self.session() as sftp:
+            chan = sftp.get_channel().get_transport().open_session()
+            try:
+                chan.exec_command(command)
+                if stdin:
+                    chan.sendall(stdin)
+                chan.shutdown_write()
+                while True:
+                    data = chan.recv(size)
+                    if not data: break
+                    yield data
+                status = chan.recv_exit_status()
+                if status:
+                    error = chan.makefile_stderr('rb').read().decode('utf-8', 'replace').strip()
+                    raise OSError(f'{command.split()[0]} exited with status {status}: {error}')
+            finally:
+                chan.close()
+
+    def close(self):
+        with self.cond:
+            for (sftp, _) in self.idle:
+                self.discard(sftp)
+            self.idle = []
+            for client in list(self.clients):
+                client.close()
+            self.clients = []
+            self.open = {}
+            self.owner = {}
+            self.cond.notify_all()
+
+
+def alive(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
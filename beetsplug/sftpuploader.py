@@ -1,131 +1,338 @@
 import paramiko
 import os
+import re
+import json
+import math
+import time
+import queue
+import shlex
+import hashlib
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from tqdm import tqdm
 from beets.util import bytestring_path, path_as_posix
 from beets.ui import decargs
-from multiprocessing import Value
+from sftppool import SftpPool
+
+MB = 1024 * 1024
+VERIFY_RETRIES = 2 # rounds of re-sending the chunks of a file that arrived damaged
+
+class UploadFailed(Exception):
+    '''some files of an upload_files call failed, failed is how many; the first error is the cause'''
+    def __init__(self, failed, total, first):
+        super().__init__(f'{failed} of {total} files failed, first: {first}')
+        self.failed = failed
 
 class SftpUploader:
-    def __init__(self, sftp_config, log):
+    def __init__(self, sftp_config, log, pool=None):
+        '''
+        sftp_config keys used besides the connection details:
+        workers - files/chunks in flight at once, chunk_size - files bigger than
+        twice this are split, and no chunk is ever smaller than it, journal - json
+        file tracking chunks of unfinished uploads so they can be resumed,
+        block_size - bytes read and written at a time, pipeline - blocks read ahead
+        on a thread while the previous ones are sent (1 to take turns),
+        verify - check uploads by size and, where the host runs commands, sha1 per chunk
+        '''
         self.sftp_config = sftp_config
+        self.pool = pool or SftpPool(sftp_config)
+        self.workers = sftp_config.get('workers') or 8
+        self.chunk_size = sftp_config.get('chunk_size') or 8 * MB
+        self.block_size = sftp_config.get('block_size') or 256 * 1024
+        self.pipeline = sftp_config.get('pipeline') or 1
+        self.verify_uploads = sftp_config.get('verify', True)
+        self.remote_hash = None # whether the host can hash chunks for verify, None until tried
         self.lock = threading.Lock()
-        self.created = False
+        self.listings = {} # remote dir => {name: SFTPAttributes}, None if missing
+        self.journal = UploadJournal(sftp_config.get('journal'))
+        self.rate = None # bytes/s per channel, averaged over finished chunks
+        self.metrics = None # ndstats.Metrics, set by the plugin for --stats
         self._log = log
 
-    def upload(self, lib, opts, args):
-        if not args:
-           items = lib
+    def upload(self, lib, opts, args, quiet=False, executor=None):
+        if hasattr(lib, 'items'):
+            items = lib.items(decargs(args or []))
         else:
-            items = lib.items(decargs(args))
-        # albumart = set()
-        artpath = None
+            items = lib
+        return self.upload_files(self.files_for(items), quiet, executor)
+
+    def files_for(self, items):
+        '''(local path, None) pairs for the items' files and their albums' art'''
         to_upload = []
+        albumart = set()
+        albums = {}
         for i in items:
-            if not artpath and i['artpath']:
-                artpath = i['artpath']
-                size = os.path.getsize(artpath)  # Calculate size of cover art
-                to_upload.append((artpath))
-            local = i['path']
-            to_upload.append((local))
-        
-        # if items[0]['artpath']:
-        #     local = items[0]['artpath']
-        #     size = os.path.getsize(local)  # Calculate size of cover art
-        #     to_upload.append((local, size))
-
-        for local, size in to_upload: 
-            print(f"Uploading {local.decode('utf-8')} to {str(self.format_dest_path(local))}")
-            self.upload_file(local, size)
-
+            if i.album_id and i.album_id not in albums:
+                albums[i.album_id] = i.get_album()
+            album = albums.get(i.album_id)
+            artpath = album.artpath if album else None
+            if artpath and artpath not in albumart and os.path.exists(artpath):
+                albumart.add(artpath)
+                to_upload.append((artpath, None))
+            to_upload.append((i['path'], None))
+        return to_upload
 
     def upload_file(self, local, dest = None):
-        size = os.path.getsize(local)  # Calculate size of file
-        threads_count = 6 
-        part_size = int(size / threads_count)
-        self.lock = threading.Lock()
-        self.created = False
-        offset = 0
-        threads = []
-        progress = Value('i', 0)  # Create shared progress object
-        items = []
-
-        for num in range(threads_count):
-            if num == threads_count - 1:
-                part_size = size - offset
-            args = [num, offset, part_size, local, dest or self.format_dest_path(local), progress]
-            items.append((part_size, args))
-            offset += part_size
-
-        total_size = sum([item[0] for item in items])
-
-        self.mkdir_p(self.sftp_connect(), items[0][1][-2], is_dir=False)
-
-        with tqdm(total=total_size, smoothing=0.8, unit='B', unit_scale=True, desc='Progress') as overall_pbar:
-            for item in items:
-                thread = threading.Thread(target=self.upload_part, args=item[1])
-                threads.append(thread)
-                thread.start()
-            
-            while any(t.is_alive() for t in threads):  # Update progress while threads are running
-                    overall_pbar.update(progress.value - overall_pbar.n)
+        return self.upload_files([(local, dest)])
 
-            overall_pbar.update(total_size - overall_pbar.n)  # Update progress to 100%
-            overall_pbar.close()
+    def upload_files(self, files, quiet=False, executor=None):
+        '''
+        uploads (local path, remote path or None) pairs on a bounded worker pool
+        small files go whole on a single channel, big ones are split into chunks
+        sized from the throughput seen so far
+        executor - worker pool shared by concurrent calls (BackgroundUploader's),
+        by default one of workers threads for this call alone
+        returns tuple of (files uploaded, bytes uploaded, files skipped),
+        raises UploadFailed once the rest are done if any failed
+        '''
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return self.upload_files(files, quiet, executor)
+        jobs = []
+        for (local, dest) in files:
+            jobs.append((local, dest or self.format_dest_path(local), os.path.getsize(local)))
+        started = time.perf_counter()
+        list(executor.map(self.listing, {os.path.dirname(j[1]) for j in jobs}))
+        if self.metrics:
+            self.metrics.add_time('remote_listing', time.perf_counter() - started)
+        todo = [j for j in jobs if not self.unchanged(*j)]
+        if len(todo) < len(jobs):
+            (self._log.debug if quiet else self._log.info)('Skipping {0} files already on the remote', len(jobs) - len(todo))
+        skipped = len(jobs) - len(todo)
+        jobs = todo
+        if not jobs: return (0, 0, skipped)
+        total_size = sum(j[2] for j in jobs)
+        done = threading.Condition()
+        pending = [len(jobs)]
+        errors = []
 
-            for num in range(len(threads)):
-                threads[num].join()
+        def finished(err=None):
+            with done:
+                if err: errors.append(err)
+                pending[0] -= 1
+                done.notify_all()
 
-    def upload_part(self, num, offset, part_size, local_path, remote_path, progress):
+        with tqdm(total=total_size, smoothing=0.8, unit='B', unit_scale=True, desc='Progress', disable=quiet) as pbar:
+            def progress(n):
+                with self.lock:
+                    pbar.update(n)
+
+            def start_file(local, remote, size):
+                try:
+                    self._log.debug('Uploading {0} to {1}', os.fsdecode(local), remote)
+                    mtime = int(os.path.getmtime(local))
+                    parts = self.journal.resume(remote, size, mtime) if self.remote_attr(remote) else None
+                    if parts is None:
+                        with self.pool.session() as sftp:
+                            self.mkdir_p(sftp, remote, is_dir=False)
+                            sftp.open(remote, 'w').close()
+                        parts = [[offset, part_size, False] for (offset, part_size) in self.split(size)]
+                        if len(parts) > 1:
+                            self.journal.start(remote, size, mtime, parts)
+                    else:
+                        self._log.debug('Resuming {0}', remote)
+                        progress(sum(p[1] for p in parts if p[2]))
+                    todo = [num for (num, p) in enumerate(parts) if not p[2]]
+                    state = {'remaining': len(todo), 'error': None, 'retries': VERIFY_RETRIES}
+                    def send(nums):
+                        for num in nums:
+                            (offset, part_size) = parts[num][:2]
+                            executor.submit(self.upload_part, num, offset, part_size, local, remote, progress, self.verify_uploads) \
+                                    .add_done_callback(partial(part_done, num))
+                    def complete():
+                        '''every chunk is written: re-sends the ones that didn't arrive intact, or marks the file done'''
+                        damaged = self.verify(local, remote, size, parts) if self.verify_uploads else []
+                        if damaged:
+                            if state['retries'] == 0:
+                                raise IOError(f'{remote}: {len(damaged)} chunks still damaged after {VERIFY_RETRIES} retries')
+                            state['retries'] -= 1
+                            state['remaining'] = len(damaged)
+                            self._log.info('{0}: {1} of {2} chunks arrived damaged, sending them again', remote, len(damaged), len(parts))
+                            if self.metrics:
+                                self.metrics.count('chunks_resent', len(damaged))
+                            progress(-sum(parts[n][1] for n in damaged)) # counted again as they're resent
+                            send(damaged)
+                            return
+                        self.set_times(local, remote)
+                        self.journal.finish(remote)
+                        finished()
+                    def part_done(num, future):
+                        if not future.exception():
+                            self.journal.part_done(remote, num, future.result())
+                        with self.lock:
+                            state['remaining'] -= 1
+                            state['error'] = state['error'] or future.exception()
+                            last = state['remaining'] == 0
+                        if not last: return
+                        try:
+                            if state['error']: raise state['error']
+                            complete()
+                        except Exception as x:
+                            finished(x)
+                    if not todo: # interrupted after the last chunk
+                        complete()
+                        return
+                    send(todo)
+                except Exception as x:
+                    finished(x)
+
+            for (local, remote, size) in jobs:
+                executor.submit(start_file, local, remote, size)
+            with done:
+                done.wait_for(lambda: pending[0] == 0)
+        if self.metrics:
+            self.metrics.transfer('upload', total_size, time.perf_counter() - started)
+            self.metrics.count('files_uploaded', len(jobs))
+            self.metrics.count('files_skipped', skipped)
+        if errors:
+            raise UploadFailed(len(errors), len(jobs), errors[0]) from errors[0]
+        return (len(jobs), total_size, skipped)
+
+    def listing(self, remote_dir, sftp=None):
+        '''
+        cached listdir_attr of a remote directory, None if it doesn't exist
+        sftp - the session the caller already holds, taking a second one from the
+        pool while holding one deadlocks once every worker does the same
+        '''
+        with self.lock:
+            if remote_dir in self.listings:
+                return self.listings[remote_dir]
         try:
-            sftp = self.sftp_connect()
+            if sftp is not None:
+                listing = {a.filename: a for a in sftp.listdir_attr(remote_dir)}
+            else:
+                with self.pool.session() as sftp:
+                    listing = {a.filename: a for a in sftp.listdir_attr(remote_dir)}
+        except IOError:
+            listing = None
+        with self.lock:
+            self.listings[remote_dir] = listing
+        return listing
+
+    def remote_attr(self, remote):
+        listing = self.listing(os.path.dirname(remote))
+        return listing.get(os.path.basename(remote)) if listing else None
+
+    def unchanged(self, local, remote, size):
+        '''remote copy has the same size and mtime, which set_times gives every finished upload'''
+        if remote in self.journal.entries: return False
+        attr = self.remote_attr(remote)
+        return attr is not None and attr.st_size == size and int(attr.st_mtime) == int(os.path.getmtime(local))
 
-            with open(local_path, "rb") as fl:
-                fl.seek(offset)
+    def split(self, size):
+        '''(offset, length) chunks for a file, fewer and bigger the faster each channel turns out to be'''
+        if size <= 2 * self.chunk_size:
+            return [(0, size)]
+        chunk = self.chunk_size
+        if self.rate:
+            chunk = max(chunk, int(self.rate * 4)) # aim for ~4s per chunk
+        count = max(1, min(self.workers, size // chunk))
+        part_size = math.ceil(size / count)
+        return [(o, min(part_size, size - o)) for o in range(0, size, part_size)]
+
+    def upload_part(self, num, offset, part_size, local_path, remote_path, progress, digest=False):
+        '''
+        writes part_size bytes of the file from offset, returns their sha1 hex digest with digest, else None
+        blocks are read into reused buffers and handed to the unbuffered remote file as views, so
+        nothing is copied on the way to paramiko, and hashed in the same pass
+        progress gets the bytes as they're written, and takes them back if the chunk fails
+        '''
+        sent = 0
+        try:
+            start = time.perf_counter()
+            sha1 = hashlib.sha1() if digest else None
+            with self.pool.session() as sftp:
+                conn = self.pool.name(sftp)
+                with open(local_path, "rb") as fl:
+                    fl.seek(offset)
+                    fr = sftp.open(remote_path, "r+", bufsize=0)
+                    try:
+                        fr.seek(offset)
+                        fr.set_pipelined(True)
+                        for block in read_blocks(fl, part_size, self.block_size, self.pipeline, sha1):
+                            fr.write(block)
+                            sent += len(block)
+                            progress(len(block))
+                    finally:
+                        fr.close()
+            elapsed = time.perf_counter() - start
+            if self.metrics:
+                self.metrics.transfer(conn, part_size, elapsed)
+            if elapsed > 0 and part_size >= self.chunk_size:
+                rate = part_size / elapsed
                 with self.lock:
-                    m = "r+" if self.created else "w"
-                    self.created = True
-                    fr = sftp.open(remote_path, m)
-                try:
-                    fr.seek(offset)
-                    fr.set_pipelined(True)
-                    size = 0
-                    while size < part_size:
-                        s = 32768
-                        if size + s > part_size:
-                            s = part_size - size
-                        data = fl.read(s)
-                        fr.write(data)
-                        size += len(data)
-                        progress.value += len(data)  # Update shared progress
-                        if len(data) == 0:
-                            break             
-                finally:
-                    fr.close()
-
-            local_stat = os.stat(local_path)
-            sftp.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
-        except (paramiko.ssh_exception.SSHException) as x:
-            print(f"Thread {num} failed: {x}")
-            raise x
+                    self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        except Exception as x:
+            progress(-sent)
+            self._log.warning('{0}: chunk {1} failed: {2}', remote_path, num, x)
+            raise
+        return sha1.hexdigest() if sha1 else None
 
-    def sftp_connect(self):
+    def verify(self, local_path, remote_path, size, parts):
+        '''
+        checks an upload arrived intact, returns the numbers of the chunks to send again
+        the remote size first, then, where the host runs commands over SSH, every chunk's sha1
+        (taken while sending, resumed chunks from before that have none are read again)
+        '''
+        started = time.perf_counter()
+        with self.pool.session() as sftp:
+            remote_size = sftp.stat(remote_path).st_size
+        if remote_size != size:
+            self._log.debug('{0}: {1} bytes on the remote, expected {2}', remote_path, remote_size, size)
+            return [n for (n, p) in enumerate(parts) if p[0] + p[1] > remote_size] if remote_size < size else list(range(len(parts)))
+        remote = self.remote_sha1s(remote_path, parts)
+        damaged = []
+        if remote is not None:
+            with open(local_path, 'rb') as f:
+                for (n, p) in enumerate(parts):
+                    local = p[3] if len(p) > 3 and p[3] else file_sha1(f, p[0], p[1], self.block_size)
+                    if remote[n] != local:
+                        damaged.append(n)
+        if self.metrics:
+            self.metrics.add_time('verify', time.perf_counter() - started)
+        return damaged
+
+    def remote_sha1s(self, remote_path, parts):
+        '''
+        sha1 hex digests of the file's chunks on the remote, None if the host can't run the command
+        one command hashes all chunks at once, each prints its number along with its digest
+        '''
+        if self.remote_hash is False:
+            return None
+        path = shlex.quote(remote_path)
+        command = ' '.join(f'(echo "{n} $(tail -c +{p[0] + 1} {path} | head -c {p[1]} | sha1sum)") &'
+                           for (n, p) in enumerate(parts)) + ' wait'
         try:
-            sftp_server = self.sftp_config['host']
-            port = self.sftp_config['port']
-            username = self.sftp_config['username']
-            password = self.sftp_config['password']
-    
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(sftp_server, port=port, username=username, password=password)
-            transport = ssh.get_transport()
-            transport.window_size = 2147483647
-            sftp = ssh.open_sftp()
-            return sftp
-
-        except (paramiko.ssh_exception.SSHException) as x:
-            raise x
+            lines = self.pool.execute(command)
+        except Exception:
+            lines = []
+        found = {}
+        for line in lines:
+            fields = line.decode('utf-8', 'replace').split()
+            if len(fields) >= 2 and fields[0].isdigit() and re.fullmatch('[0-9a-f]{40}', fields[1]):
+                found[int(fields[0])] = fields[1]
+        digests = [found.get(n) for n in range(len(parts))]
+        if None in digests:
+            if self.remote_hash is None:
+                self._log.info('The remote host can\'t hash files (tail, head and sha1sum over SSH), uploads are checked by size only')
+            self.remote_hash = False
+            return None
+        self.remote_hash = True
+        return digests
+
+    def set_times(self, local_path, remote_path):
+        '''marks an upload finished, and keeps the cached listing in step for later batches'''
+        local_stat = os.stat(local_path)
+        with self.pool.session() as sftp:
+            sftp.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = local_stat.st_size
+        attr.st_mtime = int(local_stat.st_mtime)
+        with self.lock:
+            listing = self.listings.get(os.path.dirname(remote_path))
+            if listing is not None:
+                listing[os.path.basename(remote_path)] = attr
 
     def format_dest_path(self, path):
         local_path = bytestring_path(self.sftp_config['local_directory'])
@@ -133,13 +340,16 @@ class SftpUploader:
         local = path_as_posix(path)
         dest = local.replace(local_path, dest_path)
         return dest.decode("utf-8")
-    
+
     # from https://stackoverflow.com/a/20422692
     def mkdir_p(self, sftp, remote, is_dir=False):
         """
-        emulates mkdir_p if required. 
+        emulates mkdir_p if required.
         sftp - is a valid sftp object
-        remote - remote path to create. 
+        remote - remote path to create.
+        existence is checked against the cached directory listings rather than
+        a stat per level, and concurrent uploads creating the same directory
+        don't trip over each other
         """
         dirs_ = []
         if is_dir:
@@ -150,12 +360,189 @@ class SftpUploader:
             dirs_.append(dir_)
             dir_, _  = os.path.split(dir_)
 
-        if len(dir_) == 1 and not dir_.startswith("/"): 
-            dirs_.append(dir_) # For a remote path like y/x.txt 
+        if len(dir_) == 1 and not dir_.startswith("/"):
+            dirs_.append(dir_) # For a remote path like y/x.txt
 
         while len(dirs_):
             dir_ = dirs_.pop()
+            if self.listing(dir_, sftp) is not None:
+                continue
             try:
-                sftp.stat(dir_)
-            except:
-                sftp.mkdir(dir_)    
+                sftp.mkdir(dir_)
+            except IOError:
+                sftp.stat(dir_) # created by another worker in the meantime
+            with self.lock:
+                self.listings[dir_] = {}
+
+
+class BackgroundUploader:
+    '''
+    Uploads batches of items on worker threads while the caller keeps going,
+    used to stream files to the remote during an import. The queue is bounded,
+    so put() blocks once too many batches are waiting. The batches in progress
+    share one executor of the uploader's workers threads, so running several
+    at once doesn't multiply the threads waiting on the pool's sessions.
+    '''
+    def __init__(self, uploader, log, workers=2, queue_size=4):
+        self.uploader = uploader
+        self._log = log
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.executor = ThreadPoolExecutor(max_workers=uploader.workers, thread_name_prefix='ndupload-file')
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stats = {'files': 0, 'bytes': 0, 'skipped': 0, 'failed': 0}
+
+    def put(self, items):
+        if not self.threads:
+            for num in range(self.workers):
+                thread = threading.Thread(target=self.run, name=f'ndupload-{num}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(list(items))
+
+    def run(self):
+        while True:
+            items = self.queue.get()
+            files = []
+            try:
+                files = self.uploader.files_for(items)
+                (uploaded, size, skipped) = self.uploader.upload_files(files, quiet=True, executor=self.executor)
+                with self.lock:
+                    self.stats['files'] += uploaded
+                    self.stats['bytes'] += size
+                    self.stats['skipped'] += skipped
+            except UploadFailed as x:
+                self._log.error('Upload failed: {0}', x)
+                with self.lock:
+                    self.stats['failed'] += x.failed
+            except Exception as x:
+                # before any file was sent, the whole batch failed (one file per item if the list itself failed)
+                failed = len(files) or len(items)
+                self._log.error('Upload of {0} files failed: {1}', failed, x)
+                with self.lock:
+                    self.stats['failed'] += failed
+            finally:
+                self.queue.task_done()
+
+    def drain(self):
+        '''waits for everything queued so far, returns and resets the stats'''
+        self.queue.join()
+        with self.lock:
+            stats = self.stats
+            self.reset()
+        return stats
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class UploadJournal:
+    '''
+    Local json record of chunked uploads in progress: remote path => local size,
+    mtime and the chunk layout with a done flag (and sha1 once done) per chunk. Entries go away once
+    the file is complete, so an interrupted run resumes from the last whole chunk.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    def resume(self, remote, size, mtime):
+        '''chunk list to continue with, or None if the file has to start over'''
+        with self.lock:
+            entry = self.entries.get(remote)
+            if entry and entry['size'] == size and entry['mtime'] == mtime:
+                return entry['parts']
+        return None
+
+    def start(self, remote, size, mtime, parts):
+        with self.lock:
+            self.entries[remote] = {'size': size, 'mtime': mtime, 'parts': parts}
+            self.save()
+
+    def part_done(self, remote, num, digest=None):
+        '''marks a chunk sent, with its sha1 for verifying the file once all chunks are'''
+        with self.lock:
+            if remote in self.entries:
+                self.entries[remote]['parts'][num][2:] = [True, digest]
+                self.save()
+
+    def finish(self, remote):
+        with self.lock:
+            if self.entries.pop(remote, None) is not None:
+                self.save()
+
+    def save(self):
+        if not self.path: return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+
+def read_blocks(f, length, block_size, pipeline=1, sha1=None):
+    '''
+    yields the next length bytes of f as memoryviews of at most block_size, updating sha1 with each
+    the buffers are allocated once and reused, a view is only good until the next one is taken
+    pipeline - buffers a reader thread keeps filled ahead, 1 reads each block when it's asked for
+    '''
+    if pipeline <= 1:
+        view = memoryview(bytearray(block_size))
+        while length > 0:
+            n = f.readinto(view[:min(block_size, length)])
+            if not n: break
+            if sha1: sha1.update(view[:n])
+            length -= n
+            yield view[:n]
+        return
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(pipeline):
+        free.put(memoryview(bytearray(block_size)))
+
+    def reader(length):
+        try:
+            while length > 0:
+                view = free.get()
+                if view is None: return # the consumer stopped early
+                n = f.readinto(view[:min(block_size, length)])
+                if not n: break
+                if sha1: sha1.update(view[:n])
+                length -= n
+                full.put((view, n))
+            full.put(None)
+        except Exception as x:
+            full.put(x)
+
+    thread = threading.Thread(target=reader, args=(length,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = full.get()
+            if block is None: return
+            if isinstance(block, Exception): raise block
+            (view, n) = block
+            yield view[:n]
+            free.put(view)
+    finally:
+        free.put(None)
+        thread.join()
+
+
+def file_sha1(f, offset, length, block_size):
+    '''sha1 hex digest of length bytes of the open file f from offset'''
+    sha1 = hashlib.sha1()
+    f.seek(offset)
+    for block in read_blocks(f, length, block_size, sha1=sha1):
+        pass
+    return sha1.hexdigest()
@@ -0,0 +1,271 @@
+'''
+Subsonic API client and API backed sync target (pushtarget: api).
+
+For servers where the Navidrome DB can't be reached at all. Songs are paged
+in with search3 into the same kind of in-memory projection remote-sql uses,
+so matching and pull run unchanged, and a push is turned into API calls:
+multi-id star/unstar in batches, setRating one call per track and, if
+enabled, scrobble batches for missing plays. Calls go out concurrently over
+kept-alive connections (one per worker thread) under a shared rate limit, the
+worker threads and their connections last until the client is closed.
+
+MusicBrainz data and file times can't be written through the API.
+'''
+import json, time, random, sqlite3, hashlib, threading, http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlencode
+from ndmerge import number
+
+API_VERSION = '1.16.1'
+CLIENT_NAME = 'beets-navidrome_sync'
+
+
+class SubsonicError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f'Subsonic API error {code}: {message}')
+        self.code = code
+
+
+class RateLimiter:
+    '''spaces calls at least 1/rate seconds apart across all threads, rate 0 means unlimited'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        if not self.rate: return
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now)
+            delay = self.next - now
+            self.next += 1 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SubsonicClient:
+    def __init__(self, host, username, password, port=443, workers=8, rate=50, timeout=30):
+        url = urlsplit(host if '://' in host else f"{'https' if port == 443 else 'http'}://{host}")
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port or port
+        self.base = url.path.rstrip('/') + '/rest/'
+        self.username = username
+        self.password = password
+        self.workers = workers
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.local = threading.local()
+        self.sent = 0
+        self.received = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.connections = set() # every thread's, for close()
+
+    def connection(self):
+        '''one kept-alive connection per thread'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = self.local.conn = cls(self.host, self.port, timeout=self.timeout)
+            with self.lock:
+                self.connections.add(conn)
+        return conn
+
+    def map(self, fn, values):
+        '''executor.map on the client's worker threads, started on first use and kept (with their connections) until close()'''
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='subsonic')
+        return self.executor.map(fn, values)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        with self.lock:
+            (connections, self.connections) = (self.connections, set())
+        for conn in connections:
+            conn.close()
+
+    def auth(self):
+        salt = '%08x' % random.getrandbits(32)
+        token = hashlib.md5((self.password + salt).encode('utf-8')).hexdigest()
+        return [('u', self.username), ('t', token), ('s', salt), ('v', API_VERSION), ('c', CLIENT_NAME), ('f', 'json')]
+
+    def call(self, endpoint, **params):
+        '''
+        POSTs an API call form encoded, list values become repeated parameters (id=1&id=2)
+        returns the subsonic-response dict, raises SubsonicError if the server reports a failure
+        '''
+        fields = self.auth()
+        for (k, v) in params.items():
+            if isinstance(v, (list, tuple)):
+                fields.extend((k, x) for x in v)
+            else:
+                fields.append((k, v))
+        body = urlencode(fields).encode('utf-8')
+        headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Connection': 'keep-alive'}
+        self.limiter.wait()
+        for attempt in (1, 2):
+            conn = self.connection()
+            try:
+                conn.request('POST', self.base + endpoint, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # stale kept-alive connection, reconnect once
+                conn.close()
+                self.local.conn = None
+                with self.lock:
+                    self.connections.discard(conn)
+                if attempt == 2: raise
+        with self.lock:
+            self.calls += 1
+            self.sent += len(body)
+            self.received += len(data)
+        if response.status != 200:
+            raise SubsonicError(response.status, response.reason)
+        result = json.loads(data)['subsonic-response']
+        if result.get('status') != 'ok':
+            error = result.get('error', {})
+            raise SubsonicError(error.get('code'), error.get('message'))
+        return result
+
+    def ping(self):
+        return self.call('ping')
+
+    def songs(self, page_size=500):
+        '''
+        every song on the server via search3 with an empty query, pages are
+        requested `workers` at a time until one comes back short
+        '''
+        offset = 0
+        while True:
+            pages = self.map(lambda o: self.call('search3', query='', artistCount=0, albumCount=0,
+                                                 songCount=page_size, songOffset=o)
+                             .get('searchResult3', {}).get('song', []),
+                             range(offset, offset + page_size * self.workers, page_size))
+            for page in pages:
+                yield from page
+                if len(page) < page_size:
+                    return
+            offset += page_size * self.workers
+
+    def batched(self, endpoint, key, values, batch, **params):
+        '''multi-id calls, batch ids at a time, run concurrently'''
+        chunks = [values[i:i + batch] for i in range(0, len(values), batch)]
+        list(self.map(lambda c: self.call(endpoint, **{key: c}, **params), chunks))
+        return len(chunks)
+
+    def star(self, ids, batch=200):
+        return self.batched('star', 'id', ids, batch)
+
+    def unstar(self, ids, batch=200):
+        return self.batched('unstar', 'id', ids, batch)
+
+    def set_ratings(self, ratings):
+        '''ratings - dict of id => 0-5, setRating only takes one id per call'''
+        list(self.map(lambda r: self.call('setRating', id=r[0], rating=r[1]), ratings.items()))
+        return len(ratings)
+
+    def scrobble(self, ids, batch=200):
+        '''registers one play per id (ids can repeat), stamped a second apart ending now'''
+        now = int(time.time() * 1000)
+        plays = [(id, now - (len(ids) - n) * 1000) for (n, id) in enumerate(ids)]
+        chunks = [plays[i:i + batch] for i in range(0, len(plays), batch)]
+        list(self.map(lambda c: self.call('scrobble', id=[p[0] for p in c], time=[p[1] for p in c],
+                                          submission='true'), chunks))
+        return len(chunks)
+
+
+class ApiTarget:
+    '''in-memory projection of the server's songs and annotations, pushes are applied as API calls'''
+    name = 'api'
+
+    def __init__(self, client, user_name, batch=200, page_size=500, scrobble=False, log=None):
+        self.client = client
+        self.user_name = user_name
+        self.batch = batch
+        self.page_size = page_size
+        self.scrobble = scrobble
+        self._log = log
+
+    def projection(self):
+        '''
+        same tables the DB targets are read from, filled from search3
+        returns (conn, cur)
+        '''
+        conn = sqlite3.connect(':memory:')
+        cur = conn.cursor()
+        cur.executescript('''
+            CREATE TABLE user (id TEXT PRIMARY KEY, user_name TEXT);
+            CREATE TABLE media_file (id, path, artist, album_artist, album, title, mbz_recording_id,
+                                     album_id, full_text, updated_at);
+            CREATE TABLE annotation (user_id TEXT, item_id TEXT, item_type TEXT, play_count INTEGER, rating INTEGER,
+                                     starred INTEGER, starred_at TEXT, play_date TEXT,
+                                     UNIQUE (user_id, item_id, item_type));''')
+        cur.execute('INSERT INTO user VALUES (?, ?)', (self.client.username, self.user_name))
+        files = []
+        annotations = []
+        for song in self.client.songs(self.page_size):
+            files.append((song['id'], song.get('path'), song.get('artist'), song.get('displayAlbumArtist') or song.get('artist'),
+                          song.get('album'), song.get('title'), song.get('musicBrainzId'), song.get('albumId'),
+                          ' '.join(filter(None, (song.get('title'), song.get('album'), song.get('artist')))).lower(),
+                          song.get('created')))
+            if song.get('playCount') or song.get('userRating') or song.get('starred'):
+                annotations.append((self.client.username, song['id'], 'media_file', song.get('playCount', 0),
+                                    song.get('userRating', 0), 1 if song.get('starred') else 0, song.get('starred')))
+            if len(files) >= 10000:
+                self.insert(cur, files, annotations)
+        self.insert(cur, files, annotations)
+        conn.commit()
+        return (conn, cur)
+
+    def insert(self, cur, files, annotations):
+        cur.executemany('INSERT INTO media_file VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', files)
+        cur.executemany('INSERT INTO annotation (user_id, item_id, item_type, play_count, rating, starred, starred_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        annotations)
+        del files[:]
+        del annotations[:]
+
+    def apply(self, writer, cur):
+        '''
+        turns the writer's annotations into API calls for whatever differs from the server
+        returns (tracks changed, bytes sent)
+        '''
+        if (writer.mbids or writer.times) and self._log:
+            self._log.info('MusicBrainz data and file times can\'t be written through the Subsonic API, skipping them')
+        current = {r[0]: r[1:] for r in cur.execute('''SELECT item_id, play_count, rating, starred FROM annotation
+                                                       WHERE item_type = 'media_file' ''')}
+        (stars, unstars, ratings, plays) = ([], [], {}, [])
+        changed = set()
+        for ((user_id, id), a) in writer.annotations.items():
+            if user_id != self.client.username: continue # the API only acts as the logged in user
+            (play_count, rating, starred) = current.get(id, (0, 0, 0))
+            if 'starred' in writer.fields and bool(a['starred']) != bool(starred):
+                (stars if a['starred'] else unstars).append(id)
+                changed.add(id)
+            new_rating = max(0, min(5, number(a['rating'])))
+            if 'rating' in writer.fields and new_rating != number(rating):
+                ratings[id] = new_rating
+                changed.add(id)
+            missing = number(a['play_count']) - number(play_count)
+            if 'play_count' in writer.fields and self.scrobble and missing > 0:
+                plays.extend([id] * missing)
+                changed.add(id)
+        sent = self.client.sent
+        self.client.star(stars, self.batch)
+        self.client.unstar(unstars, self.batch)
+        self.client.set_ratings(ratings)
+        self.client.scrobble(plays, self.batch)
+        if self._log:
+            self._log.info('API: {0} starred, {1} unstarred, {2} ratings, {3} plays scrobbled',
+                           len(stars), len(unstars), len(ratings), len(plays))
+        return (len(changed), self.client.sent - sent)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,409 @@
+'''
+Benchmarks for push, pull, fuzzy matching and uploads, runs fully offline.
+
+Synthetic data comes from generate.py and is cached under --work per
+(size, seed), uploads go to the local SFTP stand-in from sftpserver.py. Each
+case runs in its own python process so peak RSS is per case, the working
+copies of the DBs are fresh for every run.
+
+    python benchmarks/bench.py                          # 10k and 100k, all cases
+    python benchmarks/bench.py --sizes 1000000 --cases push,pull
+    python benchmarks/bench.py --out bench_output.txt   # also append JSON lines
+
+Cases:
+    push      - nd_push_annotations over the whole library (default ndpush options)
+    push-time - the same with --time
+    push-sql  - nd_push_sql, the same push with --engine sql
+    push-mapped - a second push once the first saved the item mapping (steady state)
+    push-apply - applying a push planned with --plan, i.e. how long the DB is written to
+    api-push  - ndpush with pushtarget: api against the mock Subsonic server in subsonicserver.py
+    pull      - nd_pull, i.e. reading Navidrome and process_navidrome_annotations
+    sync      - nd_merge, a first ndsync over the whole library, fails if it changes the
+                beets rating of any track Navidrome has no rating for
+    fuzzy     - building the full_text index and fuzzy_search for --fuzzy-queries needles
+    upload    - SftpUploader.upload_files of --upload-mb over --upload-files files,
+                then the same again to time the skip-unchanged pass
+    import    - importing the plugin and creating it, what every beet command pays, in
+                --import-runs fresh interpreters (median), and whether any of the
+                transfer modules it should only load on demand got loaded
+'''
+import os, sys, json, time, shutil, random, logging, argparse, resource, subprocess, tempfile, sqlite3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.join(os.path.dirname(HERE), 'beetsplug')
+MUSIC_DIR = '/bench/music'
+CASES = ('push', 'push-time', 'push-sql', 'push-mapped', 'push-apply', 'api-push', 'pull', 'sync', 'fuzzy', 'upload', 'import')
+NO_DATA = ('upload', 'import') # cases that don't use the generated DBs
+DATA_VERSION = '2' # bump when generate.py changes what it writes, cached data from before is regenerated
+# what the plugin only imports when a command or auto upload needs it
+ON_DEMAND_MODULES = ('paramiko', 'cryptography', 'tqdm', 'ssl', 'http.client', 'sftpuploader', 'sftppool', 'subsonic')
+IMPORT_PROBE = '''
+import sys, time, json
+sys.path.insert(0, {plugin_dir!r})
+import beets.plugins, beets.library, beets.ui
+from beets import config
+config.read(user=False, defaults=True)
+started = time.perf_counter()
+import navidrome_sync
+navidrome_sync.NavidromeSyncPlugin()
+seconds = time.perf_counter() - started
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {modules!r} if m in sys.modules]}}))
+'''
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def fresh_copy(src, work):
+    dst = os.path.join(work, 'run-' + os.path.basename(src))
+    shutil.copyfile(src, dst)
+    return dst
+
+def load_plugin(work, nd_path):
+    '''sets up a throwaway beets config and returns a NavidromeSyncPlugin using it'''
+    sys.path.insert(0, PLUGIN_DIR) # the plugin modules import each other by bare name
+    from beets import config
+    config.clear()
+    config.read(user=False, defaults=True)
+    config['directory'] = MUSIC_DIR
+    config['navidrome_sync'].set({
+        'dbuser': 'admin',
+        'dbpath': nd_path,
+        'temp_path': os.path.join(work, 'temp.db'),
+        'ledger_path': os.path.join(work, 'ledger.db'),
+    })
+    import navidrome_sync
+    plugin = navidrome_sync.NavidromeSyncPlugin()
+    plugin.start_metrics()
+    return plugin
+
+def command_opts(plugin, name, args=()):
+    '''parses args with the real subcommand's parser so new options get their defaults'''
+    command = next(c for c in plugin.commands() if c.name == name)
+    return command.parser.parse_args(list(args))[0]
+
+
+def run_push(data, work, args, time_flag=False, engine='python', mapped=False):
+    from beets.library import Library
+    nd_path = fresh_copy(os.path.join(data, 'navidrome.db'), work)
+    plugin = load_plugin(work, nd_path)
+    lib = Library(os.path.join(data, 'library.db'), MUSIC_DIR)
+    opts = command_opts(plugin, 'ndpush', ['-t'] if time_flag else [])
+    target = None
+    if mapped:
+        target = plugin.ledger_key('get_local_db')
+        plugin.open_ledger().forget(target)
+        push_once(plugin, lib, opts, engine, target) # saves the mapping, not timed
+        plugin.start_metrics()
+    base = peak_rss_mb()
+    started = time.perf_counter()
+    push_once(plugin, lib, opts, engine, target)
+    seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'items': len(lib.items()), 'base_rss_mb': base, 'metrics': plugin.metrics.report()}
+
+def push_once(plugin, lib, opts, engine, target=None):
+    (conn, cur) = plugin.get_local_db()
+    if engine == 'sql':
+        plugin.nd_push_sql(conn, cur, lib, [], opts, target)
+    else:
+        plugin.nd_push_annotations(conn, cur, lib.items(), opts, target)
+    conn.commit()
+    conn.close()
+
+def run_push_apply(data, work, args):
+    from beets.library import Library
+    nd_path = fresh_copy(os.path.join(data, 'navidrome.db'), work)
+    plugin = load_plugin(work, nd_path)
+    lib = Library(os.path.join(data, 'library.db'), MUSIC_DIR)
+    plan_path = os.path.join(work, 'plan.jsonl')
+    (conn, cur) = plugin.get_local_db('plan')
+    plugin.nd_push_annotations(conn, cur, lib.items(), command_opts(plugin, 'ndpush', ['--plan', plan_path])) # not timed
+    conn.close()
+    plugin.start_metrics()
+    base = peak_rss_mb()
+    started = time.perf_counter()
+    (conn, cur) = plugin.get_local_db()
+    plugin.nd_apply(conn, plan_path, None)
+    conn.close()
+    seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'items': len(lib.items()), 'base_rss_mb': base, 'metrics': plugin.metrics.report()}
+
+def run_api_push(data, work, args):
+    import builtins
+    from beets.library import Library
+    from subsonicserver import MockSubsonic
+    builtins.input = lambda *a: '' # nd_sync asks for confirmation
+    server = MockSubsonic(fresh_copy(os.path.join(data, 'navidrome.db'), work))
+    plugin = load_plugin(work, '')
+    from beets import config
+    config['navidrome_sync']['pushtarget'] = 'api'
+    config['navidrome_sync']['navidrome'].set({'host': f'http://127.0.0.1:{server.port}', 'username': 'admin',
+                                               'password': 'bench', 'rate': 0})
+    lib = Library(os.path.join(data, 'library.db'), MUSIC_DIR)
+    opts = command_opts(plugin, 'ndpush')
+    base = peak_rss_mb()
+    started = time.perf_counter()
+    plugin.nd_sync('push', lib, opts, [])
+    seconds = time.perf_counter() - started
+    server.close()
+    return {'seconds': seconds, 'items': len(lib.items()), 'base_rss_mb': base, 'requests': server.requests,
+            'metrics': plugin.metrics.report()}
+
+def run_pull(data, work, args):
+    import builtins
+    from beets.library import Library
+    builtins.input = lambda *a: '' # process_navidrome_annotations asks for confirmation
+    nd_path = os.path.join(data, 'navidrome.db')
+    plugin = load_plugin(work, nd_path)
+    lib = Library(fresh_copy(os.path.join(data, 'library.db'), work), MUSIC_DIR)
+    base = peak_rss_mb()
+    started = time.perf_counter()
+    (conn, cur) = plugin.get_local_db()
+    plugin.nd_pull(lib, conn, cur)
+    conn.close()
+    seconds = time.perf_counter() - started
+    items = sqlite3.connect(nd_path).execute('SELECT count(*) FROM media_file').fetchone()[0]
+    return {'seconds': seconds, 'items': items, 'base_rss_mb': base, 'metrics': plugin.metrics.report()}
+
+def run_sync(data, work, args):
+    from beets.library import Library
+    if os.path.exists(os.path.join(work, 'ledger.db')):
+        os.remove(os.path.join(work, 'ledger.db')) # a first sync, no saved matches or stars from the last run
+    nd_path = fresh_copy(os.path.join(data, 'navidrome.db'), work)
+    plugin = load_plugin(work, nd_path)
+    lib = Library(fresh_copy(os.path.join(data, 'library.db'), work), MUSIC_DIR)
+    base = peak_rss_mb()
+    started = time.perf_counter()
+    (conn, cur) = plugin.get_local_db()
+    target = plugin.ledger_key('get_local_db')
+    before = item_ratings(lib.path)
+    plugin.nd_merge(conn, cur, lib, lib.items(), command_opts(plugin, 'ndsync'), target)
+    conn.close()
+    seconds = time.perf_counter() - started
+    lowered = ratings_lowered(before, item_ratings(lib.path), os.path.join(data, 'navidrome.db'), plugin.open_ledger().mapping(target))
+    if lowered:
+        raise AssertionError(f'ndsync changed {len(lowered)} beets ratings of tracks unrated in Navidrome, e.g. {lowered[:5]}')
+    return {'seconds': seconds, 'items': len(lib.items()), 'base_rss_mb': base, 'metrics': plugin.metrics.report()}
+
+def item_ratings(library_path):
+    '''beets item id => rating flex field, as a number'''
+    from ndmerge import number
+    conn = sqlite3.connect(os.fsdecode(library_path))
+    try:
+        return {i: number(v) for (i, v) in conn.execute("SELECT entity_id, value FROM item_attributes WHERE key = 'rating'")}
+    finally:
+        conn.close()
+
+def ratings_lowered(before, after, nd_path, mapping):
+    '''(item id, before, after) of rated items whose rating a sync changed although their track was unrated in Navidrome'''
+    conn = sqlite3.connect(nd_path)
+    try:
+        rated = {r[0] for r in conn.execute("SELECT item_id FROM annotation WHERE item_type = 'media_file' AND rating > 0")}
+    finally:
+        conn.close()
+    return [(i, r, after.get(i, 0)) for (i, r) in sorted(before.items())
+            if r and i in mapping and mapping[i][0] not in rated and after.get(i, 0) != r]
+
+def run_fuzzy(data, work, args):
+    from beets.library import Library
+    nd_path = os.path.join(data, 'navidrome.db')
+    plugin = load_plugin(work, nd_path)
+    from ndmatch import FullTextIndex
+    lib = Library(os.path.join(data, 'library.db'), MUSIC_DIR)
+    items = list(lib.items())
+    rnd = random.Random(args.seed)
+    needles = [[i.artist, i.albumartist, i.album, i.title] for i in rnd.sample(items, min(args.fuzzy_queries, len(items)))]
+    del items
+    base = peak_rss_mb()
+    (conn, cur) = plugin.get_local_db()
+    started = time.perf_counter()
+    index = FullTextIndex(cur)
+    built = time.perf_counter()
+    hits = sum(1 for n in needles if plugin.fuzzy_search(n, cur, index)[0])
+    seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'items': len(needles), 'base_rss_mb': base,
+            'index_build_seconds': built - started, 'search_seconds': seconds - (built - started), 'hits': hits}
+
+def run_upload(data, work, args):
+    from sftpserver import StandInServer
+    sys.path.insert(0, PLUGIN_DIR)
+    from sftppool import SftpPool
+    from sftpuploader import SftpUploader
+    from ndstats import Metrics
+    src = os.path.join(work, 'upload-src')
+    dst = os.path.join(work, 'upload-dst')
+    files = make_upload_files(src, args.upload_files, args.upload_mb * 1024 * 1024, args.seed)
+    shutil.rmtree(dst, ignore_errors=True)
+    journal = os.path.join(work, 'upload-journal.json')
+    if os.path.exists(journal): os.remove(journal)
+    server = StandInServer()
+    cfg = server.config(dst + '/', local_directory=src, journal=journal)
+    pool = SftpPool(cfg, args.connections, args.channels)
+    uploader = SftpUploader(cfg, logging.getLogger('bench'), pool)
+    uploader.metrics = Metrics()
+    jobs = [(f, os.path.join(dst, os.path.relpath(f, src))) for f in files]
+    base = peak_rss_mb()
+    started = time.perf_counter()
+    (count, size, _) = uploader.upload_files(jobs, quiet=True)
+    seconds = time.perf_counter() - started
+    rerun = time.perf_counter()
+    skipped = SftpUploader(cfg, logging.getLogger('bench'), pool).upload_files(jobs, quiet=True)[2]
+    rerun = time.perf_counter() - rerun
+    pool.close()
+    server.close()
+    return {'seconds': seconds, 'items': count, 'bytes': size, 'bytes_per_second': size / seconds, 'base_rss_mb': base,
+            'skip_pass_seconds': rerun, 'skipped': skipped, 'handshakes': server.handshakes,
+            'metrics': uploader.metrics.report()}
+
+def make_upload_files(src, count, total, seed):
+    '''a mix of track sized files and a few big ones, roughly what an album with a hi-res bonus disc looks like'''
+    rnd = random.Random(seed)
+    weights = [rnd.choice((1, 1, 1, 2, 3, 12)) for _ in range(count)]
+    sizes = [total * w // sum(weights) for w in weights]
+    files = []
+    block = os.urandom(1024 * 1024)
+    for (num, size) in enumerate(sizes):
+        path = os.path.join(src, f'disc{num % 3}', f'{num:03d} track.flac')
+        files.append(path)
+        if os.path.exists(path) and os.path.getsize(path) == size: continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for offset in range(0, size, len(block)):
+                f.write(block[:size - offset])
+    return files
+
+def run_import(data, work, args):
+    probe = IMPORT_PROBE.format(plugin_dir=PLUGIN_DIR, modules=ON_DEMAND_MODULES)
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None) # bytecode cached like in a normal install, the first run writes it
+    runs = []
+    for n in range(args.import_runs + 1):
+        out = subprocess.run([sys.executable, '-c', probe], env=env, cwd=work, check=True, capture_output=True).stdout
+        runs.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    seconds = sorted(r['seconds'] for r in runs[1:])[len(runs[1:]) // 2]
+    return {'seconds': seconds, 'items': 1, 'base_rss_mb': peak_rss_mb(), 'runs': args.import_runs, 'loaded': runs[-1]['loaded']}
+
+RUNNERS = {
+    'push': run_push,
+    'push-time': lambda data, work, args: run_push(data, work, args, time_flag=True),
+    'push-sql': lambda data, work, args: run_push(data, work, args, engine='sql'),
+    'push-mapped': lambda data, work, args: run_push(data, work, args, mapped=True),
+    'push-apply': run_push_apply,
+    'api-push': run_api_push,
+    'pull': run_pull,
+    'sync': run_sync,
+    'fuzzy': run_fuzzy,
+    'upload': run_upload,
+    'import': run_import,
+}
+
+
+def ensure_data(work, size, seed):
+    '''generates the synthetic DBs for a size once, later runs reuse them'''
+    from generate import make_navidrome_db, make_beets_library
+    data = os.path.join(work, f'{size}-{seed}')
+    done = os.path.join(data, 'complete')
+    if not os.path.exists(done) or open(done).read() != DATA_VERSION:
+        os.makedirs(data, exist_ok=True)
+        print(f'Generating {size} tracks in {data}...', flush=True)
+        started = time.perf_counter()
+        make_navidrome_db(os.path.join(data, 'navidrome.db'), size, seed)
+        make_beets_library(os.path.join(data, 'library.db'), size, seed)
+        with open(done, 'w') as f:
+            f.write(DATA_VERSION)
+        print(f'  done in {time.perf_counter() - started:.1f}s', flush=True)
+    return data
+
+def run_case(case, size, data, args):
+    '''runs one case in a child process and returns its result dict'''
+    work = os.path.join(args.work, 'runs', f'{case}-{size}')
+    os.makedirs(work, exist_ok=True)
+    result = os.path.join(work, 'result.json')
+    if os.path.exists(result): os.remove(result)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', case, '--data', data or '', '--run-dir', work,
+           '--work', args.work, '--seed', str(args.seed), '--fuzzy-queries', str(args.fuzzy_queries),
+           '--upload-files', str(args.upload_files), '--upload-mb', str(args.upload_mb),
+           '--connections', str(args.connections), '--channels', str(args.channels), '--import-runs', str(args.import_runs)]
+    out = None if args.verbose else subprocess.DEVNULL
+    proc = subprocess.run(cmd, stdout=out, stderr=None if args.verbose else subprocess.PIPE)
+    if proc.returncode != 0 or not os.path.exists(result):
+        return {'case': case, 'size': size, 'error': (proc.stderr or b'').decode('utf-8', 'replace').strip()[-2000:]}
+    with open(result, encoding='utf-8') as f:
+        return dict(json.load(f), case=case, size=size)
+
+def child(args):
+    sys.path.insert(0, HERE)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('beets').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    result = RUNNERS[args.child](args.data, args.run_dir, args)
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['throughput'] = result['items'] / result['seconds'] if result['seconds'] else None
+    with open(os.path.join(args.run_dir, 'result.json'), 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+def print_result(r):
+    if 'error' in r:
+        print(f"{r['case']:<10} {r['size']:>9}  FAILED\n{r['error']}")
+        return
+    extra = ''
+    if r['case'] == 'fuzzy':
+        extra = f"index {r['index_build_seconds']:.2f}s, {r['hits']}/{r['items']} hits"
+    elif r['case'] == 'api-push':
+        extra = f"{sum(r['requests'].values())} API calls"
+    elif r['case'] == 'upload':
+        extra = f"{r['bytes_per_second'] / 1024 / 1024:.1f} MB/s, skip pass {r['skip_pass_seconds']:.2f}s, {r['handshakes']} handshakes"
+    elif r['case'] == 'import':
+        extra = f"median of {r['runs']}, " + (f"loaded {', '.join(r['loaded'])}" if r['loaded'] else 'no transfer modules loaded')
+    print(f"{r['case']:<10} {r['size']:>9} {r['seconds']:>9.2f}s {r['throughput']:>12.0f}/s "
+          f"{r['peak_rss_mb']:>8.0f} MB {r['peak_rss_mb'] - r['base_rss_mb']:>8.0f} MB  {extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the navidrome_sync plugin')
+    parser.add_argument('--sizes', default='10000,100000', help='comma separated track counts (default 10000,100000)')
+    parser.add_argument('--cases', default=','.join(CASES), help=f'comma separated, any of {", ".join(CASES)}')
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'navidrome_sync_bench'),
+                        help='where generated data and working copies live')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fuzzy-queries', type=int, default=1000)
+    parser.add_argument('--upload-files', type=int, default=40)
+    parser.add_argument('--upload-mb', type=int, default=256)
+    parser.add_argument('--connections', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--import-runs', type=int, default=20)
+    parser.add_argument('--out', help='append results as JSON lines to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the plugin output of each run')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    parser.add_argument('--run-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    sys.path.insert(0, HERE)
+    cases = [c.strip() for c in args.cases.split(',') if c.strip()]
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error(f'unknown case(s): {", ".join(sorted(unknown))}')
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    results = []
+    print(f"{'case':<10} {'size':>9} {'time':>10} {'throughput':>14} {'peak RSS':>11} {'case RSS':>11}")
+    for case in NO_DATA:
+        if case in cases:
+            results.append(run_case(case, 0, None, args))
+            print_result(results[-1])
+    for size in sizes:
+        data = None
+        for case in cases:
+            if case in NO_DATA: continue
+            data = data or ensure_data(args.work, size, args.seed)
+            results.append(run_case(case, size, data, args))
+            print_result(results[-1])
+    if args.out:
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with open(args.out, 'a', encoding='utf-8') as f:
+            for r in results:
+                f.write(json.dumps(dict(r, timestamp=stamp)) + '\n')
+
+if __name__ == '__main__':
+    main()
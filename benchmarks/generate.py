@@ -0,0 +1,219 @@
+'''
+Synthetic Navidrome DB and beets library generators for the benchmarks.
+
+make_navidrome_db builds a navidrome.db with the user, album, media_file and
+annotation tables the plugin reads, with Navidrome style paths, MBIDs and
+full_text. make_beets_library builds a beets library.db holding the same
+tracks, with controlled fractions of them changed so every match rule gets
+exercised:
+
+    mbid     - share the MusicBrainz recording id with their media_file
+    moved    - live under a different folder layout (path rule misses)
+    retagged - title tagged differently as well (only fuzzy can find these)
+    missing  - aren't in Navidrome at all
+    extra    - Navidrome tracks that aren't in beets (misses for ndpull)
+
+Everything is derived from a seeded Random, so a (size, seed, ratios) tuple
+always produces the same files.
+
+    python benchmarks/generate.py OUT_DIR 100000
+'''
+import os, glob, random, sqlite3, uuid, argparse
+
+WORDS = ('love', 'night', 'river', 'fire', 'dream', 'heart', 'blue', 'city', 'light', 'rain', 'gold', 'shadow',
+         'summer', 'ghost', 'road', 'sun', 'wild', 'echo', 'stone', 'winter', 'silver', 'ocean', 'midnight', 'glass',
+         'electric', 'paper', 'velvet', 'northern', 'broken', 'falling', 'dancing', 'lost', 'young', 'golden',
+         'crystal', 'secret', 'paradise', 'thunder', 'machine', 'garden', 'mirror', 'season', 'holy', 'sweet',
+         'café', 'déjà', 'über', 'señor', 'naïve', "don't", "rock'n'roll", 'l’amour', 'noël')
+
+RATIOS = {'mbid': 0.6, 'moved': 0.1, 'retagged': 0.03, 'missing': 0.02, 'extra': 0.01}
+
+NAVIDROME_SCHEMA = '''
+CREATE TABLE user (id varchar(255) PRIMARY KEY, user_name varchar(255) UNIQUE, name varchar(255), is_admin bool);
+CREATE TABLE album (id varchar(255) PRIMARY KEY, name varchar(255), artist varchar(255), album_artist varchar(255),
+                    mbz_album_id varchar(255), full_text varchar(255), created_at datetime, updated_at datetime);
+CREATE TABLE media_file (id varchar(255) PRIMARY KEY, path varchar(255), title varchar(255), album varchar(255),
+                         artist varchar(255), album_artist varchar(255), album_id varchar(255), track_number integer,
+                         year integer, size integer, suffix varchar(255), full_text varchar(255),
+                         mbz_recording_id varchar(255), mbz_album_id varchar(255), mbz_artist_id varchar(255),
+                         mbz_album_artist_id varchar(255), mbz_album_type varchar(255), mbz_release_track_id varchar(255),
+                         created_at datetime, updated_at datetime);
+CREATE INDEX media_file_path ON media_file (path);
+CREATE INDEX media_file_album_id ON media_file (album_id);
+CREATE TABLE annotation (ann_id varchar(255) PRIMARY KEY, user_id varchar(255), item_id varchar(255),
+                         item_type varchar(255), play_count integer DEFAULT 0, play_date datetime, rating integer DEFAULT 0,
+                         starred bool DEFAULT FALSE, starred_at datetime, UNIQUE (user_id, item_id, item_type));
+'''
+
+USERS = (('u-admin', 'admin'), ('u-guest', 'guest'))
+
+
+def rand_id(rnd):
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+def full_text(*values):
+    '''same shape as Navidrome's: unique lowercase words without punctuation, sorted, with a leading space'''
+    words = set()
+    for v in values:
+        words.update(''.join(c if c.isalnum() else ' ' for c in v.lower()).split())
+    return ' ' + ' '.join(sorted(words))
+
+def tracks(n, seed=1):
+    '''
+    yields n track dicts grouped into albums of 8-15 tracks
+    each artist gets a few albums, titles are 1-4 words from a small vocabulary
+    so artist/title collisions and fuzzy candidates happen as they do in real libraries
+    '''
+    rnd = random.Random(seed)
+    num = 0
+    while num < n:
+        artist = ' '.join(w.capitalize() for w in rnd.sample(WORDS, rnd.randint(1, 3)))
+        artist_mbid = rand_id(rnd)
+        for _ in range(rnd.randint(1, 5)):
+            album = ' '.join(w.capitalize() for w in rnd.sample(WORDS, rnd.randint(1, 3)))
+            album_mbid = rand_id(rnd)
+            year = rnd.randint(1960, 2024)
+            album_id = rand_id(rnd)
+            albumtype = rnd.choice(('album', 'album', 'album', 'ep', 'single', 'compilation'))
+            for track in range(1, rnd.randint(8, 15) + 1):
+                if num >= n: return
+                title = ' '.join(rnd.sample(WORDS, rnd.randint(1, 4))).capitalize()
+                yield {
+                    'num': num, 'id': rand_id(rnd), 'artist': artist, 'album': album, 'title': title,
+                    'year': year, 'track': track, 'album_id': album_id, 'albumtype': albumtype,
+                    'mb_trackid': rand_id(rnd), 'mb_albumid': album_mbid, 'mb_artistid': artist_mbid,
+                    'mb_releasetrackid': rand_id(rnd), 'size': rnd.randint(3, 60) * 1024 * 1024,
+                    'path': f'{artist}/{album} ({year})/{track:02d} {title}.flac',
+                    'roll': rnd.random(), 'roll_mbid': rnd.random(),
+                }
+                num += 1
+
+def category(track, ratios):
+    '''which of the mismatch groups a track falls in, the groups are disjoint slices of [0, 1)'''
+    edge = 0
+    for name in ('extra', 'missing', 'retagged', 'moved'):
+        edge += ratios[name]
+        if track['roll'] < edge:
+            return name
+    return 'exact'
+
+def make_navidrome_db(path, n, seed=1, ratios=RATIOS, music_dir='/music'):
+    if os.path.exists(path): os.remove(path)
+    rnd = random.Random(seed + 1)
+    conn = sqlite3.connect(path)
+    conn.executescript(NAVIDROME_SCHEMA)
+    conn.executemany('INSERT INTO user VALUES (?, ?, ?, 1)', ((i, u, u.capitalize()) for (i, u) in USERS))
+    albums = {}
+    album_ids = []
+    files = []
+    annotations = []
+    now = '2024-01-01 00:00:00'
+    for t in tracks(n, seed):
+        if category(t, ratios) == 'missing':
+            continue
+        if t['album_id'] not in albums:
+            if t['track'] == 1: album_ids.append(t['album_id'])
+            albums[t['album_id']] = (t['album_id'], t['album'], t['artist'], t['artist'], t['mb_albumid'],
+                                     full_text(t['album'], t['artist']), now, now)
+        files.append((t['id'], f"{music_dir}/{t['path']}", t['title'], t['album'], t['artist'], t['artist'], t['album_id'],
+                      t['track'], t['year'], t['size'], 'flac', full_text(t['title'], t['album'], t['artist']),
+                      t['mb_trackid'], t['mb_albumid'], t['mb_artistid'], t['mb_artistid'], t['albumtype'],
+                      t['mb_releasetrackid'], now, now))
+        for (user_id, _) in USERS:
+            if rnd.random() < 0.3:
+                starred = rnd.random() < 0.15
+                annotations.append((rand_id(rnd), user_id, t['id'], 'media_file', rnd.randint(1, 200), now,
+                                    rnd.randint(0, 5), starred, now if starred else None))
+        if len(files) >= 10000:
+            write_rows(conn, albums, files, annotations)
+    write_rows(conn, albums, files, annotations)
+    for album_id in album_ids[::7]:
+        annotations.append((rand_id(rnd), USERS[0][0], album_id, 'album', rnd.randint(1, 50), now, 0, False, None))
+    write_rows(conn, {}, [], annotations)
+    conn.close()
+
+def write_rows(conn, albums, files, annotations):
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO album VALUES (?, ?, ?, ?, ?, ?, ?, ?)', albums.values())
+        conn.executemany(f'INSERT INTO media_file VALUES ({", ".join("?" * 20)})', files)
+        conn.executemany('INSERT INTO annotation VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', annotations)
+    albums.clear()
+    del files[:]
+    del annotations[:]
+
+def make_beets_library(path, n, seed=1, ratios=RATIOS, music_dir='/bench/music'):
+    '''
+    writes the items table directly instead of going through Item.add, which
+    would take hours at 1M items; the schema still comes from beets itself,
+    and paths are stored relative to music_dir with / separators like beets stores them
+    '''
+    from beets.library import Library, Item
+    if os.path.exists(path): os.remove(path)
+    Library(path, music_dir)._close()
+    for backup in glob.glob(glob.escape(path) + '-before-*.bak'): # beets backs up the empty DB before each migration
+        os.remove(backup)
+    rnd = random.Random(seed + 2)
+    base = {k: t.to_sql(t.null) for (k, t) in Item._fields.items()}
+    columns = list(base)
+    rows = []
+    flex = []
+    written = 0
+    conn = sqlite3.connect(path)
+    for t in tracks(n, seed):
+        kind = category(t, ratios)
+        if kind == 'extra':
+            continue
+        item = dict(base)
+        rel = t['path']
+        title = t['title']
+        if kind in ('moved', 'retagged'):
+            rel = f"{t['artist']}/{t['year']} - {t['album']}/{t['track']:02d} - {title}.flac"
+        if kind == 'retagged':
+            title = f'{title} (Remastered {t["year"] + 20})'
+        if kind == 'missing':
+            rel = f"New/{t['artist']}/{t['album']}/{t['track']:02d} {title}.flac"
+        item.update({
+            'id': len(rows) + written + 1,
+            'path': rel.encode('utf-8'), 'title': title, 'artist': t['artist'],
+            'albumartist': t['artist'], 'album': t['album'], 'year': t['year'], 'track': t['track'],
+            'albumtype': t['albumtype'], 'mtime': 1500000000 + t['num'], 'added': 1500000000 + t['num'],
+            'mb_trackid': t['mb_trackid'] if t['roll_mbid'] < ratios['mbid'] else '',
+            'mb_albumid': t['mb_albumid'], 'mb_artistid': t['mb_artistid'],
+            'mb_albumartistid': t['mb_artistid'], 'mb_releasetrackid': t['mb_releasetrackid'],
+            'format': 'FLAC', 'bitrate': 1000000, 'length': rnd.randint(120, 420),
+        })
+        rows.append(tuple(item[k] for k in columns))
+        if rnd.random() < 0.2:
+            flex.append((item['id'], 'play_count', str(rnd.randint(1, 300))))
+            flex.append((item['id'], 'rating', str(rnd.randint(0, 5))))
+            flex.append((item['id'], 'starred', 'True' if rnd.random() < 0.2 else 'False'))
+        if len(rows) >= 10000:
+            written += write_items(conn, columns, rows, flex)
+    write_items(conn, columns, rows, flex)
+    conn.close()
+
+def write_items(conn, columns, rows, flex):
+    count = len(rows)
+    with conn:
+        conn.executemany(f'INSERT INTO items ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+        conn.executemany('INSERT INTO item_attributes (entity_id, key, value) VALUES (?, ?, ?)', flex)
+    del rows[:]
+    del flex[:]
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic navidrome.db and matching beets library.db')
+    parser.add_argument('out_dir')
+    parser.add_argument('size', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    for (k, v) in RATIOS.items():
+        parser.add_argument(f'--{k}', type=float, default=v, help=f'fraction of tracks that are {k} (default {v})')
+    args = parser.parse_args()
+    ratios = {k: getattr(args, k) for k in RATIOS}
+    os.makedirs(args.out_dir, exist_ok=True)
+    make_navidrome_db(os.path.join(args.out_dir, 'navidrome.db'), args.size, args.seed, ratios)
+    make_beets_library(os.path.join(args.out_dir, 'library.db'), args.size, args.seed, ratios)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+'''
+Local SSH/SFTP server stand-in for the benchmarks, built on paramiko.
+
+Accepts any username/password on 127.0.0.1, serves the local filesystem
+over SFTP and runs exec requests through the shell (stdin is forwarded), so
+the uploader, the pooled DB transfer and remote sha1sum checks can all be
+timed without a real server. Counts SSH handshakes so pooling can be checked.
+
+Only ever bind this to localhost, it has no authentication to speak of.
+'''
+import os, socket, threading, subprocess
+import paramiko
+from paramiko import (ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle,
+                      SFTP_OK, AUTH_SUCCESSFUL, OPEN_SUCCEEDED)
+
+
+class Server(ServerInterface):
+    def check_auth_password(self, username, password): return AUTH_SUCCESSFUL
+    def get_allowed_auths(self, username): return 'password'
+    def check_channel_request(self, kind, chanid): return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_command, args=(channel, command.decode('utf-8')), daemon=True).start()
+        return True
+
+
+def run_command(channel, command):
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def pump():
+        while True:
+            data = channel.recv(65536)
+            if not data: break
+            proc.stdin.write(data)
+        proc.stdin.close()
+    threading.Thread(target=pump, daemon=True).start()
+    while True:
+        data = proc.stdout.read1(65536)
+        if not data: break
+        channel.sendall(data)
+    channel.sendall_stderr(proc.stderr.read())
+    channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+class Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        if attr._flags & attr.FLAG_SIZE:
+            self.readfile.truncate(attr.st_size)
+        return SFTP_OK
+
+
+class LocalSftp(SFTPServerInterface):
+    def list_folder(self, path):
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, getattr(attr, 'st_mode', None) or 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY: mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR: mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else: mode = 'rb'
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path): return self.call(os.remove, path)
+    def rename(self, old, new): return self.call(os.rename, old, new)
+    def posix_rename(self, old, new): return self.call(os.replace, old, new)
+    def mkdir(self, path, attr): return self.call(os.mkdir, path)
+    def rmdir(self, path): return self.call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        if attr._flags & attr.FLAG_AMTIME:
+            os.utime(path, (attr.st_atime, attr.st_mtime))
+        if attr._flags & attr.FLAG_SIZE:
+            os.truncate(path, attr.st_size)
+        return SFTP_OK
+
+    def call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class StandInServer:
+    def __init__(self, port=0):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.handshakes = 0
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                (client, _) = self.sock.accept()
+            except OSError:
+                return
+            self.handshakes += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, LocalSftp)
+            transport.start_server(server=Server())
+            self.transports.append(transport)
+
+    def config(self, directory, **extra):
+        '''sftp config for SftpPool/SftpUploader pointing at this server'''
+        return dict({'host': '127.0.0.1', 'port': self.port, 'username': 'bench', 'password': 'bench',
+                     'directory': directory}, **extra)
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
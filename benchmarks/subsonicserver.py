@@ -0,0 +1,126 @@
+'''
+Local mock of the handful of Subsonic API endpoints the api target uses.
+
+Serves ping, search3 (empty query pages through every song), star, unstar,
+setRating and scrobble over HTTP/1.1 with keep-alive, backed by a
+navidrome.db from generate.py so results can be compared with a DB push.
+Any username/password is accepted and acts as the user with that user_name.
+Counts requests per endpoint.
+'''
+import json, sqlite3, threading, datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_call(parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = parse_qs(urlsplit(self.path).query)
+        params.update(parse_qs(body.decode('utf-8'), keep_blank_values=True))
+        self.handle_call(params)
+
+    def handle_call(self, params):
+        endpoint = urlsplit(self.path).path.rsplit('/', 1)[-1].replace('.view', '')
+        server = self.server.mock
+        server.count(endpoint)
+        method = getattr(server, endpoint.replace('3', '_3'), None)
+        if method is None:
+            body = {'status': 'failed', 'error': {'code': 0, 'message': f'unknown endpoint {endpoint}'}}
+        else:
+            body = {'status': 'ok', 'version': '1.16.1'}
+            body.update(method(params) or {})
+        data = json.dumps({'subsonic-response': body}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockSubsonic:
+    def __init__(self, db_path, port=0):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def user_id(self, params):
+        with self.lock:
+            row = self.conn.execute('SELECT id FROM user WHERE user_name = ?', (params['u'][0],)).fetchone()
+        return row[0]
+
+    def ping(self, params):
+        return {}
+
+    def search_3(self, params):
+        user = self.user_id(params)
+        count = int(params.get('songCount', ['20'])[0])
+        offset = int(params.get('songOffset', ['0'])[0])
+        with self.lock:
+            rows = self.conn.execute('''SELECT m.id, m.title, m.album, m.artist, m.album_artist, m.album_id, m.path,
+                                               m.mbz_recording_id, m.created_at, a.play_count, a.rating, a.starred_at
+                                        FROM media_file m LEFT JOIN annotation a
+                                          ON a.item_id = m.id AND a.user_id = ? AND a.item_type = 'media_file'
+                                        ORDER BY m.rowid LIMIT ? OFFSET ?''', (user, count, offset)).fetchall()
+        songs = []
+        for (id, title, album, artist, album_artist, album_id, path, mbid, created, plays, rating, starred) in rows:
+            song = {'id': id, 'title': title, 'album': album, 'artist': artist, 'displayAlbumArtist': album_artist,
+                    'albumId': album_id, 'path': path, 'isDir': False, 'created': created}
+            if mbid: song['musicBrainzId'] = mbid
+            if plays: song['playCount'] = plays
+            if rating: song['userRating'] = rating
+            if starred: song['starred'] = starred
+            songs.append(song)
+        return {'searchResult3': {'song': songs}}
+
+    def annotate(self, user, id, plays=0, **values):
+        '''sets values on the user's annotation of a song, adds plays to its play count'''
+        columns = list(values)
+        sets = [c + ' = ?' for c in columns] + ['play_count = coalesce(play_count, 0) + ?']
+        with self.lock, self.conn:
+            cur = self.conn.execute(f'''UPDATE annotation SET {", ".join(sets)}
+                                        WHERE user_id = ? AND item_id = ? AND item_type = 'media_file' ''',
+                                    list(values.values()) + [plays, user, id])
+            if not cur.rowcount:
+                self.conn.execute(f'''INSERT INTO annotation (ann_id, user_id, item_id, item_type, play_count{"".join(", " + c for c in columns)})
+                                      VALUES (lower(hex(randomblob(16))), ?, ?, 'media_file', ?{", ?" * len(columns)})''',
+                                  [user, id, plays] + list(values.values()))
+
+    def star(self, params):
+        user = self.user_id(params)
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        for id in params.get('id', []):
+            self.annotate(user, id, starred=True, starred_at=now)
+
+    def unstar(self, params):
+        user = self.user_id(params)
+        for id in params.get('id', []):
+            self.annotate(user, id, starred=False, starred_at=None)
+
+    def setRating(self, params):
+        self.annotate(self.user_id(params), params['id'][0], rating=int(params['rating'][0]))
+
+    def scrobble(self, params):
+        user = self.user_id(params)
+        for id in params.get('id', []):
+            self.annotate(user, id, plays=1)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.conn.close()